@@ -3,6 +3,19 @@
 HOST=${APP_HOST:="0.0.0.0"}
 PORT=${APP_PORT:="8080"}
 WORKERS=${GUNICORN_WORKERS:="2"}
+# Configuration and keys are loaded once in the master and shared by the forked workers
+PRELOAD=${GUNICORN_PRELOAD:="true"}
+
+# Metrics of all workers are aggregated through this directory, it must be empty on start
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:="/tmp/elixir_rems_proxy_metrics"}
+export prometheus_multiproc_dir=$PROMETHEUS_MULTIPROC_DIR
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+PRELOAD_FLAG=""
+if [ "$PRELOAD" = "true" ]; then
+    PRELOAD_FLAG="--preload"
+fi
 
 echo 'Start ELIXIR Permissions API for REMS API'
-exec gunicorn elixir_rems_proxy.app:init_app --bind $HOST:$PORT --worker-class aiohttp.GunicornUVLoopWebWorker --workers $WORKERS
+exec gunicorn elixir_rems_proxy.app:init_app --bind $HOST:$PORT --worker-class aiohttp.GunicornUVLoopWebWorker --workers $WORKERS \
+    --config "$(dirname "$0")/gunicorn.conf.py" $PRELOAD_FLAG
@@ -0,0 +1,22 @@
+"""Gunicorn server hooks."""
+
+import gc
+
+from gunicorn.arbiter import Arbiter
+from gunicorn.workers.base import Worker
+from prometheus_client import multiprocess
+
+
+def when_ready(server: Arbiter) -> None:
+    """Move objects created so far, including the app preloaded with `--preload`, out of garbage collection.
+
+    Collections would otherwise write to the memory of every object they inspect, copying the pages
+    that forked workers share with the master. `gc.freeze` is only available from Python 3.7.
+    """
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def child_exit(server: Arbiter, worker: Worker) -> None:
+    """Drop live metrics of an exited worker."""
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,53 +1,208 @@
 """ELIXIR Permissions API proxy for REMS API."""
 
+import asyncio
 import sys
+import threading
+
+from functools import partial
+from typing import AsyncGenerator, Optional
 
 from aiohttp import web
 
-from .middlewares import api_key, username_in_path
-from .endpoints.permissions import request_rems_permissions
+from .middlewares import add_age_header, add_profile_header, add_request_id_header, admission, api_key, metrics, profiling, request_id
+from .middlewares import RATE_LIMIT, charge_rate_limit, route_policies, route_policy, username_in_path
+from .endpoints.permissions import iso_to_timestamp, permission_visa, request_rems_permissions, request_rems_permissions_batch, stream_rems_permissions
 from .config import CONFIG, LOG
+from .config.keys import KEY_RING
+from .utils.client import init_rems_session, close_rems_session
+from .utils.signing import init_key_reload, init_signer, close_key_reload, close_signer
+from .utils.metrics import render_metrics
+from .utils.profiling import StackSampler, profiling_authorized
+from .utils.snapshot import init_permissions_snapshot, close_permissions_snapshot
+from .utils.sync import init_entitlement_sync, close_entitlement_sync
+from .utils.codec import CODEC
+from .utils.responses import JSONBody, StaticBody, json_response
+from .utils.types import PermissionFilter
 
 routes = web.RouteTableDef()
 
+# Revalidated on each request, a health check must not be answered by a cache
+INDEX_BODY = StaticBody(b"ELIXIR Permissions API proxy for REMS API", "text/plain; charset=utf-8", "no-cache")
+JWKS_BODY = JSONBody(lambda: KEY_RING.current.jwks, f"public, max-age={CONFIG.jwks_max_age}")
+# Encoded on import, so that workers forked by `gunicorn --preload` share it until the keys change
+JWKS_BODY.get()
+
 
 @routes.get("/", name="index")
 async def index(request: web.Request) -> web.Response:
     """Return name of service, doubles as a health check function."""
     LOG.debug("INFO Request received.")
-    return web.Response(text="ELIXIR Permissions API proxy for REMS API")
+    return INDEX_BODY.response(request)
+
+
+def permission_filter(request: web.Request) -> Optional[PermissionFilter]:
+    """Read the permissions requested with the `resource`, `prefix` and `since` query parameters, None for all of them."""
+    resource, prefix, since = (request.query.get(name) or None for name in ("resource", "prefix", "since"))
+    if resource is None and prefix is None and since is None:
+        return None
+    timestamp = None
+    if since is not None:
+        try:
+            timestamp = int(since) if since.isdigit() else iso_to_timestamp(since)
+        except (ValueError, OverflowError):
+            raise web.HTTPBadRequest(text="'since' must be a Unix timestamp or an ISO 8601 date.")
+    return PermissionFilter(resource, prefix, timestamp)
 
 
 @routes.get("/permissions/{username}")
-async def get_permissions(request: web.Request) -> web.Response:
+@route_policy(api_key=True, username=True)
+async def get_permissions(request: web.Request) -> web.StreamResponse:
     """GET request to the /permissions endpoint.
 
     List all datasets user has access to.
     """
     LOG.debug("GET Request received.")
 
+    # Only the requested permissions are signed
+    requested = permission_filter(request)
+
+    if CONFIG.stream_permissions:
+        return await stream_passport(
+            request,
+            stream_rems_permissions(
+                request=request, username=request.match_info["username"], api_key=request.headers["Permissions-Api-Key"], permission_filter=requested
+            ),
+        )
+
     permissions = await request_rems_permissions(
-        request=request, username=request.match_info.get("username"), api_key=request.headers.get("Permissions-Api-Key")
+        request=request, username=request.match_info.get("username"), api_key=request.headers.get("Permissions-Api-Key"), permission_filter=requested
     )
 
     # The new GA4GH RI format
     ga4gh_passport = {"ga4gh_passport_v1": permissions}
 
-    return web.json_response(ga4gh_passport)
+    return json_response(ga4gh_passport)
+
+
+@routes.post("/permissions")
+@route_policy(api_key=True)
+async def post_permissions(request: web.Request) -> web.Response:
+    """POST request to the /permissions endpoint.
+
+    List all datasets each of the given users has access to.
+    """
+    LOG.debug("POST Request received.")
+
+    try:
+        body = await request.json(loads=CODEC.loads)
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body must be JSON.")
+    usernames = body.get("usernames") if isinstance(body, dict) else None
+    if not isinstance(usernames, list) or not all(isinstance(username, str) and username for username in usernames):
+        raise web.HTTPBadRequest(text="Request body must contain 'usernames', a list of usernames.")
+    if len(usernames) > CONFIG.batch_max_users:
+        raise web.HTTPBadRequest(text=f"At most {CONFIG.batch_max_users} usernames can be requested at once.")
+
+    # Duplicates are fetched once
+    usernames = list(dict.fromkeys(usernames))
+    # Under a rate limit each user takes a token of the api key, the first one taken on admission
+    buckets = request.get(RATE_LIMIT)
+    if buckets is not None and len(usernames) > buckets.burst:
+        raise web.HTTPBadRequest(text=f"At most {int(buckets.burst)} usernames can be requested at once under the rate limit.")
+    charge_rate_limit(request, len(usernames) - 1)
+
+    passports = await request_rems_permissions_batch(request=request, usernames=usernames, api_key=request.headers["Permissions-Api-Key"])
+
+    return json_response(passports)
+
+
+async def stream_passport(request: web.Request, passports: AsyncGenerator[str, None]) -> web.StreamResponse:
+    """Write a GA4GH passport response while the passports are produced."""
+    try:
+        # The first passport is awaited before sending headers, so that REMS errors still get their own status
+        first: Optional[str] = await passports.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    try:
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await response.write(b'{"ga4gh_passport_v1": [')
+        if first is not None:
+            await response.write(CODEC.dumps(first))
+            async for passport in passports:
+                await response.write(b", " + CODEC.dumps(passport))
+        await response.write(b"]}")
+        await response.write_eof()
+        return response
+    finally:
+        await passports.aclose()
 
 
 @routes.get("/jwks.json")
 async def jwks(request: web.Request) -> web.Response:
-    """Return JWK set keys."""
+    """Return the JWK set of the published keys."""
     LOG.info("Received request to GET /jwks.json.")
-    return web.json_response(CONFIG.public_key)
+    return JWKS_BODY.response(request)
+
+
+@routes.get("/metrics")
+async def get_metrics(request: web.Request) -> web.Response:
+    """Return metrics in the Prometheus text format."""
+    body, content_type = render_metrics()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+async def admin_profile(request: web.Request) -> web.Response:
+    """Sample the stacks of the worker for `seconds`, and return them in the folded format of flame graph tools."""
+    if not profiling_authorized(request):
+        raise web.HTTPForbidden(text="Missing or invalid profiling token.")
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+        interval = float(request.query.get("interval", "0.01"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="'seconds' and 'interval' must be numbers.")
+    if not 0 < seconds <= CONFIG.profile_max_seconds or not 0.001 <= interval <= 1:
+        raise web.HTTPBadRequest(text=f"'seconds' must be within (0, {CONFIG.profile_max_seconds}], and 'interval' within [0.001, 1].")
+
+    LOG.info("Sampling the worker for %ss.", seconds)
+    # The event loop runs in this thread, sampled from another one while the worker goes on serving requests
+    sampler = StackSampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+    return web.Response(text=sampler.folded(), headers={"X-Profile-Samples": str(sampler.samples)})
 
 
 async def init_app() -> web.Application:
     """Initialise the app."""
     LOG.info("Initialising the server.")
-    app = web.Application(middlewares=[api_key(), username_in_path()])
+    app = web.Application(middlewares=[request_id(), metrics()])
     app.router.add_routes(routes)
+    # Route checks are looked up by the matched route, unprotected routes skip them
+    policies = route_policies(app.router)
+    app.middlewares.extend([api_key(policies), username_in_path(policies), admission(policies)])
+    app.on_response_prepare.append(add_request_id_header)
+    app.on_response_prepare.append(add_age_header)
+    # Added only when enabled, so that requests pay nothing for profiling otherwise
+    if CONFIG.profiling_token:
+        app.middlewares.append(profiling(policies))
+        app.on_response_prepare.append(add_profile_header)
+        app.router.add_get("/admin/profile", admin_profile)
+    app.on_startup.append(init_rems_session)
+    # Keys are reloaded before the signing pool loads the active one
+    app.on_startup.append(init_key_reload)
+    app.on_startup.append(init_signer)
+    app.on_startup.append(init_permissions_snapshot)
+    # Started after the REMS client it syncs with, and stopped before it is closed
+    app.on_startup.append(partial(init_entitlement_sync, to_visa=permission_visa))
+    app.on_cleanup.append(close_entitlement_sync)
+    app.on_cleanup.append(close_rems_session)
+    app.on_cleanup.append(close_signer)
+    app.on_cleanup.append(close_key_reload)
+    app.on_cleanup.append(close_permissions_snapshot)
     return app
 
 
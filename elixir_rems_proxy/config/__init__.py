@@ -3,23 +3,102 @@
 import os
 import sys
 import json
+import zlib
 import logging
 
+from contextvars import ContextVar
 from pathlib import Path
 from configparser import ConfigParser
-from distutils.util import strtobool
 from typing import Union
 
 from ..utils.types import Config
 
-formatting = "[%(asctime)s][%(name)s][%(process)d %(processName)s][%(levelname)-8s] (L:%(lineno)s) %(module)s | %(funcName)s: %(message)s"
-logging.basicConfig(level=logging.DEBUG if bool(strtobool(os.environ.get("DEBUG", "False"))) else logging.INFO, format=formatting)
-LOG = logging.getLogger("ELIXIR")
+if sys.version_info < (3, 7):
+    # Gives each asyncio task a copy of the context, as asyncio itself does from Python 3.7
+    import aiocontextvars  # noqa: F401
+
+formatting = "[%(asctime)s][%(name)s][%(process)d %(processName)s][%(levelname)-8s][%(request_id)s] (L:%(lineno)s) %(module)s | %(funcName)s: %(message)s"
+
+# Truth values accepted in the configuration
+TRUE_VALUES = ("y", "yes", "t", "true", "on", "1")
+FALSE_VALUES = ("n", "no", "f", "false", "off", "0")
+
+# Correlation ID of the request being handled, set by the request_id middleware
+REQUEST_ID = ContextVar("request_id", default="-")
+
+
+def strtobool(value: str) -> bool:
+    """Convert a truth value of the configuration to a boolean.
+
+    Replaces `distutils.util.strtobool`, as importing distutils also imports setuptools, a large part of the startup time.
+    """
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(f"Invalid truth value {value!r}.")
+
+
+class RequestContextFilter(logging.Filter):
+    """Add the request correlation ID to log records, and keep debug records of a sample of requests.
+
+    Requests are sampled by their correlation ID, so that a sampled request keeps all of its debug records.
+    """
+
+    def __init__(self, debug_sample_rate: float = 1.0) -> None:
+        """Keep debug records of `debug_sample_rate` of requests."""
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Add `request_id` to the record, return whether it is kept."""
+        request_id = REQUEST_ID.get()
+        record.request_id = request_id
+        if record.levelno > logging.DEBUG or self.debug_sample_rate >= 1 or request_id == "-":
+            return True
+        return zlib.crc32(request_id.encode("utf-8")) < self.debug_sample_rate * 0x100000000
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as single line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the record."""
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "process": record.process,
+            "level": record.levelname,
+            "request_id": getattr(record, "request_id", "-"),
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(debug: bool, log_format: str, debug_sample_rate: float) -> logging.Logger:
+    """Set up logging as `text` or `json` lines, with debug records sampled by request."""
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestContextFilter(debug_sample_rate))
+    handler.setFormatter(JSONFormatter() if log_format == "json" else logging.Formatter(formatting))
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, handlers=[handler])
+    return logging.getLogger("ELIXIR")
+
+
+LOG = configure_logging(
+    debug=bool(strtobool(os.environ.get("DEBUG", "False"))),
+    log_format=os.environ.get("LOG_FORMAT", "text"),
+    debug_sample_rate=float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1")),
+)
 
 
 def load_json_file(path: Union[str, Path]) -> dict:
     """Load local JSON file."""
-    LOG.info(f"Loading JSON file {path}")
+    LOG.info("Loading JSON file %s", path)
     json_file = Path(path)
     if not json_file.is_file():
         sys.exit(f"Could not find file {path}")
@@ -28,22 +107,64 @@ def load_json_file(path: Union[str, Path]) -> dict:
 
 def parse_config_file(path: Union[str, Path]) -> Config:
     """Parse configuration file."""
-    LOG.info(f"Parsing configuration file {path}")
+    LOG.info("Parsing configuration file %s", path)
     config = ConfigParser()
     config.read(path)
+    config_dir = Path(__file__).resolve().parent
+    public_key_file = os.environ.get("JWK_PUBLIC_KEY_FILE", config.get("jwk", "jwk_public_key_file")) or config_dir.joinpath("public_key.json")
+    private_key_file = os.environ.get("JWK_PRIVATE_KEY_FILE", config.get("jwk", "jwk_private_key_file")) or config_dir.joinpath("private_key.json")
 
     return Config(
         rems_url=os.environ.get("REMS_URL", config.get("rems", "rems_url")),
         repository=os.environ.get("GA4GH_REPOSITORY", config.get("ga4gh", "repository")),
         jwt_exp=int(os.environ.get("JWT_EXP", config.get("ga4gh", "jwt_exp"))),
-        public_key=load_json_file(
-            os.environ.get("JWK_PUBLIC_KEY_FILE", config.get("jwk", "jwk_public_key_file")) or Path(__file__).resolve().parent.joinpath("public_key.json")
-        ),
-        private_key=load_json_file(
-            os.environ.get("JWK_PRIVATE_KEY_FILE", config.get("jwk", "jwk_private_key_file")) or Path(__file__).resolve().parent.joinpath("private_key.json")
-        ),
+        jwt_cache_size=int(os.environ.get("JWT_CACHE_SIZE", config.get("ga4gh", "jwt_cache_size", fallback="10000"))),
+        jwt_reuse_threshold=float(os.environ.get("JWT_REUSE_THRESHOLD", config.get("ga4gh", "jwt_reuse_threshold", fallback="0.5"))),
+        public_key=load_json_file(public_key_file),
+        private_key=load_json_file(private_key_file),
+        jwk_public_key_file=str(public_key_file),
+        jwk_private_key_file=str(private_key_file),
+        key_reload_interval=float(os.environ.get("KEY_RELOAD_INTERVAL", config.get("jwk", "key_reload_interval", fallback="60"))),
+        signing_executor=os.environ.get("SIGNING_EXECUTOR", config.get("signing", "signing_executor", fallback="process")),
+        signing_workers=int(os.environ.get("SIGNING_WORKERS", config.get("signing", "signing_workers", fallback="2"))),
         host=os.environ.get("APP_HOST", config.get("server", "host")),
         port=os.environ.get("APP_PORT", config.get("server", "port")),
+        stream_permissions=bool(strtobool(os.environ.get("STREAM_PERMISSIONS", config.get("server", "stream_permissions", fallback="false")))),
+        stream_batch_size=int(os.environ.get("STREAM_BATCH_SIZE", config.get("server", "stream_batch_size", fallback="100"))),
+        json_backend=os.environ.get("JSON_BACKEND", config.get("server", "json_backend", fallback="auto")),
+        jwks_max_age=int(os.environ.get("JWKS_MAX_AGE", config.get("server", "jwks_max_age", fallback="300"))),
+        rems_connection_limit=int(os.environ.get("REMS_CONNECTION_LIMIT", config.get("rems", "connection_limit", fallback="100"))),
+        rems_connection_limit_per_host=int(os.environ.get("REMS_CONNECTION_LIMIT_PER_HOST", config.get("rems", "connection_limit_per_host", fallback="0"))),
+        rems_keepalive_timeout=float(os.environ.get("REMS_KEEPALIVE_TIMEOUT", config.get("rems", "keepalive_timeout", fallback="15"))),
+        rems_dns_cache_ttl=int(os.environ.get("REMS_DNS_CACHE_TTL", config.get("rems", "dns_cache_ttl", fallback="10"))),
+        rems_connect_timeout=float(os.environ.get("REMS_CONNECT_TIMEOUT", config.get("rems", "connect_timeout", fallback="5"))),
+        rems_read_timeout=float(os.environ.get("REMS_READ_TIMEOUT", config.get("rems", "read_timeout", fallback="30"))),
+        rems_retries=int(os.environ.get("REMS_RETRIES", config.get("rems", "retries", fallback="2"))),
+        rems_retry_backoff=float(os.environ.get("REMS_RETRY_BACKOFF", config.get("rems", "retry_backoff", fallback="0.1"))),
+        rems_max_concurrency=int(os.environ.get("REMS_MAX_CONCURRENCY", config.get("rems", "max_concurrency", fallback="100"))),
+        rems_breaker_threshold=int(os.environ.get("REMS_BREAKER_THRESHOLD", config.get("rems", "breaker_threshold", fallback="5"))),
+        rems_breaker_reset_timeout=float(os.environ.get("REMS_BREAKER_RESET_TIMEOUT", config.get("rems", "breaker_reset_timeout", fallback="30"))),
+        rems_sync_interval=float(os.environ.get("REMS_SYNC_INTERVAL", config.get("rems", "sync_interval", fallback="0"))),
+        rems_sync_api_key=os.environ.get("REMS_SYNC_API_KEY", config.get("rems", "sync_api_key", fallback="")),
+        rems_sync_user_id=os.environ.get("REMS_SYNC_USER_ID", config.get("rems", "sync_user_id", fallback="")),
+        batch_max_users=int(os.environ.get("BATCH_MAX_USERS", config.get("batch", "batch_max_users", fallback="500"))),
+        batch_concurrency=int(os.environ.get("BATCH_CONCURRENCY", config.get("batch", "batch_concurrency", fallback="10"))),
+        rate_limit=float(os.environ.get("RATE_LIMIT", config.get("admission", "rate_limit", fallback="0"))),
+        rate_limit_burst=float(os.environ.get("RATE_LIMIT_BURST", config.get("admission", "rate_limit_burst", fallback="20"))),
+        rate_limit_keys=int(os.environ.get("RATE_LIMIT_KEYS", config.get("admission", "rate_limit_keys", fallback="10000"))),
+        max_in_flight=int(os.environ.get("MAX_IN_FLIGHT", config.get("admission", "max_in_flight", fallback="1000"))),
+        overload_retry_after=int(os.environ.get("OVERLOAD_RETRY_AFTER", config.get("admission", "overload_retry_after", fallback="1"))),
+        profiling_token=os.environ.get("PROFILING_TOKEN", config.get("profiling", "profiling_token", fallback="")),
+        profile_dir=os.environ.get("PROFILE_DIR", config.get("profiling", "profile_dir", fallback="")),
+        profile_max_seconds=float(os.environ.get("PROFILE_MAX_SECONDS", config.get("profiling", "profile_max_seconds", fallback="60"))),
+        permissions_cache_size=int(os.environ.get("PERMISSIONS_CACHE_SIZE", config.get("cache", "permissions_cache_size", fallback="1024"))),
+        permissions_cache_ttl=float(os.environ.get("PERMISSIONS_CACHE_TTL", config.get("cache", "permissions_cache_ttl", fallback="30"))),
+        permissions_stale_ttl=float(os.environ.get("PERMISSIONS_STALE_TTL", config.get("cache", "permissions_stale_ttl", fallback="0"))),
+        permissions_snapshot_file=os.environ.get("PERMISSIONS_SNAPSHOT_FILE", config.get("cache", "permissions_snapshot_file", fallback="")),
+        permissions_snapshot_lease=float(os.environ.get("PERMISSIONS_SNAPSHOT_LEASE", config.get("cache", "permissions_snapshot_lease", fallback="10"))),
+        permissions_revalidate=bool(strtobool(os.environ.get("PERMISSIONS_REVALIDATE", config.get("cache", "permissions_revalidate", fallback="false")))),
+        permissions_refresh_rate=float(os.environ.get("PERMISSIONS_REFRESH_RATE", config.get("cache", "permissions_refresh_rate", fallback="1"))),
+        permissions_refresh_burst=float(os.environ.get("PERMISSIONS_REFRESH_BURST", config.get("cache", "permissions_refresh_burst", fallback="10"))),
     )
 
 
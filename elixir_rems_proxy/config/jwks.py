@@ -1,20 +1,37 @@
-"""JWK Generator."""
+"""JWK Generator.
+
+Without arguments, a single key is written to the key files. To rotate keys without downtime,
+the private key file is turned into a key ring, of which the proxy reloads on SIGHUP or when the files change:
+
+1. `jwks.py --add` adds a new key, published in `/jwks.json` but not yet signing
+2. once relying parties have had time to fetch the new key set, `jwks.py --activate <kid>` signs with the new key
+3. once the tokens signed with the old key have expired, `jwks.py --retire <kid>` stops publishing the old key
+"""
+
+import argparse
+import base64
 import json
 import os
 import secrets
 
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Union
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
 from cryptography.hazmat.backends import default_backend
 from authlib.jose import jwk
 
+# JWK members that are safe to publish
+PUBLIC_MEMBERS = ("kty", "use", "key_ops", "alg", "kid", "crv", "n", "e", "x", "y")
+
+# Supported signing algorithms, ES256 and EdDSA are much faster to sign with and give smaller tokens than RS256
+ALGORITHMS = ("RS256", "ES256", "EdDSA")
 
-def print_jwks() -> None:
+
+def print_jwks(alg: str = "RS256") -> None:
     """Write JWK set to file."""
     print("Writing keys to file.")
-    public_data, pem = generate_jwks()
+    public_data, pem = generate_jwks(alg)
     # Public data to public_key.json
     # Double use of Path to get correct types (needed for testing)
     with open(Path(os.environ.get("JWK_PUBLIC_KEY_FILE", Path(__file__).resolve().parent.joinpath("public_key.json"))), "w") as public_file:
@@ -26,10 +43,102 @@ def print_jwks() -> None:
     print("Done. Keys saved to public_key.json and private_key.json")
 
 
-def generate_jwks() -> Tuple[dict, dict]:
+def key_files() -> Tuple[Path, Path]:
+    """Return the paths of the private and the public key file."""
+    config_dir = Path(__file__).resolve().parent
+    return (
+        Path(os.environ.get("JWK_PRIVATE_KEY_FILE", config_dir.joinpath("private_key.json"))),
+        Path(os.environ.get("JWK_PUBLIC_KEY_FILE", config_dir.joinpath("public_key.json"))),
+    )
+
+
+def write_json_atomic(path: Union[str, Path], data: dict) -> None:
+    """Replace a JSON file in one step, so that a reloading proxy never reads it half written."""
+    temporary = Path(f"{path}.tmp")
+    with open(temporary, "w") as temporary_file:
+        temporary_file.write(json.dumps(data))
+    os.replace(temporary, path)
+
+
+def load_key_ring() -> dict:
+    """Load the private key file as a key ring, a single key becomes the active key of a new ring."""
+    private_path, public_path = key_files()
+    with open(private_path) as private_file:
+        private_data = json.load(private_file)
+    if "keys" in private_data:
+        return private_data
+    with open(public_path) as public_file:
+        first = json.load(public_file)["keys"][0]
+    return {"keys": [dict(private_data, kid=first["kid"], alg=first.get("alg", "RS256"), status="active")]}
+
+
+def save_key_ring(ring: dict) -> None:
+    """Write the key ring, and the key set of its published keys."""
+    private_path, public_path = key_files()
+    public_data = {"keys": [{member: key[member] for member in PUBLIC_MEMBERS if member in key} for key in ring["keys"] if key["status"] != "retired"]}
+    # Published first, so that a key is never active before it is published
+    write_json_atomic(public_path, public_data)
+    write_json_atomic(private_path, ring)
+
+
+def add_key(alg: str = "RS256") -> str:
+    """Add a new published key to the key ring, return its key id."""
+    ring = load_key_ring()
+    public_data, private_data = generate_jwks(alg)
+    new_key = dict(private_data, kid=public_data["keys"][0]["kid"], alg=alg, status="published")
+    ring["keys"].append(new_key)
+    save_key_ring(ring)
+    return new_key["kid"]
+
+
+def set_key_status(kid: str, status: str) -> None:
+    """Activate or retire a key of the key ring, the previously active key stays published."""
+    ring = load_key_ring()
+    if kid not in {key["kid"] for key in ring["keys"]}:
+        raise SystemExit(f"No key {kid} in the key ring.")
+    for key in ring["keys"]:
+        if key["kid"] == kid:
+            if status == "retired" and key["status"] == "active":
+                raise SystemExit(f"Key {kid} is active, activate another key before retiring it.")
+            key["status"] = status
+        elif status == "active" and key["status"] == "active":
+            key["status"] = "published"
+    save_key_ring(ring)
+
+
+def b64url_encode(data: bytes) -> str:
+    """Encode bytes as an unpadded base64url JWK member."""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def generate_okp_or_ec_jwk(alg: str) -> dict:
+    """Generate a private Ed25519 or P-256 JWK."""
+    if alg == "EdDSA":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        d = private_key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+        x = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return {"kty": "OKP", "crv": "Ed25519", "x": b64url_encode(x), "d": b64url_encode(d)}
+    ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    numbers = ec_key.private_numbers()
+    return {
+        "kty": "EC",
+        "crv": "P-256",
+        "x": b64url_encode(numbers.public_numbers.x.to_bytes(32, "big")),
+        "y": b64url_encode(numbers.public_numbers.y.to_bytes(32, "big")),
+        "d": b64url_encode(numbers.private_value.to_bytes(32, "big")),
+    }
+
+
+def generate_jwks(alg: str = "RS256") -> Tuple[dict, dict]:
     """Generate JWK set."""
     # Generate keys
     print("Generating keys.")
+    if alg not in ALGORITHMS:
+        raise ValueError(f"Unsupported signing algorithm {alg}, expected one of {', '.join(ALGORITHMS)}.")
+    if alg != "RS256":
+        private_data = generate_okp_or_ec_jwk(alg)
+        public_data = {"keys": [dict({member: private_data[member] for member in PUBLIC_MEMBERS if member in private_data}, kid=secrets.token_hex(4), alg=alg)]}
+        return public_data, private_data
     private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
     public_key = private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo)
     pem = private_key.private_bytes(
@@ -45,6 +154,28 @@ def generate_jwks() -> Tuple[dict, dict]:
     return public_data, jwk.dumps(pem, kty="RSA")
 
 
+def main() -> None:
+    """Write a new key, or rotate the keys of a key ring."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--alg", choices=ALGORITHMS, default="RS256", help="signing algorithm of a new key")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--add", action="store_true", help="add a new published key to the key ring")
+    group.add_argument("--activate", metavar="KID", help="sign with a published key of the key ring")
+    group.add_argument("--retire", metavar="KID", help="stop publishing a key of the key ring")
+    args = parser.parse_args()
+
+    if args.add:
+        print(f"Added key {add_key(args.alg)}.")
+    elif args.activate:
+        set_key_status(args.activate, "active")
+        print(f"Activated key {args.activate}.")
+    elif args.retire:
+        set_key_status(args.retire, "retired")
+        print(f"Retired key {args.retire}.")
+    else:
+        print_jwks(args.alg)
+
+
 if __name__ == "__main__":
     """Run script."""
-    print_jwks()
+    main()
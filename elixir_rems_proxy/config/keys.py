@@ -0,0 +1,205 @@
+"""Signing key management."""
+
+import base64
+import json
+import os
+
+from functools import lru_cache
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+from . import CONFIG, LOG
+from ..utils.codec import CODEC
+
+# Key ring statuses: the active key signs, published keys verify tokens, retired keys are neither
+KEY_STATUSES = ("active", "published", "retired")
+
+# JWK members that are safe to publish
+PUBLIC_MEMBERS = ("kty", "use", "key_ops", "alg", "kid", "crv", "n", "e", "x", "y")
+
+# Key type and curve of each supported signing algorithm
+ALGORITHMS = {"RS256": ("RSA", None), "ES256": ("EC", "P-256"), "EdDSA": ("OKP", "Ed25519")}
+
+
+def b64url_encode(data: bytes) -> bytes:
+    """Encode bytes to unpadded base64url, as used in JWS."""
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def b64url_decode(data: str) -> bytes:
+    """Decode an unpadded base64url JWK member."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def b64url_decode_int(data: str) -> int:
+    """Decode an unpadded base64url JWK member to an integer."""
+    return int.from_bytes(b64url_decode(data), "big")
+
+
+def load_rsa_private_key(jwk: dict) -> rsa.RSAPrivateKey:
+    """Deserialize an RSA private JWK into a key object."""
+    if jwk.get("kty") != "RSA":
+        raise ValueError(f"Unsupported private key type {jwk.get('kty')}, expected RSA.")
+    n, e, d = (b64url_decode_int(jwk[member]) for member in ("n", "e", "d"))
+    if all(member in jwk for member in ("p", "q", "dp", "dq", "qi")):
+        p, q, dp, dq, qi = (b64url_decode_int(jwk[member]) for member in ("p", "q", "dp", "dq", "qi"))
+    else:
+        # The CRT parameters are optional in a JWK
+        p, q = rsa.rsa_recover_prime_factors(n, e, d)
+        dp, dq, qi = rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q), rsa.rsa_crt_iqmp(p, q)
+    return rsa.RSAPrivateNumbers(p, q, d, dp, dq, qi, rsa.RSAPublicNumbers(e, n)).private_key(default_backend())
+
+
+def load_ec_private_key(jwk: dict) -> ec.EllipticCurvePrivateKey:
+    """Deserialize a P-256 private JWK into a key object."""
+    x, y, d = (b64url_decode_int(jwk[member]) for member in ("x", "y", "d"))
+    return ec.EllipticCurvePrivateNumbers(d, ec.EllipticCurvePublicNumbers(x, y, ec.SECP256R1())).private_key(default_backend())
+
+
+def load_ed25519_private_key(jwk: dict) -> ed25519.Ed25519PrivateKey:
+    """Deserialize an Ed25519 private JWK into a key object."""
+    return ed25519.Ed25519PrivateKey.from_private_bytes(b64url_decode(jwk["d"]))
+
+
+def key_algorithm(jwk: dict) -> str:
+    """Return the `alg` of a JWK, or the algorithm of its key type when it has none."""
+    if "alg" in jwk:
+        return jwk["alg"]
+    return next((alg for alg, (kty, crv) in ALGORITHMS.items() if jwk.get("kty") == kty and jwk.get("crv") == crv), "RS256")
+
+
+def signature_function(jwk: dict, alg: str) -> Callable[[bytes], bytes]:
+    """Deserialize a private JWK, and return a function computing JWS signatures of `alg` with it."""
+    if alg not in ALGORITHMS:
+        raise ValueError(f"Unsupported signing algorithm {alg}, expected one of {', '.join(ALGORITHMS)}.")
+    kty, crv = ALGORITHMS[alg]
+    if jwk.get("kty") != kty or jwk.get("crv") != crv:
+        raise ValueError(f"Unsupported private key type {jwk.get('kty')} for {alg}, expected {' '.join(filter(None, (kty, crv)))}.")
+
+    if alg == "ES256":
+        ec_key = load_ec_private_key(jwk)
+
+        def sign_es256(data: bytes) -> bytes:
+            # JWS uses the fixed size r || s encoding instead of DER
+            r, s = decode_dss_signature(ec_key.sign(data, ec.ECDSA(hashes.SHA256())))
+            return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+        return sign_es256
+    if alg == "EdDSA":
+        return load_ed25519_private_key(jwk).sign
+    rsa_key = load_rsa_private_key(jwk)
+    return lambda data: rsa_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+
+class SigningKey:
+    """Private key deserialized once, with its JWS header encoded once per issuer host.
+
+    The key object is not picklable, pool workers create their own from `jwk`, `kid` and `alg`.
+    """
+
+    def __init__(self, jwk: dict, kid: str, alg: str = "RS256") -> None:
+        """Load the private `jwk` published with key id `kid`, for signing with `alg`."""
+        self.jwk = jwk
+        self.kid = kid
+        self.alg = alg
+        self.signature = signature_function(jwk, alg)
+        # Bounded, as the host comes from the request
+        self.encoded_header = lru_cache(maxsize=64)(self._encode_header)
+
+    def _encode_header(self, host: str) -> bytes:
+        """Encode the JWS header of tokens issued at `host`."""
+        header = {"jku": f"https://{host}/jwks.json", "kid": self.kid, "alg": self.alg, "typ": "JWT"}
+        return b64url_encode(CODEC.dumps(header))
+
+    def sign(self, encoded_header: bytes, payload: dict) -> str:
+        """Return a JWS compact serialization of `payload` under an encoded header."""
+        signing_input = encoded_header + b"." + b64url_encode(CODEC.dumps(payload))
+        return (signing_input + b"." + b64url_encode(self.signature(signing_input))).decode("ascii")
+
+
+class KeySet(NamedTuple):
+    """A consistent state of the key ring: the key that signs, and the JWK set that verifies."""
+
+    active: SigningKey
+    jwks: dict
+
+
+def load_key_set(private_key: dict, public_key: dict) -> KeySet:
+    """Load the key set from a private key ring and the public key set.
+
+    A key ring is a JWK set of private keys, each with a `kid` and a `status`, of which one is active.
+    The published key set is derived from it, and `public_key` is ignored.
+    A single private key pairs with the first key of `public_key`, which is published as is.
+    """
+    if "keys" not in private_key:
+        first = public_key["keys"][0]
+        return KeySet(SigningKey(private_key, first["kid"], key_algorithm(first)), public_key)
+
+    active = [jwk for jwk in private_key["keys"] if jwk.get("status", "published") == "active"]
+    if len(active) != 1:
+        raise ValueError(f"Key ring must have exactly one active key, found {len(active)}.")
+    published = []
+    for jwk in private_key["keys"]:
+        if "kid" not in jwk:
+            raise ValueError("Key ring keys must have a `kid`.")
+        status = jwk.get("status", "published")
+        if status not in KEY_STATUSES:
+            raise ValueError(f"Unknown status {status} of key {jwk['kid']}, expected one of {', '.join(KEY_STATUSES)}.")
+        if status != "retired":
+            published.append({member: jwk[member] for member in PUBLIC_MEMBERS if member in jwk})
+    return KeySet(SigningKey(active[0], active[0]["kid"], key_algorithm(active[0])), {"keys": published})
+
+
+class KeyRing:
+    """Signing keys, reloaded from the key files without interrupting signing.
+
+    A reload builds a whole new `KeySet` before replacing `current` in one assignment,
+    so a request that takes `current` once signs and publishes a consistent set of keys.
+    """
+
+    def __init__(self, key_set: KeySet, private_key_file: str = "", public_key_file: str = "") -> None:
+        """Start from `key_set`, loaded from the given key files."""
+        self.current = key_set
+        self.private_key_file = private_key_file
+        self.public_key_file = public_key_file
+        self._mtimes = self.mtimes()
+
+    def mtimes(self) -> Tuple[Optional[float], ...]:
+        """Return the modification times of the key files."""
+        mtimes = []
+        for path in (self.private_key_file, self.public_key_file):
+            try:
+                mtimes.append(os.stat(path).st_mtime if path else None)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self) -> bool:
+        """Reload the key files, keep the current keys if they cannot be loaded."""
+        mtimes = self.mtimes()
+        try:
+            with open(self.private_key_file) as private_file:
+                private_key = json.load(private_file)
+            with open(self.public_key_file) as public_file:
+                public_key = json.load(public_file)
+            key_set = load_key_set(private_key, public_key)
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            LOG.error("Could not reload signing keys, keeping key %s: %r", self.current.active.kid, error)
+            return False
+        self.current = key_set
+        self._mtimes = mtimes
+        LOG.info("Reloaded signing keys: signing with %s, publishing %d keys.", key_set.active.kid, len(key_set.jwks["keys"]))
+        return True
+
+    def reload_if_modified(self) -> bool:
+        """Reload the key files if they have been modified since they were last loaded."""
+        if self.mtimes() == self._mtimes:
+            return False
+        return self.reload()
+
+
+KEY_RING = KeyRing(load_key_set(CONFIG.private_key, CONFIG.public_key), CONFIG.jwk_private_key_file, CONFIG.jwk_public_key_file)
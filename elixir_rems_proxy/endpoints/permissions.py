@@ -1,103 +1,214 @@
 """Process Requests."""
 
+import re
+import asyncio
 import time
-from typing import List, Optional, Tuple
+import logging
+import hashlib
+from functools import lru_cache, partial
+from typing import AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, TypeVar, cast
 
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import quote
 from uuid import uuid4
 
 import aiohttp
-import dateutil.parser
 
 from aiohttp import web
-from authlib.jose import jwt
 
 from ..config import CONFIG, LOG
-from ..utils.types import Permission, Visa, Passport
+from ..config.keys import KEY_RING
+from ..utils.cache import LRUCache
+from ..utils.codec import CODEC
+from ..utils.client import REMS_CLIENT, REMS_CONNECTION_STATS, REMS_UNAVAILABLE, RemsClient, create_rems_client, rems_timeout
+from ..utils.jsonstream import iter_json_array
+from ..utils.metrics import STAGE_DURATION, SYNC_LOOKUPS, VISAS_PER_USER
+from ..utils.ratelimit import TokenBuckets
+from ..utils.signing import SIGNER, Signer
+from ..utils.snapshot import PERMISSIONS_SNAPSHOT, Key, PermissionSnapshot
+from ..utils.sync import ENTITLEMENT_SYNC
+from ..utils.types import Permission, PermissionFilter, Visa, Passport
+
+# Raw REMS permissions keyed on (username, api key fingerprint), expired ones are served while REMS is unavailable or being revalidated
+PERMISSIONS_CACHE: LRUCache[List[Permission]] = LRUCache(
+    CONFIG.permissions_cache_size, CONFIG.permissions_cache_ttl, CONFIG.permissions_stale_ttl, CONFIG.permissions_revalidate
+)
+
+# Signed visas keyed on (username, visa, issuer host, key id), reused until only `jwt_reuse_threshold` of their lifetime is left
+TOKEN_CACHE: LRUCache[Passport] = LRUCache(CONFIG.jwt_cache_size, CONFIG.jwt_exp * (1 - CONFIG.jwt_reuse_threshold))
+
+# Refreshes of cached permissions with `Cache-Control: no-cache`, limited per api key so that clients cannot bypass the cache at will
+REFRESH_BUCKETS = TokenBuckets(CONFIG.permissions_refresh_rate, CONFIG.permissions_refresh_burst, CONFIG.rate_limit_keys)
+
+# Key used to store the users refreshed by a request
+CACHE_REFRESHES = "cache_refreshes"
+
+# Used when the app has not started a signing pool
+SYNCHRONOUS_SIGNER = Signer()
+
+T = TypeVar("T")
+
+
+def api_key_fingerprint(api_key: Optional[str]) -> bytes:
+    """Hash the api key, so that it is not kept in memory as part of a cache key."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).digest()
+
+
+def record_permissions_age(request: web.Request, cache_key: Tuple[Hashable, ...]) -> None:
+    """Store the age of cached permissions in the request for the `Age` header, the oldest when there are several users."""
+    age = PERMISSIONS_CACHE.age(cache_key)
+    if age is not None:
+        request["permissions_age"] = max(age, request.get("permissions_age", 0))
+
+
+async def snapshot_permissions(
+    snapshot: PermissionSnapshot, cache_key: Key, fetch: Callable[[], Awaitable[List[Permission]]], refresh: bool
+) -> Tuple[float, List[Permission]]:
+    """Return permissions from the snapshot, or fetched by one worker for all, with seconds since they were fetched."""
+    fetched, permissions = await snapshot.get_or_fetch(cache_key, fetch, refresh=refresh)
+    return max(time.time() - fetched, 0), permissions
+
+
+def refresh_requested(request: web.Request, username: str, api_key: str) -> bool:
+    """Return whether the request asks for fresh permissions of a user with `Cache-Control: no-cache`, and may have them.
+
+    Each user refreshed takes a token of the api key, once per request. Without tokens left, cached permissions are used.
+    """
+    if "no-cache" not in request.headers.get("Cache-Control", ""):
+        return False
+    refreshes = request.setdefault(CACHE_REFRESHES, {})
+    if username not in refreshes:
+        refreshes[username] = CONFIG.permissions_refresh_rate > 0 and REFRESH_BUCKETS.take(api_key) == 0
+        if not refreshes[username]:
+            LOG.debug("Not refreshing permissions of %s, the api key is over its refresh rate.", username)
+    return refreshes[username]
+
+
+def invalidate_permissions(username: str) -> int:
+    """Drop cached REMS permissions of a user, return the number of entries dropped."""
+    LOG.debug("Invalidate cached permissions of %s.", username)
+    return PERMISSIONS_CACHE.invalidate(lambda key: key[0] == username)
+
+
+def ga4gh_visa_v1(permission: Permission, asserted: Optional[int]) -> Visa:
+    """Construct a GA4GH Passport Visa from a REMS permission and its parsed start date."""
+
+    # expires was removed from new RI spec
+    # # REMS doesn't have "end" date, for now, replace it with "start" + 3 years for an estimate
+    # if permission.get('end') is None:
+    #     expires = await iso_to_timestamp(permission.get('start'))
+    #     expires += 94608000
+    # else:
+    #     # Fallback, in case REMS is updated to use this key
+    #     expires = await iso_to_timestamp(permission.get('end'))
+
+    # Fields shared by all visas are added when the visa is signed
+    return Visa(f"{CONFIG.repository}{permission.resource}", asserted)
+
+
+def permission_visa(permission: Permission) -> Visa:
+    """Construct a GA4GH Passport Visa from a REMS permission, parsing its start date."""
+    return ga4gh_visa_v1(permission, iso_to_timestamp(permission.start))
+
+
+def filter_permissions(permissions: List[Permission], permission_filter: PermissionFilter) -> List[Permission]:
+    """Keep the permissions requested by the client."""
+    return [permission for permission in permissions if permission_filter.selects(permission.resource, iso_to_timestamp(permission.start))]
+
+
+def filter_visas(visas: List[Visa], permission_filter: PermissionFilter) -> List[Visa]:
+    """Keep the visas requested by the client, visa values being the repository followed by the resource."""
+    prefix = len(CONFIG.repository)
+    return [visa for visa in visas if permission_filter.selects(visa.value[prefix:], visa.asserted)]
+
+
+async def iter_filtered_permissions(permissions: AsyncIterable[Permission], permission_filter: PermissionFilter) -> AsyncIterator[Permission]:
+    """Yield the permissions requested by the client while they are received."""
+    async for permission in permissions:
+        if permission_filter.selects(permission.resource, iso_to_timestamp(permission.start)):
+            yield permission
 
 
 async def create_ga4gh_visa_v1(permissions: List[Permission]) -> List[Visa]:
     """Construct a GA4GH Passport Visa type of response."""
     LOG.debug("Construct a GA4GH Passport Visa type of response.")
 
-    # Collect permissions here
-    visas = []
+    with STAGE_DURATION.labels("date_parsing").time():
+        asserted = [iso_to_timestamp(permission.start) for permission in permissions]
+    with STAGE_DURATION.labels("visa_construction").time():
+        return [ga4gh_visa_v1(permission, start) for permission, start in zip(permissions, asserted)]
+
 
-    for permission in permissions:
+async def iter_ga4gh_visa_v1(permissions: AsyncIterable[Permission]) -> AsyncIterator[Visa]:
+    """Construct GA4GH Passport Visas while the permissions are received."""
+    LOG.debug("Stream GA4GH Passport Visas.")
 
-        # expires was removed from new RI spec
-        # # REMS doesn't have "end" date, for now, replace it with "start" + 3 years for an estimate
-        # if permission.get('end') is None:
-        #     expires = await iso_to_timestamp(permission.get('start'))
-        #     expires += 94608000
-        # else:
-        #     # Fallback, in case REMS is updated to use this key
-        #     expires = await iso_to_timestamp(permission.get('end'))
+    async for permission in permissions:
+        yield permission_visa(permission)
 
-        visa = {
-            "type": "ControlledAccessGrants",
-            "value": f'{CONFIG.repository}{permission.get("resource")}',
-            "source": "https://ga4gh.org/duri/no_org",
-            "by": "dac",
-            "asserted": await iso_to_timestamp(permission.get("start")),
-        }
-        visas.append(Visa(visa))
 
-    return visas
+# Date format used by REMS, 2020-01-01T12:00:00.000Z, also with a numeric UTC offset
+REMS_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?(?:(Z)|([+-])(\d\d):?(\d\d))$")
 
 
-async def iso_to_timestamp(iso: Optional[str]) -> Optional[int]:
+@lru_cache(maxsize=4096)
+def iso_to_timestamp(iso: Optional[str]) -> Optional[int]:
     """Convert ISO 8601 date to (int)timestamp without milliseconds.
 
     2020-01-01T12:00:00.000Z -> 1577880000
-    """
-    LOG.debug("Convert date to timestamp.")
 
+    Results are memoized, as many entitlements share a start date.
+    """
     # Check that date is not null
-    if isinstance(iso, str):
-        # Convert ISO 8601 to date
-        date = dateutil.parser.parse(iso)
-        # Convert date to timestamp
-        ts = datetime.timestamp(date)
-        # Convert timestamp to string for splitting
-        ts_str = str(ts)
-        # Split timestamp to remove millis
-        ts_split = ts_str.split(".")
-        # Convert string to integer
-        timestamp_final = int(ts_split[0])
-        return timestamp_final
-    else:
+    if not isinstance(iso, str):
         return None
 
+    match = REMS_DATE.match(iso)
+    if match is None:
+        # Other formats, and dates without a time zone, which are read as local time
+        import dateutil.parser  # Rarely needed, so imported on first use
+
+        return int(datetime.timestamp(dateutil.parser.parse(iso)))
 
-async def call_rems_api(url: str, headers: dict) -> List[Permission]:
-    """Send request for permissions."""
+    year, month, day, hour, minute, second, utc, sign, offset_hours, offset_minutes = match.groups()
+    # Millis are dropped by ignoring the fraction, and dates out of range raise ValueError as dateutil does
+    timestamp = int(datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=timezone.utc).timestamp())
+    if utc is None:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        timestamp += -offset if sign == "+" else offset
+    return timestamp
+
+
+async def call_rems_api(url: str, headers: dict, client: Optional[RemsClient] = None) -> List[Permission]:
+    """Send request for permissions.
+
+    The shared app client is used when given, otherwise a one-off client is opened for the call.
+    """
     LOG.debug("Send request for permissions.")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                result = await response.json()
-                # REMS peculiarity: user not found == user found, but no permissions
-                # if result == []:
-                #     raise web.HTTPNotFound(text='Request was successful, but no records were found. '
-                #                                 'Either the user has no permissions, or the username was not found.')
-                return result
-            elif response.status == 400:
-                LOG.error(f"400: {response}")
-                raise web.HTTPBadRequest(text="400 Bad Request")
-            elif response.status == 401:
-                LOG.error(f"401: {response}")
-                raise web.HTTPUnauthorized(text="401 Unauthorized")
-            elif response.status == 403:
-                LOG.error(f"403: {response}")
-                raise web.HTTPForbidden(text="403 Forbidden")
-            elif response.status == 404:
-                LOG.error(f"404: {response}")
-                raise web.HTTPNotFound(text="404 Not Found")
-            else:
-                LOG.error(f"500: {response}")
-                raise web.HTTPInternalServerError(text="500 Internal Server Error")
+    if client is None:
+        async with aiohttp.ClientSession(timeout=rems_timeout()) as session:
+            return await call_rems_api(url, headers, create_rems_client(session))
+
+    # REMS peculiarity: user not found == user found, but no permissions
+    # if result == []:
+    #     raise web.HTTPNotFound(text='Request was successful, but no records were found. '
+    #                                 'Either the user has no permissions, or the username was not found.')
+    return await client.get_json(url, headers, loads=decode_rems_response)
+
+
+async def iter_rems_api(url: str, headers: dict, client: RemsClient) -> AsyncIterator[Permission]:
+    """Send request for permissions, and yield them while the response body is received."""
+    LOG.debug("Send request for streamed permissions.")
+
+    async for permission in iter_json_array(client.iter_chunks(url, headers, 65536)):
+        yield Permission.from_rems(permission)
+
+
+def decode_rems_response(body: str) -> List[Permission]:
+    """Decode a REMS response body, keeping only the fields used for visas."""
+    with STAGE_DURATION.labels("json_decode").time():
+        return [Permission.from_rems(entitlement) for entitlement in CODEC.loads(body)]
 
 
 async def generate_jwt_timestamps() -> Tuple[int, int]:
@@ -118,57 +229,178 @@ async def create_ga4gh_passports(request: web.Request, username: str, visas: Lis
     """Create GA4GH Passports from GA4GH Visas."""
     LOG.debug("Crafting JWTs.")
 
+    passports = await create_ga4gh_passports_batch(request, {username: visas})
+    return passports[username]
+
+
+async def create_ga4gh_passports_batch(request: web.Request, visas_by_user: Dict[str, List[Visa]]) -> Dict[str, List[Passport]]:
+    """Create GA4GH Passports of several users, signing all of them together."""
+    LOG.debug("Crafting JWTs for %d users.", len(visas_by_user))
+
     # `jku` and `iss` used to be formed with:
     # f'{request.scheme}://{request.host}/jwks.json'
     # but in openshift containers the apps are http,
     # even though the ingress router is https.
     # Hard-coding these for a quick fix (proxy is temporary)
 
-    # Collect passports here
-    passports = []
-    header = {
-        "jku": f"https://{request.host}/jwks.json",
-        "kid": CONFIG.public_key["keys"][0]["kid"],
-        "alg": "RS256",
-        "typ": "JWT",
-    }
-
-    for visa in visas:
-
-        iat, exp = await generate_jwt_timestamps()
-
-        # Prepare the payload for JWT encoding
-        payload = {
-            "iss": f"https://{request.host}/",
-            "sub": username,
-            "ga4gh_visa_v1": visa,
-            "iat": iat,
-            "exp": exp,
-            "jti": str(uuid4()),
-        }
+    # Collect passports here, visas missing from the token cache are signed together in one batch
+    passports: Dict[str, List[Optional[Passport]]] = {}
+    unsigned = []
+    payloads = []
+    signer = request.app.get(SIGNER) or SYNCHRONOUS_SIGNER
+    # Taken once, so that the whole batch is signed with the same key even if the keys are reloaded meanwhile
+    key = KEY_RING.current.active
+    # Header with `jku`, `kid` and `alg`, encoded once per host
+    header = key.encoded_header(request.host)
+
+    for username, visas in visas_by_user.items():
+        user_passports = passports[username] = []
+
+        for visa in visas:
+            # Reuse a previously signed token of the same visa while it is still fresh enough
+            cache_key = (username, visa, request.host, key.kid)
+            cached_visa = TOKEN_CACHE.get(cache_key)
+            user_passports.append(cached_visa)
+            if cached_visa is not None:
+                continue
+
+            iat, exp = await generate_jwt_timestamps()
+
+            # Prepare the payload for JWT encoding
+            payload = {
+                "iss": f"https://{request.host}/",
+                "sub": username,
+                "ga4gh_visa_v1": visa.claim(),
+                "iat": iat,
+                "exp": exp,
+                "jti": str(uuid4()),
+            }
+            unsigned.append((user_passports, len(user_passports) - 1, cache_key))
+            payloads.append(payload)
+
+    # Encode permissions into JWTs, off the event loop when the app has a signing pool
+    with STAGE_DURATION.labels("signing").time():
+        encoded_visas = await signer.sign(key, header, payloads)
+    for (user_passports, index, cache_key), encoded_visa in zip(unsigned, encoded_visas):
+        user_passports[index] = Passport(encoded_visa)
+        TOKEN_CACHE.set(cache_key, Passport(encoded_visa))
+
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Signed %d JWTs, token cache: %s", len(payloads), TOKEN_CACHE.stats())
+    return cast(Dict[str, List[Passport]], passports)
+
+
+async def iter_ga4gh_passports(request: web.Request, username: str, visas: AsyncIterable[Visa]) -> AsyncIterator[Passport]:
+    """Create GA4GH Passports while the GA4GH Visas are received, signing them in batches."""
+    LOG.debug("Stream JWTs.")
+
+    batch = []
+    async for visa in visas:
+        batch.append(visa)
+        if len(batch) == CONFIG.stream_batch_size:
+            for passport in await create_ga4gh_passports(request, username, batch):
+                yield passport
+            batch = []
+    if batch:
+        for passport in await create_ga4gh_passports(request, username, batch):
+            yield passport
+
+
+def rems_request(username: str, api_key: str, resource: Optional[str] = None) -> Tuple[str, dict]:
+    """Return the REMS API url and headers for fetching permissions of a user, only of `resource` when given."""
+    rems_api = f"{CONFIG.rems_url}?user={username}"
+    if resource is not None:
+        rems_api += f"&resource={quote(resource, safe='')}"
+    headers = {"x-rems-api-key": api_key, "x-rems-user-id": username, "content-type": "application/json"}
+    return rems_api, headers
 
-        # Encode permissions into a JWT
-        encoded_visa = jwt.encode(header, payload, CONFIG.private_key).decode("utf-8")
-        passports.append(encoded_visa)
 
-    return passports
+def indexed_visas(request: web.Request, username: str, api_key: str) -> Optional[List[Visa]]:
+    """Return visas of a user from the synced entitlement index, or None when they must be fetched from REMS."""
+    sync = request.app.get(ENTITLEMENT_SYNC)
+    if sync is None or refresh_requested(request, username, api_key):
+        return None
+    found = sync.lookup(username, api_key)
+    SYNC_LOOKUPS.labels("miss" if found is None else "hit").inc()
+    if found is None:
+        return None
+    synced, visas = found
+    request["permissions_age"] = max(time.time() - synced, request.get("permissions_age", 0))
+    return list(visas)
 
 
-async def request_rems_permissions(request: web.Request, username: str, api_key: str) -> List[Passport]:
-    """Fetch dataset permissions from REMS."""
-    LOG.debug("Fetch dataset permissions from REMS.")
+async def fetch_rems_permissions(request: web.Request, username: str, api_key: str, resource: Optional[str] = None) -> List[Permission]:
+    """Fetch raw dataset permissions of a user from REMS, or from the cache.
 
+    With `resource`, REMS is only asked for the permissions of that resource, unless all permissions of the user are cached.
+    """
     # Items needed for REMS API call
-    rems_api = f"{CONFIG.rems_url}?user={username}"
-    headers = {"x-rems-api-key": api_key, "x-rems-user-id": username, "content-type": "application/json"}
+    rems_api, headers = rems_request(username, api_key, resource)
+
+    # Clients can force a fresh REMS lookup with `Cache-Control: no-cache`, up to the refresh rate of their api key
+    cache_key: Tuple[Hashable, ...] = (username, api_key_fingerprint(api_key))
+    refresh = refresh_requested(request, username, api_key)
+    snapshot = request.app.get(PERMISSIONS_SNAPSHOT)
+    if resource is not None:
+        cached = None if refresh else PERMISSIONS_CACHE.get(cache_key)
+        if cached is not None:
+            record_permissions_age(request, cache_key)
+            return cached
+        # Cached apart from all permissions of the user, and not shared through the snapshot
+        cache_key += (resource,)
+        snapshot = None
+    if refresh:
+        PERMISSIONS_CACHE.invalidate(lambda key: key == cache_key)
+
+    # Call the REMS API, request for permissions, concurrent requests for the same user share one call
+    fetch = partial(call_rems_api, url=rems_api, headers=headers, client=request.app.get(REMS_CLIENT))
+    try:
+        if snapshot is not None:
+            # Workers sharing a snapshot take permissions fetched by the others, and one of them calls REMS at a time.
+            # Permissions of the snapshot are cached as old as they are, so that they expire when the stored ones do.
+            permissions = await PERMISSIONS_CACHE.get_or_fetch_aged(cache_key, partial(snapshot_permissions, snapshot, cast(Key, cache_key), fetch, refresh))
+        else:
+            permissions = await PERMISSIONS_CACHE.get_or_fetch(cache_key, fetch)
+    except REMS_UNAVAILABLE:
+        stale = PERMISSIONS_CACHE.get_stale(cache_key)
+        if stale is None and snapshot is not None:
+            stored = snapshot.get(cache_key)
+            if stored is not None and time.time() - stored[0] < snapshot.ttl + snapshot.stale_ttl:
+                request["permissions_age"] = max(time.time() - stored[0], request.get("permissions_age", 0))
+                stale = stored[1]
+        if stale is None:
+            raise
+        LOG.warning("REMS is unavailable, serving expired permissions of %s.", username)
+        permissions = stale
+    record_permissions_age(request, cache_key)
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Permissions cache: %s", PERMISSIONS_CACHE.stats())
+        if REMS_CONNECTION_STATS in request.app:
+            stats = request.app[REMS_CONNECTION_STATS]
+            LOG.debug("REMS connections: %d created, %d reused.", stats["created"], stats["reused"])
+
+    return permissions
+
+
+async def request_rems_permissions(request: web.Request, username: str, api_key: str, permission_filter: Optional[PermissionFilter] = None) -> List[Passport]:
+    """Fetch dataset permissions from REMS, only those selected by `permission_filter` when given."""
+    LOG.debug("Fetch dataset permissions from REMS.")
 
-    # Call the REMS API, request for permissions
-    permissions = await call_rems_api(url=rems_api, headers=headers)
+    # Users in the synced index are answered without calling REMS
+    ga4gh_visas = indexed_visas(request, username, api_key)
+    if ga4gh_visas is None:
+        # REMS filters by resource itself, other filters are applied before visas are made and signed
+        permissions = await fetch_rems_permissions(request, username, api_key, permission_filter.resource if permission_filter else None)
+        if permission_filter is not None:
+            permissions = filter_permissions(permissions, permission_filter)
+        # Parse REMS records into GA4GH passport visas
+        ga4gh_visas = await create_ga4gh_visa_v1(permissions) if permissions else []
+    elif permission_filter is not None:
+        ga4gh_visas = filter_visas(ga4gh_visas, permission_filter)
+    VISAS_PER_USER.observe(len(ga4gh_visas))
 
     # Check if permissions were retrieved
-    if permissions:
-        # Parse REMS records into GA4GH passport visas
-        ga4gh_visas = await create_ga4gh_visa_v1(permissions)
+    if ga4gh_visas:
         # Craft JWT tokens "ga4gh passports" from each permission "visa"
         ga4gh_passports = await create_ga4gh_passports(request, username, ga4gh_visas)
         # Return JWTs
@@ -176,3 +408,87 @@ async def request_rems_permissions(request: web.Request, username: str, api_key:
     else:
         # Return empty list due to no permissions found
         return []
+
+
+async def request_rems_permissions_batch(request: web.Request, usernames: List[str], api_key: str) -> Dict[str, dict]:
+    """Fetch dataset permissions of several users from REMS concurrently, and sign them together.
+
+    Each user maps to either a GA4GH passport, or the error that REMS responded with for that user.
+    """
+    LOG.debug("Fetch dataset permissions of %d users from REMS.", len(usernames))
+
+    # Limit concurrent REMS calls of one batch
+    semaphore = asyncio.Semaphore(CONFIG.batch_concurrency)
+
+    async def fetch(username: str) -> List[Visa]:
+        visas = indexed_visas(request, username, api_key)
+        if visas is not None:
+            return visas
+        async with semaphore:
+            permissions = await fetch_rems_permissions(request, username, api_key)
+        return await create_ga4gh_visa_v1(permissions)
+
+    results = await asyncio.gather(*[fetch(username) for username in usernames], return_exceptions=True)
+
+    response: Dict[str, dict] = {}
+    visas_by_user = {}
+    for username, result in zip(usernames, results):
+        if isinstance(result, web.HTTPException):
+            response[username] = {"error": {"status": result.status, "message": result.text}}
+        elif isinstance(result, Exception):
+            LOG.error("Fetching permissions of %s failed: %r", username, result)
+            response[username] = {"error": {"status": 500, "message": "500 Internal Server Error"}}
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            VISAS_PER_USER.observe(len(result))
+            visas_by_user[username] = result
+
+    for username, passports in (await create_ga4gh_passports_batch(request, visas_by_user)).items():
+        response[username] = {"ga4gh_passport_v1": passports}
+
+    # Users in the order they were requested
+    return {username: response[username] for username in usernames}
+
+
+async def stream_rems_permissions(
+    request: web.Request, username: str, api_key: str, permission_filter: Optional[PermissionFilter] = None
+) -> AsyncGenerator[Passport, None]:
+    """Fetch dataset permissions from REMS, and yield passports while the REMS response is received.
+
+    Permissions are taken from the synced index or the cache when present, but streamed responses are not
+    added to the cache, so that the permissions of a user are never held in memory all at once.
+    """
+    LOG.debug("Stream dataset permissions from REMS.")
+
+    cached = None
+    cache_key = (username, api_key_fingerprint(api_key))
+    if not refresh_requested(request, username, api_key):
+        cached = PERMISSIONS_CACHE.get(cache_key)
+
+    indexed = indexed_visas(request, username, api_key)
+    permissions: AsyncIterable[Permission]
+    if indexed is not None:
+        visas = iter_cached(filter_visas(indexed, permission_filter) if permission_filter else indexed)
+    else:
+        if cached is not None:
+            record_permissions_age(request, cache_key)
+            permissions = iter_cached(cached)
+        else:
+            rems_api, headers = rems_request(username, api_key, permission_filter.resource if permission_filter else None)
+            permissions = iter_rems_api(url=rems_api, headers=headers, client=request.app[REMS_CLIENT])
+        if permission_filter is not None:
+            permissions = iter_filtered_permissions(permissions, permission_filter)
+        visas = iter_ga4gh_visa_v1(permissions)
+
+    count = 0
+    async for passport in iter_ga4gh_passports(request, username, visas):
+        count += 1
+        yield passport
+    VISAS_PER_USER.observe(count)
+
+
+async def iter_cached(items: Sequence[T]) -> AsyncIterator[T]:
+    """Yield cached permissions or visas."""
+    for item in items:
+        yield item
@@ -1,24 +1,86 @@
 """Web Server Middleware Components."""
 
-from typing import Callable
+import math
+import os
+import time
+import uuid
+
+from typing import Callable, Dict, NamedTuple
 
 from aiohttp import web
+from aiohttp.abc import AbstractRouter
+
+from ..config import CONFIG, LOG, REQUEST_ID
+from ..utils.metrics import REJECTED, REQUESTS, REQUESTS_IN_FLIGHT, REQUEST_DURATION
+from ..utils.profiling import profile_path, profiling_authorized
+from ..utils.ratelimit import InFlightLimit, TokenBuckets
+
+
+def request_id() -> Callable:
+    """Tag log records and the response with the request correlation ID."""
+    LOG.debug("Tag requests with a correlation ID.")
+
+    @web.middleware
+    async def request_id_middleware(request: web.Request, handler: Callable) -> Callable:
+        # Keep the ID of an upstream proxy, bounded as it ends up in every log record
+        request["request_id"] = request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex
+        token = REQUEST_ID.set(request["request_id"])
+        try:
+            return await handler(request)
+        finally:
+            REQUEST_ID.reset(token)
+
+    return request_id_middleware
+
+
+async def add_request_id_header(request: web.Request, response: web.StreamResponse) -> None:
+    """Echo the request correlation ID, also on streamed and error responses."""
+    if "request_id" in request:
+        response.headers["X-Request-ID"] = request["request_id"]
+
+
+async def add_age_header(request: web.Request, response: web.StreamResponse) -> None:
+    """Tell how old the permissions in a successful response are, when they were served from the cache."""
+    if "permissions_age" in request and response.status == 200:
+        response.headers["Age"] = str(int(request["permissions_age"]))
+
 
-from ..config import LOG
+async def add_profile_header(request: web.Request, response: web.StreamResponse) -> None:
+    """Tell the name of the file the profile of a profiled request is written to."""
+    if "profile" in request:
+        response.headers["X-Profile"] = os.path.basename(request["profile"])
 
 
-def api_key() -> Callable:
+class RoutePolicy(NamedTuple):
+    """Checks required by a route."""
+
+    api_key: bool = False
+    username: bool = False
+
+
+def route_policy(api_key: bool = False, username: bool = False) -> Callable[[Callable], Callable]:
+    """Declare the checks required by a route handler, routes without a policy are not checked."""
+
+    def decorator(handler: Callable) -> Callable:
+        handler.route_policy = RoutePolicy(api_key=api_key, username=username)  # type: ignore
+        return handler
+
+    return decorator
+
+
+def route_policies(router: AbstractRouter) -> Dict[web.AbstractRoute, RoutePolicy]:
+    """Resolve the policies of the registered routes, once the routes have been added."""
+    return {route: route.handler.route_policy for route in router.routes() if hasattr(route.handler, "route_policy")}  # type: ignore
+
+
+def api_key(policies: Dict[web.AbstractRoute, RoutePolicy]) -> Callable:
     """Check that user has supplied an api key."""
     LOG.debug("Check that user has supplied an api key.")
+    protected = {route for route, policy in policies.items() if policy.api_key}
 
     @web.middleware
     async def api_key_middleware(request: web.Request, handler: Callable) -> Callable:
-        if "/permissions" in request.path and "Permissions-Api-Key" in request.headers:
-            LOG.debug("In /permissions path with api key.")
-        elif "/permissions" not in request.path:
-            # At index '/' endpoint
-            LOG.debug("No API key authentication required at index endpoint")
-        else:
+        if request.match_info.route in protected and "Permissions-Api-Key" not in request.headers:
             LOG.debug('Missing "Permissions-Api-Key" from headers.')
             raise web.HTTPBadRequest(text="Missing mandatory headers: 'Permissions-Api-Key'")
 
@@ -28,20 +90,131 @@ def api_key() -> Callable:
     return api_key_middleware
 
 
-def username_in_path() -> Callable:
+def username_in_path(policies: Dict[web.AbstractRoute, RoutePolicy]) -> Callable:
     """Check that request contains username."""
     LOG.debug("Check that request contains username.")
+    protected = {route for route, policy in policies.items() if policy.username}
 
     @web.middleware
     async def username_in_path_middleware(request: web.Request, handler: Callable) -> Callable:
-        if request.path.startswith("/permissions"):
-            LOG.debug("Request to permissions endpoint, username must be supplied.")
-            if "username" not in request.match_info:
-                raise web.HTTPBadRequest(text="Username not provided.")
-        else:
-            LOG.debug("Username is not required at this endpoint.")
+        if request.match_info.route in protected and not request.match_info.get("username"):
+            raise web.HTTPBadRequest(text="Username not provided.")
 
         # Carry on with request if no exceptions were raised
         return await handler(request)
 
     return username_in_path_middleware
+
+
+# Key used to store the rate limit of the api key in the request, for handlers charging more than one token
+RATE_LIMIT = "rate_limit"
+
+
+def charge_rate_limit(request: web.Request, cost: float) -> None:
+    """Take `cost` tokens of the api key of the request, refuse it with 429 if the key does not have them."""
+    buckets = request.get(RATE_LIMIT)
+    if buckets is None or cost <= 0:
+        return
+    wait = buckets.take(request.headers["Permissions-Api-Key"], cost)
+    if wait:
+        REJECTED.labels("rate_limit").inc()
+        LOG.debug("Rate limit of the api key exceeded.")
+        raise web.HTTPTooManyRequests(text="429 Too Many Requests", headers={"Retry-After": str(math.ceil(wait))})
+
+
+def admission(policies: Dict[web.AbstractRoute, RoutePolicy]) -> Callable:
+    """Refuse requests over the rate limit of their api key with 429, and requests over the in-flight limit with 503.
+
+    Each request takes one token of its api key, handlers may charge more with `charge_rate_limit`.
+    """
+    LOG.debug("Limit requests by api key, and requests in flight.")
+    protected = {route for route, policy in policies.items() if policy.api_key}
+    buckets = TokenBuckets(CONFIG.rate_limit, CONFIG.rate_limit_burst, CONFIG.rate_limit_keys) if CONFIG.rate_limit > 0 else None
+    in_flight = InFlightLimit(CONFIG.max_in_flight)
+    retry_after = str(CONFIG.overload_retry_after)
+
+    @web.middleware
+    async def admission_middleware(request: web.Request, handler: Callable) -> Callable:
+        if request.match_info.route not in protected:
+            return await handler(request)
+
+        # Checked first, so that refused requests do not take the place of others in flight
+        if buckets is not None:
+            request[RATE_LIMIT] = buckets
+            charge_rate_limit(request, 1)
+
+        # Refused at once rather than queued, so that overload does not build up latency
+        if not in_flight.acquire():
+            REJECTED.labels("overload").inc()
+            LOG.debug("%d requests in flight, refusing more.", in_flight.in_flight)
+            raise web.HTTPServiceUnavailable(text="503 Service Unavailable", headers={"Retry-After": retry_after})
+        try:
+            return await handler(request)
+        finally:
+            in_flight.release()
+
+    return admission_middleware
+
+
+def profiling(policies: Dict[web.AbstractRoute, RoutePolicy]) -> Callable:
+    """Profile the handling of permissions requests presenting the profiling token, one request at a time.
+
+    The profile also covers other requests handled by the worker meanwhile, as they share its thread.
+    """
+    LOG.debug("Profile requests presenting the profiling token.")
+    protected = {route for route, policy in policies.items() if policy.api_key}
+    profiling_request = False
+
+    @web.middleware
+    async def profiling_middleware(request: web.Request, handler: Callable) -> Callable:
+        nonlocal profiling_request
+        authorized = profiling_authorized(request) if request.match_info.route in protected else None
+        if authorized is None:
+            return await handler(request)
+        if not authorized:
+            raise web.HTTPForbidden(text="Invalid profiling token.")
+        if profiling_request:
+            raise web.HTTPConflict(text="Another request is being profiled.")
+
+        import cProfile  # Only needed when a request is profiled
+
+        profiling_request = True
+        request["profile"] = profile_path()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return await handler(request)
+        finally:
+            profiler.disable()
+            profiling_request = False
+            profiler.dump_stats(request["profile"])
+            LOG.info("Profile of the request written to %s.", request["profile"])
+
+    return profiling_middleware
+
+
+def metrics() -> Callable:
+    """Record request counts, handling times and requests in flight."""
+    LOG.debug("Record request metrics.")
+
+    @web.middleware
+    async def metrics_middleware(request: web.Request, handler: Callable) -> Callable:
+        # Labelled by route, not path, to keep the number of series bounded
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        status = 500
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as error:
+            status = error.status
+            raise
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUESTS.labels(request.method, route, status).inc()
+            REQUEST_DURATION.labels(request.method, route).observe(time.perf_counter() - start)
+
+    return metrics_middleware
@@ -0,0 +1,150 @@
+"""In-process caches."""
+
+import asyncio
+import time
+
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """Size bounded least recently used cache with expiring entries.
+
+    Concurrent misses for the same key in `get_or_fetch` share a single fetch.
+    A cache with `maxsize` or `ttl` of zero stores nothing, but still coalesces concurrent fetches.
+    Expired entries are kept for `stale_ttl` more seconds for `get_stale`, unless evicted first.
+    With `revalidate`, `get_or_fetch` returns such entries at once, and fetches them again in the background.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0, revalidate: bool = False) -> None:
+        """Create an empty cache holding at most `maxsize` entries for `ttl` seconds each."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        # Expiry time, time stored, and value
+        self._entries: "OrderedDict[Hashable, Tuple[float, float, V]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        """Return number of stored entries, including expired ones not yet dropped."""
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Return a live entry and mark it recently used."""
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Optional[V]]:
+        """Return whether a live entry was found, and the entry."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires, _, value = entry
+        now = time.monotonic()
+        if expires <= now:
+            if expires + self.stale_ttl <= now:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def get_stale(self, key: Hashable) -> Optional[V]:
+        """Return an entry that has expired less than `stale_ttl` seconds ago, or a live one."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+            return None
+        return entry[2]
+
+    def age(self, key: Hashable) -> Optional[float]:
+        """Return seconds since an entry was stored, live or expired, or None if there is no entry."""
+        entry = self._entries.get(key)
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None, age: float = 0) -> None:
+        """Store an entry fetched `age` seconds ago, evicting the least recently used ones beyond `maxsize`."""
+        ttl = self.ttl if ttl is None else ttl
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        stored = time.monotonic() - age
+        self._entries[key] = (stored + ttl, stored, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, match: Callable[[Any], bool]) -> int:
+        """Drop all entries whose key satisfies `match`, return the number dropped.
+
+        Fetches of matching keys already in flight are not stored when they complete, fetches of other keys are.
+        """
+        keys = [key for key in self._entries if match(key)]
+        for key in keys:
+            del self._entries[key]
+        for key in [key for key in self._inflight if match(key)]:
+            del self._inflight[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        """Drop all entries."""
+        self.invalidate(lambda key: True)
+
+    def stats(self) -> Dict[str, int]:
+        """Return cache counters."""
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "coalesced": self.coalesced}
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[V]]) -> V:
+        """Return a cached entry, or await `fetch` once for all concurrent callers of the same key."""
+        return await self.get_or_fetch_aged(key, partial(fetched_now, fetch))
+
+    async def get_or_fetch_aged(self, key: Hashable, fetch: Callable[[], Awaitable[Tuple[float, V]]]) -> V:
+        """Return a cached entry, or await `fetch` once for all concurrent callers of the same key.
+
+        `fetch` returns the value with its age, when it was fetched earlier elsewhere, and it is stored as that old.
+        """
+        found, cached = self._lookup(key)
+        if found:
+            return cached  # type: ignore
+
+        stale = self.get_stale(key) if self.revalidate else None
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            task.add_done_callback(partial(self._fetched, key))
+            self._inflight[key] = task
+        elif stale is None:
+            self.coalesced += 1
+        if stale is not None:
+            # The fetch completes in the background, its errors are dropped in `_fetched`
+            return stale
+
+        # Shielded, so that one cancelled caller does not cancel the fetch for the others
+        _, value = await asyncio.shield(task)
+        return value
+
+    def _fetched(self, key: Hashable, task: asyncio.Future) -> None:
+        """Store a completed fetch, unless its key was invalidated meanwhile."""
+        # Invalidated fetches are no longer in flight, or replaced by a newer one
+        current = self._inflight.get(key) is task
+        if current:
+            del self._inflight[key]
+        # Errors are raised to the callers awaiting the fetch, and are never cached
+        if task.cancelled() or task.exception() is not None or not current:
+            return
+        age, value = task.result()
+        self.set(key, value, age=age)
+
+
+async def fetched_now(fetch: Callable[[], Awaitable[V]]) -> Tuple[float, V]:
+    """Await `fetch`, and return its result as fetched zero seconds ago."""
+    return 0.0, await fetch()
@@ -0,0 +1,291 @@
+"""Shared HTTP client for REMS API calls.
+
+Calls are made with connect and read timeouts, a limit on concurrent calls, and retries with jittered
+exponential backoff when REMS cannot be reached or is temporarily unavailable. A circuit breaker fails
+calls fast while REMS keeps failing, and lets a trial call through now and then to notice its recovery.
+"""
+
+import asyncio
+import math
+import random
+import time
+
+from types import SimpleNamespace
+from typing import AsyncIterator, Callable, Dict, Optional, TypeVar
+
+import aiohttp
+
+from aiohttp import web
+
+from ..config import CONFIG, LOG
+from .metrics import REMS_DURATION, REMS_FAILURES
+
+T = TypeVar("T")
+
+# Keys used to store the client in the application
+REMS_SESSION = "rems_session"
+REMS_CLIENT = "rems_client"
+REMS_CONNECTION_STATS = "rems_connection_stats"
+
+# Responses of a REMS instance that is restarting or overloaded, worth retrying
+RETRY_STATUSES = (502, 503, 504)
+
+# Errors raised when REMS could not give an answer, as opposed to REMS refusing the request
+REMS_UNAVAILABLE = (web.HTTPBadGateway, web.HTTPServiceUnavailable, web.HTTPGatewayTimeout)
+
+
+class RetryableStatus(Exception):
+    """REMS responded with a status that is worth retrying."""
+
+    def __init__(self, status: int) -> None:
+        """Record the response status."""
+        super().__init__(status)
+        self.status = status
+
+
+# Failures of a single attempt that a retry may fix
+RETRYABLE_ERRORS = (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, RetryableStatus)
+
+
+def check_rems_response(response: aiohttp.ClientResponse) -> None:
+    """Raise the error matching an unsuccessful REMS response."""
+    if response.status == 200:
+        return
+
+    LOG.error("%d: REMS request %s failed.", response.status, response.url)
+    if response.status == 400:
+        raise web.HTTPBadRequest(text="400 Bad Request")
+    elif response.status == 401:
+        raise web.HTTPUnauthorized(text="401 Unauthorized")
+    elif response.status == 403:
+        raise web.HTTPForbidden(text="403 Forbidden")
+    elif response.status == 404:
+        raise web.HTTPNotFound(text="404 Not Found")
+    elif response.status in (429, 503):
+        raise web.HTTPServiceUnavailable(text="503 Service Unavailable")
+    elif response.status == 504:
+        raise web.HTTPGatewayTimeout(text="504 Gateway Timeout")
+    else:
+        raise web.HTTPBadGateway(text="502 Bad Gateway")
+
+
+def unavailable_error(error: Exception) -> web.HTTPException:
+    """Return the error for a call that failed after all of its attempts."""
+    if isinstance(error, asyncio.TimeoutError):
+        return web.HTTPGatewayTimeout(text="504 Gateway Timeout")
+    if isinstance(error, RetryableStatus):
+        return {503: web.HTTPServiceUnavailable(text="503 Service Unavailable"), 504: web.HTTPGatewayTimeout(text="504 Gateway Timeout")}.get(
+            error.status, web.HTTPBadGateway(text="502 Bad Gateway")
+        )
+    return web.HTTPBadGateway(text="502 Bad Gateway")
+
+
+class CircuitBreaker:
+    """Fail fast after `threshold` consecutive failures, until a trial call succeeds.
+
+    The circuit opens on the last failure, and lets one trial call through once `reset_timeout` has passed.
+    A trial that never reports back, e.g. a cancelled call, is replaced by another after `reset_timeout`.
+    A `threshold` of zero never opens the circuit.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float) -> None:
+        """Create a closed circuit."""
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        """Return `closed`, `open` or `half-open`."""
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def retry_after(self) -> float:
+        """Return the seconds after which a call may be let through."""
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Return whether a call may be made now."""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        if self.trial_at is not None and now - self.trial_at < self.reset_timeout:
+            return False
+        self.trial_at = now
+        return True
+
+    def success(self) -> None:
+        """Close the circuit after a successful call."""
+        if self.opened_at is not None:
+            LOG.info("REMS has recovered, closing the circuit.")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def failure(self) -> None:
+        """Count a failed call, and open the circuit on too many of them."""
+        self.failures += 1
+        self.trial_at = None
+        if self.threshold > 0 and (self.opened_at is not None or self.failures >= self.threshold):
+            if self.opened_at is None:
+                LOG.error("REMS failed %d times in a row, opening the circuit for %ss.", self.failures, self.reset_timeout)
+            self.opened_at = time.monotonic()
+
+
+class RemsClient:
+    """REMS API calls with retries, a concurrency limit and a circuit breaker, over a shared session."""
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        retries: int = 2,
+        backoff: float = 0.1,
+        max_backoff: float = 2.0,
+        concurrency: int = 100,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        """Make calls with `session`, the session timeouts apply to each attempt."""
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = breaker or CircuitBreaker(0, 0)
+
+    def check_circuit(self) -> None:
+        """Fail fast while the circuit is open."""
+        if not self.breaker.allow():
+            REMS_FAILURES.labels("circuit_open").inc()
+            raise web.HTTPServiceUnavailable(text="503 Service Unavailable", headers={"Retry-After": str(math.ceil(self.breaker.retry_after()) or 1)})
+
+    def check_response(self, response: aiohttp.ClientResponse, start: float) -> None:
+        """Record the response, and raise the error of an unsuccessful one."""
+        REMS_DURATION.labels(response.status).observe(time.perf_counter() - start)
+        if response.status in RETRY_STATUSES:
+            raise RetryableStatus(response.status)
+        if response.status >= 500:
+            self.breaker.failure()
+        else:
+            # REMS is up, even if it refused the request
+            self.breaker.success()
+        check_rems_response(response)
+
+    async def failed(self, error: Exception, attempt: int) -> None:
+        """Record a failed attempt, and wait before the next one, or raise if it was the last."""
+        reason = "timeout" if isinstance(error, asyncio.TimeoutError) else "status" if isinstance(error, RetryableStatus) else "connection"
+        REMS_FAILURES.labels(reason).inc()
+        self.breaker.failure()
+        if attempt >= self.retries:
+            LOG.error("REMS request failed after %d attempts: %r", attempt + 1, error)
+            raise unavailable_error(error) from error
+        # Full jitter, so that callers failing together do not retry together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        LOG.warning("REMS request failed: %r, retrying in %.3fs.", error, delay)
+        await asyncio.sleep(delay)
+
+    async def get_json(self, url: str, headers: Dict[str, str], loads: Callable[[str], T]) -> T:
+        """GET a JSON response, decoded with `loads`."""
+        attempt = 0
+        while True:
+            self.check_circuit()
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()
+                    async with self.session.get(url, headers=headers) as response:
+                        self.check_response(response, start)
+                        return await response.json(loads=loads)
+            except RETRYABLE_ERRORS as error:
+                await self.failed(error, attempt)
+            attempt += 1
+
+    async def iter_chunks(self, url: str, headers: Dict[str, str], size: int) -> AsyncIterator[bytes]:
+        """GET a response, and yield its body in chunks while it is received.
+
+        Only failures before the first chunk are retried, as the caller may already have used the earlier chunks.
+        """
+        attempt = 0
+        while True:
+            self.check_circuit()
+            received = False
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()
+                    async with self.session.get(url, headers=headers) as response:
+                        self.check_response(response, start)
+                        async for chunk in response.content.iter_chunked(size):
+                            received = True
+                            yield chunk
+                        return
+            except RETRYABLE_ERRORS as error:
+                if received:
+                    REMS_FAILURES.labels("connection").inc()
+                    self.breaker.failure()
+                    raise unavailable_error(error) from error
+                await self.failed(error, attempt)
+            attempt += 1
+
+
+def rems_timeout() -> aiohttp.ClientTimeout:
+    """Return the timeouts of each REMS call attempt."""
+    return aiohttp.ClientTimeout(total=None, connect=CONFIG.rems_connect_timeout, sock_read=CONFIG.rems_read_timeout)
+
+
+def create_rems_client(session: aiohttp.ClientSession) -> RemsClient:
+    """Create a REMS client with the configured retries, concurrency limit and circuit breaker."""
+    return RemsClient(
+        session,
+        retries=CONFIG.rems_retries,
+        backoff=CONFIG.rems_retry_backoff,
+        concurrency=CONFIG.rems_max_concurrency,
+        breaker=CircuitBreaker(CONFIG.rems_breaker_threshold, CONFIG.rems_breaker_reset_timeout),
+    )
+
+
+def rems_trace_config(stats: dict) -> aiohttp.TraceConfig:
+    """Count new and reused REMS connections into `stats`."""
+
+    async def on_connection_create_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionCreateEndParams) -> None:
+        stats["created"] += 1
+
+    async def on_connection_reuseconn(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionReuseconnParams) -> None:
+        stats["reused"] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+async def init_rems_session(app: web.Application) -> None:
+    """Create the app-lifetime REMS client session on startup."""
+    LOG.info(
+        "Opening REMS client session: pool size %d, per host limit %d, keep-alive %ss, DNS cache %ss.",
+        CONFIG.rems_connection_limit,
+        CONFIG.rems_connection_limit_per_host,
+        CONFIG.rems_keepalive_timeout,
+        CONFIG.rems_dns_cache_ttl,
+    )
+    stats = {"created": 0, "reused": 0}
+    connector = aiohttp.TCPConnector(
+        limit=CONFIG.rems_connection_limit,
+        limit_per_host=CONFIG.rems_connection_limit_per_host,
+        keepalive_timeout=CONFIG.rems_keepalive_timeout,
+        ttl_dns_cache=CONFIG.rems_dns_cache_ttl,
+    )
+    app[REMS_CONNECTION_STATS] = stats
+    app[REMS_SESSION] = aiohttp.ClientSession(connector=connector, timeout=rems_timeout(), trace_configs=[rems_trace_config(stats)])
+    app[REMS_CLIENT] = create_rems_client(app[REMS_SESSION])
+
+
+async def close_rems_session(app: web.Application) -> None:
+    """Close the REMS client session on cleanup."""
+    stats = app[REMS_CONNECTION_STATS]
+    LOG.info("Closing REMS client session: %d connections created, %d reused.", stats["created"], stats["reused"])
+    await app[REMS_SESSION].close()
@@ -0,0 +1,59 @@
+"""JSON encoding and decoding, with orjson when it is installed.
+
+Both backends encode to compact UTF-8 bytes, so that they produce the same documents.
+Tuples, such as permissions and visas, are encoded as arrays.
+"""
+
+import json
+
+from typing import Any, Callable, Dict, NamedTuple, Union
+
+from ..config import CONFIG, LOG
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+class Codec(NamedTuple):
+    """JSON functions of a backend."""
+
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Union[str, bytes]], Any]
+
+
+def stdlib_dumps(document: object) -> bytes:
+    """Encode a document to compact UTF-8 JSON with the standard library."""
+    return json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def orjson_default(value: object) -> list:
+    """Encode tuple subclasses, which orjson does not encode itself."""
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def orjson_dumps(document: object) -> bytes:
+    """Encode a document to compact UTF-8 JSON with orjson."""
+    return orjson.dumps(document, default=orjson_default)
+
+
+CODECS: Dict[str, Codec] = {"json": Codec("json", stdlib_dumps, json.loads)}
+if orjson is not None:
+    CODECS["orjson"] = Codec("orjson", orjson_dumps, orjson.loads)
+
+
+def select_codec(backend: str) -> Codec:
+    """Return the codec of `backend`, `auto` for the fastest one installed."""
+    if backend == "auto":
+        return CODECS.get("orjson", CODECS["json"])
+    if backend not in CODECS:
+        raise ValueError(f"JSON backend {backend!r} is not installed, choose one of: auto, {', '.join(CODECS)}.")
+    return CODECS[backend]
+
+
+CODEC = select_codec(CONFIG.json_backend)
+LOG.debug("Using the %s JSON backend.", CODEC.name)
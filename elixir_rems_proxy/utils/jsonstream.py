@@ -0,0 +1,58 @@
+"""Incremental JSON parsing."""
+
+import codecs
+import json
+
+from typing import Any, AsyncIterable, AsyncIterator
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+async def iter_json_array(chunks: AsyncIterable[bytes]) -> AsyncIterator[Any]:
+    """Yield the items of a JSON array of objects while its body is still being received.
+
+    Only the current item is buffered, so the whole array never has to be held in memory.
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    # Expecting "[" first, then an item or "]", then "," or "]" after each item, and an item after ","
+    state = "start"
+
+    async for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise ValueError(f"Expected a JSON array, got {char!r}.")
+                state = "item"
+                position += 1
+            elif state == "separator":
+                if char not in ",]":
+                    raise ValueError(f"Expected ',' or ']' between array items, got {char!r}.")
+                state = "next" if char == "," else "end"
+                position += 1
+            elif state == "item" and char == "]":
+                state = "end"
+                position += 1
+            elif state in ("item", "next"):
+                try:
+                    item, position = _DECODER.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # The item continues in the next chunk
+                    break
+                state = "separator"
+                yield item
+            else:
+                raise ValueError(f"Unexpected data after the JSON array: {char!r}.")
+        buffer = buffer[position:]
+
+    buffer += utf8.decode(b"", final=True)
+    if state != "end" or buffer.strip(_WHITESPACE):
+        raise ValueError("Incomplete JSON array.")
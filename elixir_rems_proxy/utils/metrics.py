@@ -0,0 +1,40 @@
+"""Prometheus metrics.
+
+With several gunicorn workers, set `PROMETHEUS_MULTIPROC_DIR` (`prometheus_multiproc_dir` in older
+client versions) to an empty directory shared by the workers, so that `/metrics` aggregates all of them.
+"""
+
+import os
+
+from typing import Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Buckets for fast in-process stages, in seconds
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter("elixir_rems_proxy_requests_total", "HTTP requests handled.", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("elixir_rems_proxy_requests_in_flight", "HTTP requests being handled.", multiprocess_mode="livesum")
+REQUEST_DURATION = Histogram("elixir_rems_proxy_request_duration_seconds", "HTTP request handling time.", ["method", "route"])
+REJECTED = Counter("elixir_rems_proxy_rejected_requests_total", "Requests refused by admission control.", ["reason"])
+REMS_DURATION = Histogram("elixir_rems_proxy_rems_request_duration_seconds", "REMS API round-trip time until response headers.", ["status"])
+REMS_FAILURES = Counter("elixir_rems_proxy_rems_failures_total", "Failed REMS request attempts, and calls refused by the open circuit.", ["reason"])
+STAGE_DURATION = Histogram("elixir_rems_proxy_stage_duration_seconds", "Time spent in each stage of a permissions request.", ["stage"], buckets=STAGE_BUCKETS)
+VISAS_PER_USER = Histogram("elixir_rems_proxy_visas_per_user", "Number of visas in a passport.", buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+SYNC_DURATION = Histogram(
+    "elixir_rems_proxy_sync_duration_seconds", "Time to sync all REMS entitlements.", buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+)
+SYNC_INDEX = Gauge("elixir_rems_proxy_sync_index", "Users, entitlements and approximate bytes of the synced index.", ["measure"], multiprocess_mode="max")
+SYNC_MEMORY = Gauge("elixir_rems_proxy_sync_memory_bytes", "Approximate bytes of the synced index held by each worker.", multiprocess_mode="liveall")
+SYNC_LAST_SUCCESS = Gauge("elixir_rems_proxy_sync_last_success_timestamp_seconds", "Time of the last successful sync.", multiprocess_mode="max")
+SYNC_LOOKUPS = Counter("elixir_rems_proxy_sync_lookups_total", "Permissions requests answered from the synced index, or by REMS.", ["result"])
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Return metrics in the Prometheus text format, and their content type."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ or "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
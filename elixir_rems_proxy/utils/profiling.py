@@ -0,0 +1,84 @@
+"""On-demand profiling of single requests, and sampling of the worker's stacks.
+
+Nothing here runs unless a profiling token is configured and a request presents it.
+"""
+
+import collections
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from types import FrameType
+from typing import Counter, Optional
+
+from aiohttp import web
+
+from ..config import CONFIG
+
+# Header presenting the profiling token
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+
+
+def profiling_authorized(request: web.Request) -> Optional[bool]:
+    """Return None when the request does not ask for profiling, otherwise whether it presents the configured token."""
+    supplied = request.headers.get(PROFILE_TOKEN_HEADER)
+    if supplied is None:
+        return None
+    return bool(CONFIG.profiling_token) and hmac.compare_digest(supplied.encode("utf-8"), CONFIG.profiling_token.encode("utf-8"))
+
+
+def profile_path() -> str:
+    """Return a new file path for a request profile, named independently of the request so that clients cannot choose it."""
+    directory = CONFIG.profile_dir or tempfile.gettempdir()
+    return os.path.join(directory, f"profile-{int(time.time())}-{uuid.uuid4().hex[:8]}.prof")
+
+
+def frame_name(frame: FrameType) -> str:
+    """Return the `file:function` name of a stack frame."""
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """Count the stacks of a thread, sampled every `interval` seconds from another thread.
+
+    Stacks are kept in the folded format of flame graph tools: frames from the outermost, separated by `;`.
+    The sampled thread is not slowed down, apart from the sampling thread taking the GIL.
+    """
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        """Sample the thread of `thread_id`."""
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter[str] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self) -> None:
+        """Sample until stopped."""
+        while not self._stop.wait(self.interval):
+            frame: Optional[FrameType] = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self) -> None:
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling, and wait for the sampling thread to finish."""
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        """Return the sampled stacks with their counts, the most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
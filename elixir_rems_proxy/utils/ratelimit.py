@@ -0,0 +1,68 @@
+"""Admission control: per api key rate limits, and a bound on requests in flight."""
+
+import hashlib
+import time
+
+from collections import OrderedDict
+from typing import Tuple
+
+
+class TokenBuckets:
+    """Token buckets of at most `maxsize` callers, refilled with `rate` tokens per second up to `burst`.
+
+    Callers are keyed on a 16 byte digest of their api key, so that the keys are not kept in memory and each bucket
+    takes the same space. The least recently seen caller is dropped when full, and starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int) -> None:
+        """Create empty buckets."""
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxsize = maxsize
+        # Tokens left, and when they were counted
+        self._buckets: "OrderedDict[bytes, Tuple[float, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Return number of callers with a bucket."""
+        return len(self._buckets)
+
+    @staticmethod
+    def digest(api_key: str) -> bytes:
+        """Return the bucket key of an api key."""
+        return hashlib.blake2b(api_key.encode("utf-8"), digest_size=16).digest()
+
+    def take(self, api_key: str, cost: float = 1) -> float:
+        """Take `cost` tokens of the caller, return 0 if it had them, otherwise seconds until it has them."""
+        now = time.monotonic()
+        key = self.digest(api_key)
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class InFlightLimit:
+    """Count of requests being handled, admitting at most `limit` of them (0 for no limit)."""
+
+    def __init__(self, limit: int) -> None:
+        """Create an empty count."""
+        self.limit = limit
+        self.in_flight = 0
+
+    def acquire(self) -> bool:
+        """Count a request in, return False without counting it when the limit is reached."""
+        if self.limit and self.in_flight >= self.limit:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        """Count a request out."""
+        self.in_flight -= 1
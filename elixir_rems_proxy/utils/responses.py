@@ -0,0 +1,109 @@
+"""Precomputed responses for static and rarely changing documents."""
+
+import gzip
+import hashlib
+import io
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+from .codec import CODEC
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 256
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+
+
+def json_response(document: object) -> web.Response:
+    """Return a JSON response encoded with the configured JSON backend."""
+    return web.Response(body=CODEC.dumps(document), headers={"Content-Type": JSON_CONTENT_TYPE})
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Return whether an Accept-Encoding header allows gzip."""
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzip_deterministic(body: bytes) -> bytes:
+    """Return `body` gzipped with a zero modification time, so that it compresses to the same bytes every time."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as compressed:
+        compressed.write(body)
+    return buffer.getvalue()
+
+
+class StaticBody:
+    """Response body encoded once, with a strong ETag and a pre-compressed gzip variant."""
+
+    def __init__(self, body: bytes, content_type: str, cache_control: str) -> None:
+        """Precompute the variants of `body`."""
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.body = body
+        self.etag = f'"{digest}"'
+        self.gzip_body: Optional[bytes] = None
+        self.gzip_etag = f'"{digest}-gzip"'
+        if len(body) >= GZIP_MIN_SIZE:
+            compressed = gzip_deterministic(body)
+            if len(compressed) < len(body):
+                self.gzip_body = compressed
+        self.headers = {"Content-Type": content_type, "Cache-Control": cache_control}
+        if self.gzip_body is not None:
+            self.headers["Vary"] = "Accept-Encoding"
+
+    def response(self, request: web.Request) -> web.Response:
+        """Return the body, gzipped if accepted, or 304 Not Modified if the client has it."""
+        if self.gzip_body is not None and accepts_gzip(request.headers.get("Accept-Encoding", "")):
+            body, etag, headers = self.gzip_body, self.gzip_etag, dict(self.headers, **{"Content-Encoding": "gzip"})
+        else:
+            body, etag, headers = self.body, self.etag, dict(self.headers)
+        headers["ETag"] = etag
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            # Weak comparison, as for GET and HEAD
+            if "*" in tags or etag in tags or f"W/{etag}" in tags:
+                del headers["Content-Type"]
+                headers.pop("Content-Encoding", None)
+                return web.Response(status=304, headers=headers)
+
+        return web.Response(body=body, headers=headers)
+
+
+class JSONBody:
+    """StaticBody of a JSON document, rebuilt when the document returned by `load` is another object.
+
+    Documents must be replaced, not modified in place, for the change to be noticed.
+    """
+
+    def __init__(self, load: Callable[[], Any], cache_control: str) -> None:
+        """Serve the document returned by `load`."""
+        self.load = load
+        self.cache_control = cache_control
+        self._document: Any = None
+        self._body: Optional[StaticBody] = None
+
+    def get(self) -> StaticBody:
+        """Return the body of the current document."""
+        document = self.load()
+        if self._body is None or document is not self._document:
+            self._body = StaticBody(CODEC.dumps(document), JSON_CONTENT_TYPE, self.cache_control)
+            self._document = document
+        return self._body
+
+    def response(self, request: web.Request) -> web.Response:
+        """Return the response of the current document."""
+        return self.get().response(request)
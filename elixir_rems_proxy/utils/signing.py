@@ -0,0 +1,143 @@
+"""JWT signing backends."""
+
+import asyncio
+import math
+import signal
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from ..config import CONFIG, LOG
+from ..config.keys import KEY_RING, SigningKey
+
+# Key used to store the signer in the application
+SIGNER = "signer"
+# Key used to store the key file watcher task in the application
+KEY_WATCHER = "key_watcher"
+
+# Signing keys of a pool worker by key id, each deserialized once per worker
+_WORKER_KEYS: Dict[str, SigningKey] = {}
+# Bounds the keys kept by a worker over many rotations
+_WORKER_KEYS_MAX = 8
+
+
+def sign_jwts(header: bytes, payloads: List[dict], key: SigningKey) -> List[str]:
+    """Sign JWT payloads with the same encoded header and key."""
+    return [key.sign(header, payload) for payload in payloads]
+
+
+def load_worker_key(jwk: dict, kid: str, alg: str) -> SigningKey:
+    """Load a signing key into a pool worker, unless the worker already has it."""
+    key = _WORKER_KEYS.get(kid)
+    if key is None or key.jwk != jwk:
+        if len(_WORKER_KEYS) >= _WORKER_KEYS_MAX:
+            _WORKER_KEYS.clear()
+        key = _WORKER_KEYS[kid] = SigningKey(jwk, kid, alg)
+    return key
+
+
+def sign_jwts_in_worker(header: bytes, payloads: List[dict], jwk: dict, kid: str, alg: str) -> List[str]:
+    """Sign JWT payloads in a pool worker, with the key deserialized by the worker."""
+    return sign_jwts(header, payloads, load_worker_key(jwk, kid, alg))
+
+
+class Signer:
+    """Sign batches of JWTs in an executor, or synchronously when there is none.
+
+    A batch is split evenly between the executor workers, so that a large passport is signed in parallel.
+    Process pool workers receive the key as a JWK, and deserialize it once.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, workers: int = 0) -> None:
+        """Create a signer using `workers` of `executor`."""
+        self.executor = executor
+        self.workers = workers
+
+    async def sign(self, key: SigningKey, header: bytes, payloads: List[dict]) -> List[str]:
+        """Sign JWT payloads with `key` without blocking the event loop, tokens are returned in payload order."""
+        if self.executor is None or not payloads:
+            return sign_jwts(header, payloads, key)
+
+        loop = asyncio.get_event_loop()
+        size = math.ceil(len(payloads) / self.workers)
+        jobs = []
+        for start in range(0, len(payloads), size):
+            stop = start + size
+            if isinstance(self.executor, ProcessPoolExecutor):
+                job = loop.run_in_executor(self.executor, sign_jwts_in_worker, header, payloads[start:stop], key.jwk, key.kid, key.alg)
+            else:
+                job = loop.run_in_executor(self.executor, sign_jwts, header, payloads[start:stop], key)
+            jobs.append(job)
+        batches = await asyncio.gather(*jobs)
+        return [token for batch in batches for token in batch]
+
+    def close(self) -> None:
+        """Shut down the executor."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def create_signer(key: SigningKey, executor: str, workers: int) -> Signer:
+    """Create a signer with a `process` or `thread` pool of `workers`, or a synchronous one with no workers.
+
+    Process pool workers are sent a job each loading `key`, so that it is usually loaded before the first request.
+    Keys are loaded on first use anyway, the `initializer` of the pool is not available on Python 3.6.
+    """
+    if workers <= 0:
+        return Signer()
+    if executor == "process":
+        pool: Executor = ProcessPoolExecutor(max_workers=workers)
+        for _ in range(workers):
+            pool.submit(load_worker_key, key.jwk, key.kid, key.alg)
+    elif executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="signer")
+    else:
+        raise ValueError(f"Unknown signing executor {executor}, expected 'process' or 'thread'.")
+    return Signer(pool, workers)
+
+
+async def init_signer(app: web.Application) -> None:
+    """Start the signing pool on startup."""
+    LOG.info("Starting JWT signer: %d %s workers.", CONFIG.signing_workers, CONFIG.signing_executor)
+    app[SIGNER] = create_signer(KEY_RING.current.active, CONFIG.signing_executor, CONFIG.signing_workers)
+
+
+async def close_signer(app: web.Application) -> None:
+    """Shut down the signing pool on cleanup."""
+    LOG.info("Shutting down JWT signer.")
+    app[SIGNER].close()
+
+
+async def watch_key_files(interval: float) -> None:
+    """Reload the signing keys when the key files are modified."""
+    while True:
+        await asyncio.sleep(interval)
+        KEY_RING.reload_if_modified()
+
+
+async def init_key_reload(app: web.Application) -> None:
+    """Reload the signing keys on SIGHUP, and when the key files are modified.
+
+    Key files modified since they were loaded are reloaded first: workers forked from a preloading gunicorn master
+    start with the keys loaded by the master, possibly long before they start.
+    """
+    KEY_RING.reload_if_modified()
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, KEY_RING.reload)
+    except (NotImplementedError, RuntimeError):
+        # Not available on Windows, nor outside the main thread
+        LOG.warning("Signing keys are not reloaded on SIGHUP.")
+    if CONFIG.key_reload_interval > 0:
+        app[KEY_WATCHER] = asyncio.ensure_future(watch_key_files(CONFIG.key_reload_interval))
+
+
+async def close_key_reload(app: web.Application) -> None:
+    """Stop reloading the signing keys on cleanup."""
+    try:
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+    except (NotImplementedError, RuntimeError):
+        pass
+    if KEY_WATCHER in app:
+        app[KEY_WATCHER].cancel()
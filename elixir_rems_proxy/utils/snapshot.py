@@ -0,0 +1,308 @@
+"""Permissions snapshot shared by the workers of a node.
+
+REMS permissions are stored in an SQLite file, so that a worker that has just started answers from the permissions
+fetched by the others, instead of calling REMS for every user. Before calling REMS for a user, a worker takes a
+lease on the user, and the other workers wait for it to store the permissions instead of calling REMS too.
+The entitlement index of all users is stored here too, by the one worker that syncs it, and read by all of them.
+SQLite calls are made on the event loop, so they wait at most `busy_timeout` for another worker writing the file.
+A snapshot that stays locked longer is read as missing the permissions, and a lease that cannot be taken as held by
+another worker, so that REMS answers instead of the event loop freezing.
+"""
+
+import asyncio
+import itertools
+import os
+import sqlite3
+import time
+import uuid
+
+from functools import partial
+from typing import Awaitable, Callable, List, Mapping, Optional, Sequence, Tuple, TypeVar
+
+from aiohttp import web
+
+from ..config import CONFIG, LOG
+from .codec import CODEC
+from .types import Permission, Visa
+
+# Key used to store the snapshot in the application
+PERMISSIONS_SNAPSHOT = "permissions_snapshot"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS permissions (
+    username TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    fetched REAL NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (username, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    username TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (username, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS entitlement_syncs (
+    generation INTEGER PRIMARY KEY AUTOINCREMENT,
+    synced REAL
+);
+CREATE TABLE IF NOT EXISTS entitlements (
+    generation INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    visas TEXT NOT NULL,
+    PRIMARY KEY (generation, username)
+);
+"""
+
+# Rows of the entitlement index written or deleted in one transaction, so that other workers wait for the lock only briefly
+ENTITLEMENT_BATCH = 1000
+
+# Attempts to take the lock for writing the entitlement index, `poll_interval` apart
+WRITE_ATTEMPTS = 100
+
+# Seconds between prunes of the snapshot by a worker storing permissions
+PRUNE_INTERVAL = 300
+
+# Permissions are keyed on (username, api key fingerprint), as in the in-process cache
+Key = Tuple[str, bytes]
+
+T = TypeVar("T")
+
+
+class PermissionSnapshot:
+    """Permissions of users stored in an SQLite file, refreshed by one worker at a time.
+
+    Permissions are fresh for `ttl` seconds, and rows older than `ttl + stale_ttl` are pruned every `PRUNE_INTERVAL` seconds.
+    A lease expires after `lease` seconds, in case its worker stopped without releasing it.
+    """
+
+    def __init__(self, path: str, ttl: float, stale_ttl: float = 0, lease: float = 10, poll_interval: float = 0.05, busy_timeout: float = 0.005) -> None:
+        """Open the snapshot file, creating it readable by the owner only."""
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.waits = 0
+        # Pruned on startup by init_permissions_snapshot, and then as permissions are stored
+        self._pruned = time.time()
+        # Autocommit, transactions are started explicitly. Workers starting together wait longer for each other to set up the file.
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        os.chmod(path, 0o600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+
+    def close(self) -> None:
+        """Close the snapshot file."""
+        self._db.close()
+
+    def get(self, key: Key) -> Optional[Tuple[float, List[Permission]]]:
+        """Return when the permissions of `key` were fetched, and the permissions, or None."""
+        try:
+            row = self._db.execute("SELECT fetched, body FROM permissions WHERE username = ? AND fingerprint = ?", key).fetchone()
+        except sqlite3.OperationalError as error:
+            LOG.debug("Permissions snapshot not read: %s", error)
+            return None
+        if row is None:
+            return None
+        # Stored as JSON arrays of the permission fields
+        return row[0], [Permission(*fields) for fields in CODEC.loads(row[1])]
+
+    def put(self, key: Key, value: List[Permission]) -> float:
+        """Store the permissions of `key`, fetched now, return when they were fetched."""
+        fetched = time.time()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO permissions VALUES (?, ?, ?, ?)", (*key, fetched, CODEC.dumps(value).decode("utf-8")))
+        except sqlite3.OperationalError as error:
+            LOG.debug("Permissions snapshot not written: %s", error)
+        if fetched - self._pruned >= PRUNE_INTERVAL:
+            self.prune()
+        return fetched
+
+    def acquire(self, key: Key, lease: Optional[float] = None) -> bool:
+        """Take the lease on `key` for `lease` seconds, return whether it was free or expired, and False if the snapshot stayed locked."""
+        lease = self.lease if lease is None else lease
+        now = time.time()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as error:
+            LOG.debug("Permissions lease not taken: %s", error)
+            return False
+        try:
+            self._db.execute("DELETE FROM leases WHERE username = ? AND fingerprint = ? AND expires <= ?", (*key, now))
+            cursor = self._db.execute("INSERT OR IGNORE INTO leases VALUES (?, ?, ?, ?)", (*key, self.owner, now + lease))
+            self._db.execute("COMMIT")
+        except sqlite3.OperationalError as error:
+            self._db.execute("ROLLBACK")
+            LOG.debug("Permissions lease not taken: %s", error)
+            return False
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def renew(self, key: Key, lease: Optional[float] = None) -> bool:
+        """Extend the lease on `key` by `lease` seconds from now, return whether this snapshot still holds it."""
+        lease = self.lease if lease is None else lease
+        try:
+            cursor = self._db.execute(
+                "UPDATE leases SET expires = ? WHERE username = ? AND fingerprint = ? AND owner = ?", (time.time() + lease, *key, self.owner)
+            )
+        except sqlite3.OperationalError as error:
+            LOG.debug("Permissions lease not renewed: %s", error)
+            return False
+        return cursor.rowcount == 1
+
+    def leased(self, key: Key) -> bool:
+        """Return whether some worker holds an unexpired lease on `key`, or may hold it while the snapshot is locked."""
+        try:
+            row = self._db.execute("SELECT 1 FROM leases WHERE username = ? AND fingerprint = ? AND expires > ?", (*key, time.time())).fetchone()
+        except sqlite3.OperationalError as error:
+            LOG.debug("Permissions lease not read: %s", error)
+            return True
+        return row is not None
+
+    def release(self, key: Key) -> None:
+        """Give up the lease on `key`, if this snapshot holds it, otherwise it is left to expire."""
+        try:
+            self._db.execute("DELETE FROM leases WHERE username = ? AND fingerprint = ? AND owner = ?", (*key, self.owner))
+        except sqlite3.OperationalError as error:
+            LOG.warning("Permissions lease not released, it expires in %ss: %s", self.lease, error)
+
+    def entitlements(self, username: str) -> Optional[Tuple[float, Optional[List[Visa]]]]:
+        """Return when the latest entitlement index was synced, and the visas of a user in it, or None if there is no index."""
+        query = (
+            "SELECT synced, visas FROM entitlement_syncs LEFT JOIN entitlements "
+            "ON entitlements.generation = entitlement_syncs.generation AND username = ? "
+            "WHERE synced IS NOT NULL ORDER BY entitlement_syncs.generation DESC LIMIT 1"
+        )
+        try:
+            row = self._db.execute(query, (username,)).fetchone()
+        except sqlite3.OperationalError as error:
+            LOG.debug("Entitlement index not read: %s", error)
+            return None
+        if row is None:
+            return None
+        return row[0], None if row[1] is None else [Visa(*fields) for fields in CODEC.loads(row[1])]
+
+    def entitlements_synced(self) -> float:
+        """Return when the latest entitlement index was synced, 0 if there is none or it cannot be read."""
+        try:
+            row = self._db.execute("SELECT max(synced) FROM entitlement_syncs").fetchone()
+        except sqlite3.OperationalError as error:
+            LOG.debug("Entitlement index not read: %s", error)
+            return 0
+        return row[0] or 0
+
+    async def store_entitlements(self, users: Mapping[str, Sequence[Visa]], synced: float) -> None:
+        """Store the visas of all users from a sync, and replace the previous entitlement index with it.
+
+        Users are written in batches, letting the event loop run in between, and the new index is read once complete.
+        Each sync writes a generation of its own, reserved as a pending sync, so that syncs never write over each other.
+        """
+        generation = await self._write(lambda: self._db.execute("INSERT INTO entitlement_syncs (synced) VALUES (NULL)").lastrowid)
+        items = iter(users.items())
+        while True:
+            rows = [(generation, user, CODEC.dumps(visas).decode("utf-8")) for user, visas in itertools.islice(items, ENTITLEMENT_BATCH)]
+            if not rows:
+                break
+            await self._write(partial(self._db.executemany, "INSERT INTO entitlements VALUES (?, ?, ?)", rows))
+        published = await self._write(lambda: self._db.execute("UPDATE entitlement_syncs SET synced = ? WHERE generation = ?", (synced, generation)).rowcount)
+        # A newer sync completed meanwhile and removed this one, its entitlements are removed with the older ones below
+        condition = "generation < ?" if published else "generation <= ?"
+        # Older syncs, also those that stopped before completing
+        await self._write(partial(self._db.execute, f"DELETE FROM entitlement_syncs WHERE {condition}", (generation,)))
+        statement = f"DELETE FROM entitlements WHERE rowid IN (SELECT rowid FROM entitlements WHERE {condition} LIMIT {ENTITLEMENT_BATCH})"
+        while await self._write(lambda: self._db.execute(statement, (generation,)).rowcount) == ENTITLEMENT_BATCH:
+            pass
+
+    async def _write(self, write: Callable[[], T]) -> T:
+        """Call `write` in a transaction, waiting while another worker writes, and return its result."""
+        for _ in range(WRITE_ATTEMPTS):
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            try:
+                result = write()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            # Let the other coroutines run between batches
+            await asyncio.sleep(0)
+            return result
+        raise sqlite3.OperationalError("Entitlement index not written, the snapshot stayed locked.")
+
+    def invalidate(self, username: str) -> int:
+        """Drop stored permissions of a user, return the number of rows dropped."""
+        return self._db.execute("DELETE FROM permissions WHERE username = ?", (username,)).rowcount
+
+    def prune(self) -> int:
+        """Drop permissions too old to be served, and expired leases, return the number of permissions dropped."""
+        now = self._pruned = time.time()
+        try:
+            self._db.execute("DELETE FROM leases WHERE expires <= ?", (now,))
+            return self._db.execute("DELETE FROM permissions WHERE fetched <= ?", (now - self.ttl - self.stale_ttl,)).rowcount
+        except sqlite3.OperationalError as error:
+            # Another worker is pruning
+            LOG.debug("Permissions snapshot not pruned: %s", error)
+            return 0
+
+    async def get_or_fetch(self, key: Key, fetch: Callable[[], Awaitable[List[Permission]]], refresh: bool = False) -> Tuple[float, List[Permission]]:
+        """Return fresh stored permissions, or await `fetch` in the one worker holding the lease on `key`, with when they were fetched.
+
+        With `refresh`, stored permissions are not used. Workers not holding the lease wait for the stored permissions,
+        and call `fetch` themselves if the lease is released or expires without any.
+        """
+        # Permissions fetched since then are good enough
+        fresh_since = time.time() if refresh else time.time() - self.ttl
+        if not refresh:
+            stored = self.get(key)
+            if stored is not None and stored[0] > fresh_since:
+                return stored
+
+        if self.acquire(key):
+            try:
+                value = await fetch()
+                return self.put(key, value), value
+            finally:
+                self.release(key)
+
+        self.waits += 1
+        while True:
+            stored = self.get(key)
+            if stored is not None and stored[0] > fresh_since:
+                return stored
+            if not self.leased(key):
+                break
+            await asyncio.sleep(self.poll_interval)
+        LOG.debug("Permissions lease released without permissions stored, fetching them.")
+        value = await fetch()
+        return time.time(), value
+
+
+def create_permissions_snapshot() -> Optional[PermissionSnapshot]:
+    """Open the configured snapshot file, unless the snapshot or caching is disabled."""
+    if not CONFIG.permissions_snapshot_file or CONFIG.permissions_cache_ttl <= 0:
+        return None
+    return PermissionSnapshot(CONFIG.permissions_snapshot_file, CONFIG.permissions_cache_ttl, CONFIG.permissions_stale_ttl, CONFIG.permissions_snapshot_lease)
+
+
+async def init_permissions_snapshot(app: web.Application) -> None:
+    """Open the snapshot in each worker, as SQLite connections must not be shared with forked processes."""
+    snapshot = app[PERMISSIONS_SNAPSHOT] = create_permissions_snapshot()
+    if snapshot is not None:
+        LOG.info("Using permissions snapshot %s, pruned %d expired users.", snapshot.path, snapshot.prune())
+
+
+async def close_permissions_snapshot(app: web.Application) -> None:
+    """Close the snapshot."""
+    snapshot = app.get(PERMISSIONS_SNAPSHOT)
+    if snapshot is not None:
+        snapshot.close()
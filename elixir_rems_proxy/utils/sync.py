@@ -0,0 +1,205 @@
+"""Background sync of all REMS entitlements into an index of visas by user.
+
+REMS checks the api key of each permissions request, so the index is only used to answer requests made with
+the api key that the sync itself uses. Other requests, and users not in the index, are answered by REMS.
+Without a permissions snapshot, each worker syncs and keeps an index of its own in memory. With one, a single
+worker at a time syncs and stores the index in the snapshot, where all workers look users up.
+"""
+
+import asyncio
+import hmac
+import sys
+import time
+
+from typing import AsyncIterable, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from ..config import CONFIG, LOG
+from .client import REMS_CLIENT, RemsClient
+from .jsonstream import iter_json_array
+from .metrics import SYNC_DURATION, SYNC_INDEX, SYNC_LAST_SUCCESS, SYNC_MEMORY
+from .snapshot import PERMISSIONS_SNAPSHOT, Key, PermissionSnapshot
+from .types import Permission, Visa
+
+# Keys used to store the sync and its task in the application
+ENTITLEMENT_SYNC = "entitlement_sync"
+ENTITLEMENT_SYNC_TASK = "entitlement_sync_task"
+
+# The index is not used once this many syncs in a row have failed
+MAX_MISSED_SYNCS = 3
+
+# Lease of the worker syncing into the snapshot, apart from the leases on users
+SYNC_LEASE: Key = ("", b"entitlement-sync")
+# Seconds the sync lease is held for, renewed while syncing however long a sync takes
+SYNC_LEASE_SECONDS = 60.0
+
+
+class EntitlementIndex(NamedTuple):
+    """Visas of each user, built from one complete sync and never modified."""
+
+    users: Dict[str, Tuple[Visa, ...]]
+    synced: float
+    entitlements: int
+    size: int
+
+
+def entitlement_user(entitlement: dict) -> Optional[str]:
+    """Return the user id of a REMS entitlement, given as a string or as a user object."""
+    user = entitlement.get("user")
+    if isinstance(user, dict):
+        user = user.get("userid")
+    return user if isinstance(user, str) else None
+
+
+async def build_index(entitlements: AsyncIterable[dict], to_visa: Callable[[Permission], Visa]) -> EntitlementIndex:
+    """Build an index from REMS entitlements, while they are received.
+
+    Users with the same resource and start date share one visa, and visa values are interned.
+    """
+    visas: Dict[Permission, Visa] = {}
+    users: Dict[str, List[Visa]] = {}
+    count = 0
+    async for entitlement in entitlements:
+        user = entitlement_user(entitlement)
+        if user is None:
+            continue
+        permission = Permission.from_rems(entitlement)
+        visa = visas.get(permission)
+        if visa is None:
+            visa = to_visa(permission)
+            visa = visas[permission] = Visa(sys.intern(visa.value), visa.asserted)
+        users.setdefault(user, []).append(visa)
+        count += 1
+
+    index = {sys.intern(user): tuple(user_visas) for user, user_visas in users.items()}
+    # Shallow sizes of the containers, the visas and their distinct values
+    size = sys.getsizeof(index) + sum(sys.getsizeof(user) + sys.getsizeof(user_visas) for user, user_visas in index.items())
+    size += sum(sys.getsizeof(visa) for visa in visas.values()) + sum(sys.getsizeof(value) for value in {visa.value for visa in visas.values()})
+    return EntitlementIndex(index, time.time(), count, size)
+
+
+class EntitlementSync:
+    """Index of all REMS entitlements, replaced by a new one on each successful sync.
+
+    With a `snapshot`, the index is stored there instead of in `index`, by whichever worker syncs first once it is
+    older than `interval`.
+    """
+
+    def __init__(
+        self,
+        client: RemsClient,
+        url: str,
+        api_key: str,
+        user_id: str,
+        interval: float,
+        to_visa: Callable[[Permission], Visa],
+        snapshot: Optional[PermissionSnapshot] = None,
+    ) -> None:
+        """Sync from the entitlements `url` every `interval` seconds, as the REMS user allowed to list all entitlements."""
+        self.client = client
+        self.url = url
+        self.api_key = api_key
+        self.headers = {"x-rems-api-key": api_key, "x-rems-user-id": user_id, "content-type": "application/json"}
+        self.interval = interval
+        self.to_visa = to_visa
+        self.snapshot = snapshot
+        self.index: Optional[EntitlementIndex] = None
+
+    def age(self) -> float:
+        """Return seconds since the index was built."""
+        if self.snapshot is not None:
+            synced = self.snapshot.entitlements_synced()
+            return time.time() - synced if synced else float("inf")
+        return time.time() - self.index.synced if self.index is not None else float("inf")
+
+    def lookup(self, username: str, api_key: str) -> Optional[Tuple[float, Sequence[Visa]]]:
+        """Return when the index was built and the visas of a user in it, or None if the index cannot answer the request."""
+        if not hmac.compare_digest(api_key.encode("utf-8"), self.api_key.encode("utf-8")):
+            return None
+        found: Optional[Tuple[float, Optional[Sequence[Visa]]]]
+        if self.snapshot is not None:
+            found = self.snapshot.entitlements(username)
+        else:
+            index = self.index
+            found = None if index is None else (index.synced, index.users.get(username))
+        if found is None:
+            return None
+        synced, visas = found
+        if visas is None or time.time() - synced > self.interval * MAX_MISSED_SYNCS:
+            return None
+        return synced, visas
+
+    async def sync(self) -> Optional[EntitlementIndex]:
+        """Build a new index from all REMS entitlements, and replace the current one with it.
+
+        With a snapshot, return None without syncing while another worker syncs, or has synced less than `interval` ago.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return await self._sync()
+        if time.time() - snapshot.entitlements_synced() < self.interval or not snapshot.acquire(SYNC_LEASE, lease=SYNC_LEASE_SECONDS):
+            return None
+        renewal = asyncio.ensure_future(self._renew_lease(snapshot))
+        try:
+            return await self._sync()
+        finally:
+            renewal.cancel()
+            snapshot.release(SYNC_LEASE)
+
+    @staticmethod
+    async def _renew_lease(snapshot: PermissionSnapshot) -> None:
+        """Renew the sync lease well before it expires, until cancelled."""
+        while True:
+            await asyncio.sleep(SYNC_LEASE_SECONDS / 3)
+            if not snapshot.renew(SYNC_LEASE, lease=SYNC_LEASE_SECONDS):
+                LOG.warning("Entitlement sync lease not renewed, another worker may sync meanwhile.")
+
+    async def _sync(self) -> EntitlementIndex:
+        """Build a new index, and keep it in memory or store it in the snapshot."""
+        start = time.perf_counter()
+        entitlements = iter_json_array(self.client.iter_chunks(self.url, self.headers, 65536))
+        index = await build_index(entitlements, self.to_visa)
+        if self.snapshot is not None:
+            await self.snapshot.store_entitlements(index.users, index.synced)
+        else:
+            self.index = index
+        duration = time.perf_counter() - start
+
+        SYNC_DURATION.observe(duration)
+        SYNC_LAST_SUCCESS.set(index.synced)
+        SYNC_INDEX.labels("users").set(len(index.users))
+        SYNC_INDEX.labels("entitlements").set(index.entitlements)
+        SYNC_INDEX.labels("bytes").set(index.size)
+        # Only held by this worker until stored in the snapshot
+        SYNC_MEMORY.set(index.size if self.snapshot is None else 0)
+        LOG.info("Synced %d entitlements of %d users in %.1fs, index of about %.1f MB.", index.entitlements, len(index.users), duration, index.size / 1e6)
+        return index
+
+    async def run(self) -> None:
+        """Sync every `interval` seconds, keeping the current index when a sync fails."""
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                LOG.error("Syncing REMS entitlements failed, keeping the index of %.0fs ago: %r", self.age(), error)
+            await asyncio.sleep(self.interval)
+
+
+async def init_entitlement_sync(app: web.Application, to_visa: Callable[[Permission], Visa]) -> None:
+    """Start syncing entitlements on startup, after the REMS client and snapshot, when a sync interval and api key are configured."""
+    if CONFIG.rems_sync_interval <= 0 or not CONFIG.rems_sync_api_key:
+        return
+    LOG.info("Syncing REMS entitlements every %ss.", CONFIG.rems_sync_interval)
+    sync = app[ENTITLEMENT_SYNC] = EntitlementSync(
+        app[REMS_CLIENT], CONFIG.rems_url, CONFIG.rems_sync_api_key, CONFIG.rems_sync_user_id, CONFIG.rems_sync_interval, to_visa, app.get(PERMISSIONS_SNAPSHOT)
+    )
+    app[ENTITLEMENT_SYNC_TASK] = asyncio.ensure_future(sync.run())
+
+
+async def close_entitlement_sync(app: web.Application) -> None:
+    """Stop syncing entitlements on cleanup."""
+    if ENTITLEMENT_SYNC_TASK in app:
+        app[ENTITLEMENT_SYNC_TASK].cancel()
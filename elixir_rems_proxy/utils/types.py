@@ -1,8 +1,50 @@
-from typing import Dict, NewType, Union, NamedTuple
+from typing import Dict, NewType, Optional, Union, NamedTuple
 
 Passport = NewType("Passport", str)  # an encoded list of visas
-Permission = NewType("Permission", dict)
-Visa = NewType("Visa", Dict[str, Union[str, int, None]])
+
+# Fields shared by all visas
+VISA_TYPE = "ControlledAccessGrants"
+VISA_SOURCE = "https://ga4gh.org/duri/no_org"
+VISA_BY = "dac"
+
+
+class Permission(NamedTuple):
+    """The fields of a REMS entitlement that visas are made of."""
+
+    resource: Optional[str]
+    start: Optional[str]
+
+    @staticmethod
+    def from_rems(entitlement: dict) -> "Permission":
+        """Extract a permission from a decoded REMS entitlement."""
+        return Permission(entitlement.get("resource"), entitlement.get("start"))
+
+
+class Visa(NamedTuple):
+    """A GA4GH ControlledAccessGrants visa, without the fields shared by all visas."""
+
+    value: str
+    asserted: Optional[int]
+
+    def claim(self) -> Dict[str, Union[str, int, None]]:
+        """Return the `ga4gh_visa_v1` claim of the visa."""
+        return {"type": VISA_TYPE, "value": self.value, "source": VISA_SOURCE, "by": VISA_BY, "asserted": self.asserted}
+
+
+class PermissionFilter(NamedTuple):
+    """Permissions requested by a client, all of them when no field is set."""
+
+    resource: Optional[str] = None
+    prefix: Optional[str] = None
+    since: Optional[int] = None
+
+    def selects(self, resource: Optional[str], asserted: Optional[int]) -> bool:
+        """Return whether the permission of `resource`, granted at `asserted`, was requested."""
+        if self.resource is not None and resource != self.resource:
+            return False
+        if self.prefix is not None and not (resource or "").startswith(self.prefix):
+            return False
+        return self.since is None or (asserted is not None and asserted > self.since)
 
 
 class Config(NamedTuple):
@@ -15,3 +57,46 @@ class Config(NamedTuple):
     private_key: dict
     host: str = "0.0.0.0"
     port: Union[int, str] = 8080
+    stream_permissions: bool = False
+    stream_batch_size: int = 100
+    jwks_max_age: int = 300
+    json_backend: str = "auto"
+    rems_connection_limit: int = 100
+    rems_connection_limit_per_host: int = 0
+    rems_keepalive_timeout: float = 15.0
+    rems_dns_cache_ttl: int = 10
+    rems_connect_timeout: float = 5.0
+    rems_read_timeout: float = 30.0
+    rems_retries: int = 2
+    rems_retry_backoff: float = 0.1
+    rems_max_concurrency: int = 100
+    rems_breaker_threshold: int = 5
+    rems_breaker_reset_timeout: float = 30.0
+    rems_sync_interval: float = 0.0
+    rems_sync_api_key: str = ""
+    rems_sync_user_id: str = ""
+    batch_max_users: int = 500
+    batch_concurrency: int = 10
+    rate_limit: float = 0.0
+    rate_limit_burst: float = 20.0
+    rate_limit_keys: int = 10000
+    max_in_flight: int = 1000
+    overload_retry_after: int = 1
+    profiling_token: str = ""
+    profile_dir: str = ""
+    profile_max_seconds: float = 60.0
+    permissions_cache_size: int = 1024
+    permissions_cache_ttl: float = 30.0
+    permissions_stale_ttl: float = 0.0
+    permissions_snapshot_file: str = ""
+    permissions_snapshot_lease: float = 10.0
+    permissions_revalidate: bool = False
+    permissions_refresh_rate: float = 1.0
+    permissions_refresh_burst: float = 10.0
+    jwt_cache_size: int = 10000
+    jwt_reuse_threshold: float = 0.5
+    signing_executor: str = "process"
+    signing_workers: int = 2
+    jwk_public_key_file: str = ""
+    jwk_private_key_file: str = ""
+    key_reload_interval: float = 60.0
@@ -22,7 +22,7 @@ setup(
         "elixir_rems_proxy/utils",
     ],
     package_data={"": ["*.ini", "*.json"]},
-    install_requires=["aiohttp", "authlib", "cryptography", "uvloop", "gunicorn"],
-    extras_require={"test": ["asynctest", "pytest<5.4", "pytest-cov", "coverage==4.5.4", "coveralls", "testfixtures", "tox"]},
+    install_requires=["aiocontextvars; python_version < '3.7'", "aiohttp", "authlib", "cryptography", "prometheus-client", "uvloop", "gunicorn"],
+    extras_require={"orjson": ["orjson"], "test": ["asynctest", "pytest<5.4", "pytest-cov", "coverage==4.5.4", "coveralls", "testfixtures", "tox"]},
     entry_points={"console_scripts": ["start_elixir_rems_proxy=elixir_rems_proxy.app:main"]},
 )
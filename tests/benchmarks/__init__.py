@@ -0,0 +1,27 @@
+"""Benchmarks.
+
+Run a benchmark with ``python -m tests.benchmarks.<name>`` in the same environment as the unit tests.
+"""
+
+import math
+
+from typing import Dict, List
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return the nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Summarize latencies in seconds as milliseconds."""
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
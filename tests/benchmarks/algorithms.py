@@ -0,0 +1,48 @@
+"""Signing throughput and passport size of a large passport per signature algorithm.
+
+python -m tests.benchmarks.algorithms --visas 500
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+
+from elixir_rems_proxy.config.jwks import ALGORITHMS, generate_jwks
+from elixir_rems_proxy.config.keys import load_key_set
+
+from .signing_cost import payload
+
+
+def run(alg: str, visas: int) -> dict:
+    """Sign a passport of `visas` visas with a new key of `alg`."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        public_key, private_key = generate_jwks(alg)
+    key = load_key_set(private_key, public_key).active
+    payloads = [payload(n) for n in range(visas)]
+
+    header = key.encoded_header("dummyhost")
+    start = time.perf_counter()
+    tokens = [key.sign(header, claims) for claims in payloads]
+    elapsed = time.perf_counter() - start
+
+    passport = json.dumps({"ga4gh_passport_v1": tokens}).encode("utf-8")
+    return {
+        "tokens_per_second": round(visas / elapsed),
+        "passport_ms": round(elapsed * 1000, 3),
+        "passport_bytes": len(passport),
+        "signature_bytes": len(tokens[0].rsplit(".", 1)[1]),
+    }
+
+
+def main() -> None:
+    """Run the benchmark for each algorithm and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--visas", type=int, default=500, help="visas per passport")
+    args = parser.parse_args()
+    print(json.dumps({alg: run(alg, args.visas) for alg in ALGORITHMS}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
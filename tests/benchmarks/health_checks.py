@@ -0,0 +1,66 @@
+"""Throughput and latency of the health check endpoints through the middleware chain.
+
+python -m tests.benchmarks.health_checks --requests 5000 --clients 10
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from typing import Awaitable, Callable
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from elixir_rems_proxy.app import init_app, routes
+
+from . import summarize
+
+
+async def bare_app() -> web.Application:
+    """Return the app routes without middlewares, as a baseline."""
+    app = web.Application()
+    app.router.add_routes(routes)
+    return app
+
+
+async def run(factory: Callable[[], Awaitable[web.Application]], path: str, requests: int, clients: int) -> dict:
+    """Request `path` of the app from `factory` `requests` times with `clients` concurrent clients."""
+    latencies = []
+    client = TestClient(TestServer(await factory()))
+    await client.start_server()
+
+    async def repeat(count: int) -> None:
+        for _ in range(count):
+            start = time.perf_counter()
+            async with client.get(path) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*[repeat(requests // clients) for _ in range(clients)])
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.close()
+    return dict(summarize(latencies), requests_per_second=round(len(latencies) / elapsed))
+
+
+def main() -> None:
+    """Run the benchmark with and without middlewares and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per endpoint")
+    parser.add_argument("--clients", type=int, default=10, help="concurrent clients")
+    args = parser.parse_args()
+
+    results: dict = {}
+    for name, factory in (("app", init_app), ("bare", bare_app)):
+        results[name] = {}
+        for path in ("/", "/jwks.json"):
+            results[name][path] = asyncio.run(run(factory, path, args.requests, args.clients))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Throughput of each installed JSON backend on REMS responses, passports and JWT payloads.
+
+python -m tests.benchmarks.json_codec --entitlements 100000 --visas 10000
+"""
+
+import argparse
+import json
+import time
+
+from typing import Any, Callable
+from uuid import uuid4
+
+from elixir_rems_proxy.utils.codec import CODECS, Codec
+from elixir_rems_proxy.utils.types import Visa
+
+from .visa_model import rems_body
+
+
+def payload(n: int) -> dict:
+    """Return a visa JWT payload."""
+    visa = Visa(f"https://www.ebi.ac.uk/ega/EGAD{n:011d}", 1577880000)
+    return {"iss": "https://dummyhost/", "sub": "user", "ga4gh_visa_v1": visa.claim(), "iat": 1577880000, "exp": 1577883600, "jti": str(uuid4())}
+
+
+def timed(function: Callable[[], Any], repeat: int = 3) -> float:
+    """Return the fastest of `repeat` runs of `function`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(codec: Codec, body: bytes, passport: dict, payloads: list) -> dict:
+    """Time decoding the REMS response, and encoding the passport and each JWT payload, with `codec`."""
+    decode = timed(lambda: codec.loads(body))
+    encode = timed(lambda: codec.dumps(passport))
+    payload_encode = timed(lambda: [codec.dumps(payload) for payload in payloads])
+    return {
+        "rems_decode_mb_per_s": round(len(body) / decode / 1e6, 1),
+        "passport_encode_mb_per_s": round(len(codec.dumps(passport)) / encode / 1e6, 1),
+        "jwt_payloads_per_s": round(len(payloads) / payload_encode),
+    }
+
+
+def main() -> None:
+    """Compare the installed backends, print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entitlements", type=int, default=100000, help="entitlements in the REMS response")
+    parser.add_argument("--visas", type=int, default=10000, help="visas in the passport, and JWT payloads encoded")
+    args = parser.parse_args()
+    body = rems_body(args.entitlements).encode("utf-8")
+    # Tokens of a typical RS256 visa length
+    passport = {"ga4gh_passport_v1": [f"{'h' * 100}.{'p' * 300}.{'s' * 342}" for _ in range(args.visas)]}
+    payloads = [payload(n) for n in range(args.visas)]
+    print(json.dumps({name: run(codec, body, passport, payloads) for name, codec in CODECS.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Throughput and latency of `/permissions/{username}` against a local fake REMS.
+
+python -m tests.benchmarks.load --entitlements 100 --clients 20 --duration 10 --output load.json
+python -m tests.benchmarks.load --baseline load.json  # on another commit, reports the changes
+
+The app built by `init_app` is served in-process and driven by concurrent clients, each requesting
+passports of users picked at random from `--users`, with REMS answering after `--rems-latency` seconds.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+
+from collections import Counter
+from functools import partial
+from typing import Dict, Optional, Tuple
+
+from unittest.mock import patch
+
+from aiohttp.test_utils import TestClient, TestServer
+from prometheus_client import REGISTRY
+
+from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.utils.cache import LRUCache
+from elixir_rems_proxy.utils.codec import CODEC
+
+from . import summarize
+from ..fake_rems import FakeRems, entitlements
+
+
+def histogram_totals(name: str, label: str) -> Dict[str, Tuple[float, float]]:
+    """Return the sum and count of a histogram by the value of `label`."""
+    totals: Dict[str, Tuple[float, float]] = {}
+    for metric in REGISTRY.collect():
+        if metric.name != name:
+            continue
+        for sample in metric.samples:
+            value = sample.labels.get(label, "")
+            total, count = totals.get(value, (0.0, 0.0))
+            if sample.name == f"{name}_sum":
+                totals[value] = (total + sample.value, count)
+            elif sample.name == f"{name}_count":
+                totals[value] = (total, count + sample.value)
+    return totals
+
+
+def mean_ms(before: Dict[str, Tuple[float, float]], after: Dict[str, Tuple[float, float]]) -> Dict[str, float]:
+    """Return the mean of each histogram label between two totals, in milliseconds."""
+    means = {}
+    for value, (total, count) in sorted(after.items()):
+        total -= before.get(value, (0.0, 0.0))[0]
+        count -= before.get(value, (0.0, 0.0))[1]
+        if count:
+            means[value] = round(total / count * 1000, 3)
+    return means
+
+
+def commit() -> Optional[str]:
+    """Return the checked out commit, if running in a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Serve the app against a fake REMS, and drive it with concurrent clients for the warmup and the measured duration."""
+    rems = FakeRems(permissions=partial(entitlements, count=args.entitlements), delay=args.rems_latency, error_rate=args.error_rate)
+    rems_server = TestServer(rems.app)
+    await rems_server.start_server()
+    latencies = []
+    statuses: Counter = Counter()
+
+    async def client_loop(client: TestClient, until: float, measured: bool) -> None:
+        while time.perf_counter() < until:
+            path = f"/permissions/user{random.randrange(args.users)}"
+            start = time.perf_counter()
+            async with client.get(path, headers={"Permissions-Api-Key": "key"}) as response:
+                await response.read()
+            if measured:
+                latencies.append(time.perf_counter() - start)
+                statuses[str(response.status)] += 1
+
+    async def drive(client: TestClient, duration: float, measured: bool) -> None:
+        until = time.perf_counter() + duration
+        await asyncio.gather(*[client_loop(client, until, measured) for _ in range(args.clients)])
+
+    config = CONFIG._replace(
+        rems_url=str(rems_server.make_url("/api/entitlements")),
+        signing_executor=args.executor,
+        signing_workers=args.workers,
+        stream_permissions=args.stream,
+    )
+    with patch("elixir_rems_proxy.endpoints.permissions.CONFIG", config), patch("elixir_rems_proxy.utils.signing.CONFIG", config), patch(
+        "elixir_rems_proxy.app.CONFIG", config
+    ), patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(CONFIG.permissions_cache_size, args.cache_ttl)):
+        client = TestClient(TestServer(await init_app()))
+        await client.start_server()
+        try:
+            await drive(client, args.warmup, measured=False)
+            rems_calls = rems.calls
+            stages = histogram_totals("elixir_rems_proxy_stage_duration_seconds", "stage")
+            rems_durations = histogram_totals("elixir_rems_proxy_rems_request_duration_seconds", "status")
+            start = time.perf_counter()
+            await drive(client, args.duration, measured=True)
+            elapsed = time.perf_counter() - start
+        finally:
+            await client.close()
+            await rems_server.close()
+
+    return {
+        "commit": commit(),
+        "config": dict({key: value for key, value in vars(args).items() if key not in ("output", "baseline")}, json_backend=CODEC.name),
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency": summarize(latencies),
+        "statuses": dict(statuses),
+        "rems_calls": rems.calls - rems_calls,
+        "rems_mean_ms": mean_ms(rems_durations, histogram_totals("elixir_rems_proxy_rems_request_duration_seconds", "status")),
+        "stage_mean_ms": mean_ms(stages, histogram_totals("elixir_rems_proxy_stage_duration_seconds", "stage")),
+    }
+
+
+def compare(results: dict, baseline: dict) -> Dict[str, float]:
+    """Return the relative change of throughput and latency percentiles from `baseline`, in percent."""
+    changes = {}
+    pairs = [("throughput_rps", results["throughput_rps"], baseline["throughput_rps"])]
+    pairs += [(key, results["latency"][key], baseline["latency"][key]) for key in ("p50_ms", "p95_ms", "p99_ms") if key in baseline["latency"]]
+    for key, value, base in pairs:
+        if base:
+            changes[key] = round((value - base) / base * 100, 1)
+    return changes
+
+
+def main() -> None:
+    """Run the load test, print the results as JSON, and save them if asked."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entitlements", type=int, default=100, help="entitlements of each user")
+    parser.add_argument("--users", type=int, default=1000, help="distinct users requested")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds run before measuring")
+    parser.add_argument("--rems-latency", type=float, default=0.02, help="seconds REMS takes to answer")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of REMS requests answered with 503")
+    parser.add_argument("--cache-ttl", type=float, default=0, help="seconds permissions are cached (0 calls REMS on every request)")
+    parser.add_argument("--executor", choices=("thread", "process"), default=CONFIG.signing_executor, help="signing pool")
+    parser.add_argument("--workers", type=int, default=CONFIG.signing_workers, help="signing pool workers (0 signs on the event loop)")
+    parser.add_argument("--stream", action="store_true", help="stream passports")
+    parser.add_argument("--output", help="file to save the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            results["change_percent"] = compare(results, json.load(baseline))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
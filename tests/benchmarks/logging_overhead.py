@@ -0,0 +1,74 @@
+"""Cost of logging on the permissions hot path.
+
+python -m tests.benchmarks.logging_overhead --visas 100 --requests 500
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+import timeit
+
+from unittest.mock import patch
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG, LOG
+from elixir_rems_proxy.utils.cache import LRUCache
+
+from . import summarize
+from .signing_latency import entitlements
+
+
+async def run(level: int, visas: int, requests: int) -> dict:
+    """Request a passport of `visas` visas `requests` times with the logger at `level`."""
+    latencies = []
+    config = CONFIG._replace(signing_workers=0)
+    LOG.setLevel(level)
+    with patch("elixir_rems_proxy.utils.signing.CONFIG", config), patch(
+        "elixir_rems_proxy.endpoints.permissions.call_rems_api", return_value=entitlements(visas)
+    ), patch("elixir_rems_proxy.endpoints.permissions.TOKEN_CACHE", LRUCache(0, 0)):
+        client = TestClient(TestServer(await init_app()))
+        await client.start_server()
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                async with client.get("/permissions/user", headers={"Permissions-Api-Key": "key"}) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+        finally:
+            await client.close()
+            LOG.setLevel(logging.NOTSET)
+    return summarize(latencies)
+
+
+def debug_call_cost() -> dict:
+    """Return the cost of a disabled debug call with eager and lazy formatting, in nanoseconds."""
+    LOG.setLevel(logging.INFO)
+    stats = {"hits": 1, "misses": 2, "evictions": 3}
+    try:
+        number = 100000
+        eager = timeit.timeit(lambda: LOG.debug(f"Permissions cache: {stats}"), number=number)
+        lazy = timeit.timeit(lambda: LOG.debug("Permissions cache: %s", stats), number=number)
+    finally:
+        LOG.setLevel(logging.NOTSET)
+    return {"eager_ns": round(eager / number * 1e9), "lazy_ns": round(lazy / number * 1e9)}
+
+
+def main() -> None:
+    """Run the benchmark at each log level and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--visas", type=int, default=100, help="visas per passport")
+    parser.add_argument("--requests", type=int, default=500, help="requests per log level")
+    args = parser.parse_args()
+
+    results: dict = {"debug_call": debug_call_cost()}
+    for name, level in (("debug", logging.DEBUG), ("info", logging.INFO), ("disabled", logging.CRITICAL + 1)):
+        results[name] = asyncio.run(run(level, args.visas, args.requests))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
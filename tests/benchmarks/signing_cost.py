@@ -0,0 +1,49 @@
+"""Per-token RS256 signing cost, re-importing the JWK on every call versus a preloaded key.
+
+python -m tests.benchmarks.signing_cost --tokens 200
+"""
+
+import argparse
+import json
+import time
+
+from uuid import uuid4
+
+from authlib.jose import jwt
+
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.config.keys import KEY_RING
+
+SIGNING_KEY = KEY_RING.current.active
+
+
+def payload(n: int) -> dict:
+    """Return a visa JWT payload."""
+    visa = {"type": "ControlledAccessGrants", "value": f"https://www.ebi.ac.uk/ega/EGAD{n:011d}", "source": "https://ga4gh.org/duri/no_org", "by": "dac"}
+    return {"iss": "https://dummyhost/", "sub": "user", "ga4gh_visa_v1": visa, "iat": 1577880000, "exp": 1577883600, "jti": str(uuid4())}
+
+
+def main() -> None:
+    """Time both signing paths and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=200, help="tokens signed per path")
+    args = parser.parse_args()
+    payloads = [payload(n) for n in range(args.tokens)]
+    header = {"jku": "https://dummyhost/jwks.json", "kid": SIGNING_KEY.kid, "alg": "RS256", "typ": "JWT"}
+
+    start = time.perf_counter()
+    for claims in payloads:
+        jwt.encode(header, claims, CONFIG.private_key)
+    jwk_dict = (time.perf_counter() - start) / args.tokens
+
+    start = time.perf_counter()
+    encoded_header = SIGNING_KEY.encoded_header("dummyhost")
+    for claims in payloads:
+        SIGNING_KEY.sign(encoded_header, claims)
+    preloaded = (time.perf_counter() - start) / args.tokens
+
+    print(json.dumps({"tokens": args.tokens, "jwk_dict_ms": round(jwk_dict * 1000, 3), "preloaded_key_ms": round(preloaded * 1000, 3)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
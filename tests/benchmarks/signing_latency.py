@@ -0,0 +1,78 @@
+"""Latency of `/` and `/jwks.json` while large passports are being signed.
+
+python -m tests.benchmarks.signing_latency --visas 500 --duration 5
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from unittest.mock import patch
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.utils.cache import LRUCache
+from elixir_rems_proxy.utils.types import Permission
+
+from . import summarize
+
+
+def entitlements(count: int) -> list:
+    """Return permissions of a synthetic REMS entitlements response."""
+    return [Permission(f"EGAD{n:011d}", "2020-01-01T12:00:00.000Z") for n in range(count)]
+
+
+async def run(executor: str, workers: int, visas: int, clients: int, duration: float) -> dict:
+    """Sign passports of `visas` visas with `clients` concurrent clients, and probe the cheap endpoints meanwhile."""
+    config = CONFIG._replace(signing_executor=executor, signing_workers=workers)
+    latencies: dict = {"/": [], "/jwks.json": [], "/permissions/user": []}
+
+    async def request(client: TestClient, path: str) -> None:
+        start = time.perf_counter()
+        async with client.get(path, headers={"Permissions-Api-Key": "key"}) as response:
+            await response.read()
+        latencies[path].append(time.perf_counter() - start)
+
+    async def repeat(client: TestClient, path: str, until: float, pause: float) -> None:
+        while time.perf_counter() < until:
+            await request(client, path)
+            await asyncio.sleep(pause)
+
+    with patch("elixir_rems_proxy.utils.signing.CONFIG", config), patch(
+        "elixir_rems_proxy.endpoints.permissions.call_rems_api", return_value=entitlements(visas)
+    ), patch("elixir_rems_proxy.endpoints.permissions.TOKEN_CACHE", LRUCache(0, 0)):
+        client = TestClient(TestServer(await init_app()))
+        await client.start_server()
+        try:
+            until = time.perf_counter() + duration
+            await asyncio.gather(
+                *[repeat(client, "/permissions/user", until, 0) for _ in range(clients)],
+                repeat(client, "/", until, 0.005),
+                repeat(client, "/jwks.json", until, 0.005),
+            )
+        finally:
+            await client.close()
+
+    return {path: summarize(values) for path, values in latencies.items()}
+
+
+def main() -> None:
+    """Run the benchmark for each signing executor and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--visas", type=int, default=500, help="visas per passport")
+    parser.add_argument("--clients", type=int, default=2, help="concurrent passport clients")
+    parser.add_argument("--workers", type=int, default=2, help="signing pool workers")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per executor")
+    args = parser.parse_args()
+
+    results = {}
+    for executor, workers in (("synchronous", 0), ("thread", args.workers), ("process", args.workers)):
+        results[executor] = asyncio.run(run(executor, workers, args.visas, args.clients, args.duration))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Startup time and worker memory of the gunicorn deployment, with and without `--preload`.
+
+python -m tests.benchmarks.startup --workers 4
+
+Gunicorn is started as in `deploy/app.sh`, and timed until it serves its first request. Memory of each worker
+is read from /proc (Linux only): RSS counts pages shared with the master, PSS splits them between the processes
+sharing them, and USS counts only the pages private to the worker.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def import_time(repeat: int) -> Dict[str, float]:
+    """Return the time to import the app in a fresh interpreter, in milliseconds."""
+    code = "import time; start = time.perf_counter(); import elixir_rems_proxy.app; print(time.perf_counter() - start)"
+    command = [sys.executable, "-c", code]
+    times = [float(subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True, cwd=ROOT).stdout) for _ in range(repeat)]
+    return {"min_ms": round(min(times) * 1000, 1), "median_ms": round(statistics.median(times) * 1000, 1)}
+
+
+def free_port() -> int:
+    """Return a port that is free to bind to."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def children(pid: int) -> List[int]:
+    """Return the child processes of `pid`."""
+    try:
+        return [int(child) for child in Path(f"/proc/{pid}/task/{pid}/children").read_text().split()]
+    except OSError:
+        return []
+
+
+def memory_kb(pid: int) -> Optional[Dict[str, int]]:
+    """Return RSS, PSS and USS of a process in kB, None where /proc does not have them."""
+    try:
+        lines = Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()
+    except OSError:
+        return None
+    fields = {}
+    for line in lines[1:]:
+        name, value = line.split(":", 1)
+        fields[name] = int(value.split()[0])
+    return {"rss_kb": fields["Rss"], "pss_kb": fields["Pss"], "uss_kb": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def serve(preload: bool, workers: int, worker_class: str, timeout: float) -> dict:
+    """Start gunicorn, time its first served request, and measure its workers once all of them have started."""
+    port = free_port()
+    command = [sys.executable, "-m", "gunicorn", "elixir_rems_proxy.app:init_app", "--bind", f"127.0.0.1:{port}", "--worker-class", worker_class]
+    command += ["--workers", str(workers), "--config", str(ROOT / "deploy" / "gunicorn.conf.py")] + (["--preload"] if preload else [])
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=metrics_dir, prometheus_multiproc_dir=metrics_dir)
+        start = time.perf_counter()
+        server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            first_request = None
+            while time.perf_counter() - start < timeout:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                        response.read()
+                    first_request = time.perf_counter() - start
+                    break
+                except OSError:
+                    time.sleep(0.005)
+            if first_request is None:
+                raise RuntimeError(f"gunicorn did not answer within {timeout}s.")
+
+            while len(children(server.pid)) < workers and time.perf_counter() - start < timeout:
+                time.sleep(0.05)
+            # Let the workers finish starting, and serve a request each on average
+            time.sleep(1)
+            for _ in range(workers):
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/jwks.json", timeout=1) as response:
+                    response.read()
+            worker_memory = [memory for memory in (memory_kb(pid) for pid in children(server.pid)) if memory is not None]
+        finally:
+            server.terminate()
+            server.wait()
+
+    results: dict = {"first_request_ms": round(first_request * 1000, 1)}
+    if worker_memory:
+        for measure in ("rss_kb", "pss_kb", "uss_kb"):
+            results[f"worker_{measure}"] = round(statistics.mean(memory[measure] for memory in worker_memory))
+    return results
+
+
+def main() -> None:
+    """Measure import time, and gunicorn startup with and without preloading, print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--worker-class", default="aiohttp.GunicornWebWorker", help="gunicorn worker class, aiohttp.GunicornUVLoopWebWorker as deployed")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each measurement")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for gunicorn")
+    args = parser.parse_args()
+
+    results: dict = {"import": import_time(args.repeat)}
+    for preload in (False, True):
+        runs = [serve(preload, args.workers, args.worker_class, args.timeout) for _ in range(args.repeat)]
+        results["preload" if preload else "no_preload"] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Date parsing cost over a synthetic REMS entitlements payload.
+
+python -m tests.benchmarks.timestamps --entitlements 10000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+import dateutil.parser
+
+from elixir_rems_proxy.endpoints.permissions import create_ga4gh_visa_v1, iso_to_timestamp
+from elixir_rems_proxy.utils.types import Permission
+
+
+def entitlements(count: int, dates: int) -> list:
+    """Return a synthetic REMS entitlements response with `dates` distinct start dates."""
+    base = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    starts = [(base + timedelta(seconds=random.randint(0, 100000000))).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z" for _ in range(dates)]
+    return [{"resource": f"EGAD{n:011d}", "user": "user", "start": random.choice(starts)} for n in range(count)]
+
+
+def dateutil_timestamp(iso: str) -> int:
+    """Convert the date the way it was done before the fast path."""
+    return int(str(datetime.timestamp(dateutil.parser.parse(iso))).split(".")[0])
+
+
+def timed(function: Callable[[str], Optional[int]], values: list) -> float:
+    """Return seconds taken to call `function` on each value."""
+    start = time.perf_counter()
+    for value in values:
+        function(value)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Time date parsing and visa construction, print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entitlements", type=int, default=10000, help="entitlements in the payload")
+    parser.add_argument("--dates", type=int, default=1000, help="distinct start dates in the payload")
+    args = parser.parse_args()
+    payload = entitlements(args.entitlements, args.dates)
+    starts = [permission["start"] for permission in payload]
+
+    results = {"entitlements": args.entitlements, "distinct_dates": args.dates}
+    results["dateutil_ms"] = timed(dateutil_timestamp, starts) * 1000
+    iso_to_timestamp.cache_clear()
+    results["fast_path_cold_ms"] = timed(iso_to_timestamp.__wrapped__, starts) * 1000
+    results["fast_path_memo_ms"] = timed(iso_to_timestamp, starts) * 1000
+
+    iso_to_timestamp.cache_clear()
+    start = time.perf_counter()
+    asyncio.run(create_ga4gh_visa_v1([Permission.from_rems(entitlement) for entitlement in payload]))
+    results["create_ga4gh_visa_v1_ms"] = (time.perf_counter() - start) * 1000
+    print(json.dumps({key: round(value, 3) if isinstance(value, float) else value for key, value in results.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
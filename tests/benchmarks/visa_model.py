@@ -0,0 +1,104 @@
+"""Memory and time of permissions and visas over a synthetic REMS payload, as tuples versus per-entitlement dicts.
+
+python -m tests.benchmarks.visa_model --entitlements 100000
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from typing import Any, Callable, Tuple
+
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.endpoints.permissions import create_ga4gh_visa_v1, decode_rems_response, iso_to_timestamp
+from elixir_rems_proxy.utils.types import Visa
+
+
+def rems_body(count: int) -> str:
+    """Return a synthetic REMS entitlements response body."""
+    entitlements = [
+        {"resource": f"EGAD{n:011d}", "user": "user", "application-id": n, "start": "2020-01-01T12:00:00.000Z", "end": None, "mail": "user@example.org"}
+        for n in range(count)
+    ]
+    return json.dumps(entitlements)
+
+
+def dict_visas(permissions: list) -> list:
+    """Build visas the way it was done before the tuple model."""
+    return [
+        {
+            "type": "ControlledAccessGrants",
+            "value": f'{CONFIG.repository}{permission.get("resource")}',
+            "source": "https://ga4gh.org/duri/no_org",
+            "by": "dac",
+            "asserted": iso_to_timestamp(permission.get("start")),
+        }
+        for permission in permissions
+    ]
+
+
+def dict_claims(visas: list) -> list:
+    """Build token cache keys and payload claims the way it was done before the tuple model."""
+    return [(("user", json.dumps(visa, sort_keys=True), "host", "kid"), {"ga4gh_visa_v1": visa}) for visa in visas]
+
+
+def tuple_claims(visas: list) -> list:
+    """Build token cache keys and payload claims from visa tuples."""
+    return [(("user", visa, "host", "kid"), {"ga4gh_visa_v1": visa.claim()}) for visa in visas]
+
+
+def measured(function: Callable[..., Any], *args: Any) -> Tuple[Any, float, int]:
+    """Return the result of `function`, seconds taken, and bytes still allocated for the result.
+
+    Memory is traced in a second call, as tracing slows down allocations.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    traced = function(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced
+    return result, elapsed, size
+
+
+def run(body: str, model: str) -> dict:
+    """Decode `body` and build visas and claims with `model`, `dict` or `tuple`."""
+    iso_to_timestamp.cache_clear()
+    if model == "dict":
+        permissions, decode, permissions_bytes = measured(json.loads, body)
+        visas, construct, visas_bytes = measured(dict_visas, permissions)
+        _, claim, _ = measured(dict_claims, visas)
+    else:
+        permissions, decode, permissions_bytes = measured(decode_rems_response, body)
+        visas, construct, visas_bytes = measured(lambda permissions: asyncio.run(create_ga4gh_visa_v1(permissions)), permissions)
+        assert isinstance(visas[0], Visa)
+        _, claim, _ = measured(tuple_claims, visas)
+    return {
+        "decode_ms": round(decode * 1000, 1),
+        "visa_construction_ms": round(construct * 1000, 1),
+        "cache_key_and_claim_ms": round(claim * 1000, 1),
+        "permissions_mb": round(permissions_bytes / 1e6, 1),
+        "visas_mb": round(visas_bytes / 1e6, 1),
+    }
+
+
+def main() -> None:
+    """Compare the two models, print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entitlements", type=int, default=100000, help="entitlements in the payload")
+    args = parser.parse_args()
+    body = rems_body(args.entitlements)
+    results = {"entitlements": args.entitlements, "body_mb": round(len(body) / 1e6, 1)}
+    for model in ("dict", "tuple"):
+        results[model] = run(body, model)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Local stand-in for the REMS entitlements API."""
+
+import asyncio
+import random
+
+from typing import Callable, List, Union
+
+from aiohttp import web
+
+
+def entitlements(username: str, count: int = 1) -> list:
+    """Return REMS entitlements of a user."""
+    return [{"resource": f"EGAD{n:011d}", "user": username, "start": "2020-01-01T12:00:00.000Z"} for n in range(count)]
+
+
+class FakeRems:
+    """REMS entitlements API answering from `permissions`, with scripted failures.
+
+    Each request takes the next action from `script`, once it is empty requests succeed, except for
+    a random `error_rate` share of them that get `error_status`: a status code is responded with an empty body,
+    `"timeout"` waits for `hang` seconds before answering, and `"disconnect"` closes the connection without answering.
+    Every answer is delayed by `delay` seconds.
+    """
+
+    def __init__(
+        self,
+        permissions: Callable[[str], list] = entitlements,
+        delay: float = 0,
+        hang: float = 1,
+        error_rate: float = 0,
+        error_status: Union[int, str] = 503,
+    ) -> None:
+        """Create the fake REMS app."""
+        self.permissions = permissions
+        self.delay = delay
+        self.hang = hang
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.script: List[Union[int, str]] = []
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.app = web.Application()
+        self.app.router.add_get("/api/entitlements", self.get_entitlements)
+
+    async def get_entitlements(self, request: web.Request) -> web.StreamResponse:
+        """Answer an entitlements request."""
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            action = self.script.pop(0) if self.script else None
+            if action is None and self.error_rate and random.random() < self.error_rate:
+                action = self.error_status
+            if action == "disconnect":
+                request.transport.close()
+                return web.Response()
+            await asyncio.sleep(self.hang if action == "timeout" else self.delay)
+            if isinstance(action, int):
+                return web.Response(status=action)
+            return web.json_response(self.permissions(request.headers["x-rems-user-id"]))
+        finally:
+            self.in_flight -= 1
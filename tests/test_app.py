@@ -1,8 +1,17 @@
+import asyncio
+
+import aiohttp
 import asynctest
 
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 
+from aiohttp import web
+from unittest.mock import patch
+
 from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.utils.client import REMS_SESSION
+from elixir_rems_proxy.utils.types import PermissionFilter
 
 
 class TestApp(AioHTTPTestCase):
@@ -34,6 +43,44 @@ class TestApp(AioHTTPTestCase):
         content = await resp.json()
         self.assertIn("ga4gh_passport_v1", content)
 
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions", return_value=[])
+    @unittest_run_loop
+    async def test_permissions_filtered(self, rems_permissions):
+        """Test that the resource, prefix and since query parameters select the permissions requested."""
+        resp = await self.client.request("GET", "/permissions/user?resource=EGAD1&since=2020-01-01T12:00:00Z", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(rems_permissions.call_args[1]["permission_filter"], PermissionFilter("EGAD1", None, 1577880000))
+        await self.client.request("GET", "/permissions/user?prefix=EGAD&since=1577880000", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(rems_permissions.call_args[1]["permission_filter"], PermissionFilter(None, "EGAD", 1577880000))
+        await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        self.assertIsNone(rems_permissions.call_args[1]["permission_filter"])
+        resp = await self.client.request("GET", "/permissions/user?since=yesterday", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(400, resp.status)
+        resp = await self.client.request("GET", "/permissions/user?since=2020-02-30T00:00:00Z", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(400, resp.status)
+
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions_batch", return_value={"user": {"ga4gh_passport_v1": []}})
+    @unittest_run_loop
+    async def test_permissions_batch(self, rems_permissions):
+        """Test that POST /permissions returns passports of the requested users."""
+        resp = await self.client.request("POST", "/permissions", json={"usernames": ["user", "user"]}, headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(200, resp.status)
+        content = await resp.json()
+        self.assertEqual(content, {"user": {"ga4gh_passport_v1": []}})
+        # Duplicates are fetched once
+        self.assertEqual(rems_permissions.call_args[1]["usernames"], ["user"])
+
+    @unittest_run_loop
+    async def test_permissions_batch_invalid(self):
+        """Test that POST /permissions requires an api key and a list of usernames."""
+        resp = await self.client.request("POST", "/permissions", json={"usernames": ["user"]})
+        self.assertEqual(400, resp.status)
+        for body in ({"usernames": "user"}, {"usernames": [""]}, ["user"], {"usernames": ["user"] * (CONFIG.batch_max_users + 1)}):
+            resp = await self.client.request("POST", "/permissions", json=body, headers={"Permissions-Api-Key": "abc"})
+            self.assertEqual(400, resp.status, msg=body)
+        resp = await self.client.request("POST", "/permissions", data="not json", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(400, resp.status)
+
     @unittest_run_loop
     async def test_jwks(self):
         """Test that jwks.json works."""
@@ -42,3 +89,159 @@ class TestApp(AioHTTPTestCase):
         # check that a json dict is returned
         content = await resp.json()
         self.assertIsInstance(content, dict)
+
+    @unittest_run_loop
+    async def test_rems_session(self):
+        """Test that a shared REMS client session is opened on startup."""
+        self.assertIsInstance(self.app[REMS_SESSION], aiohttp.ClientSession)
+        self.assertFalse(self.app[REMS_SESSION].closed)
+
+    @unittest_run_loop
+    async def test_permissions_streamed(self):
+        """Test that a streamed passport is the same JSON document."""
+
+        async def passports(**kwargs):
+            for passport in ("header.payload.signature1", "header.payload.signature2"):
+                yield passport
+
+        with patch("elixir_rems_proxy.app.CONFIG", CONFIG._replace(stream_permissions=True)), patch(
+            "elixir_rems_proxy.app.stream_rems_permissions", side_effect=passports
+        ):
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(200, resp.status)
+        content = await resp.json()
+        self.assertEqual(content, {"ga4gh_passport_v1": ["header.payload.signature1", "header.payload.signature2"]})
+
+    @unittest_run_loop
+    async def test_permissions_streamed_error(self):
+        """Test that REMS errors keep their status when streaming."""
+
+        async def passports(**kwargs):
+            raise web.HTTPForbidden(text="403 Forbidden")
+            yield
+
+        with patch("elixir_rems_proxy.app.CONFIG", CONFIG._replace(stream_permissions=True)), patch(
+            "elixir_rems_proxy.app.stream_rems_permissions", side_effect=passports
+        ):
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(403, resp.status)
+
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions", return_value=[])
+    @unittest_run_loop
+    async def test_metrics(self, _rems_permissions):
+        """Test that requests are counted by route in the metrics."""
+        await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        resp = await self.client.request("GET", "/metrics")
+        self.assertEqual(200, resp.status)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+        content = await resp.text()
+        self.assertIn('elixir_rems_proxy_requests_total{method="GET",route="/permissions/{username}",status="200"}', content)
+        self.assertIn("elixir_rems_proxy_stage_duration_seconds", content)
+
+    @unittest_run_loop
+    async def test_age_header(self):
+        """Test that responses built from cached permissions tell their age."""
+
+        async def permissions(request, **kwargs):
+            request["permissions_age"] = 12.5
+            return []
+
+        with patch("elixir_rems_proxy.app.request_rems_permissions", side_effect=permissions):
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(resp.headers["Age"], "12")
+        resp = await self.client.request("GET", "/")
+        self.assertNotIn("Age", resp.headers)
+
+    @unittest_run_loop
+    async def test_route_policies(self):
+        """Test that only routes declaring a policy are checked."""
+        resp = await self.client.request("GET", "/foo/permissions")
+        self.assertEqual(404, resp.status)
+        resp = await self.client.request("GET", "/jwks.json")
+        self.assertEqual(200, resp.status)
+        resp = await self.client.request("HEAD", "/permissions/user")
+        self.assertEqual(400, resp.status)
+
+    @unittest_run_loop
+    async def test_profiling_disabled(self):
+        """Test that the profiling endpoint and header do nothing unless a profiling token is configured."""
+        resp = await self.client.request("GET", "/admin/profile", headers={"X-Profile-Token": ""})
+        self.assertEqual(404, resp.status)
+        with patch("elixir_rems_proxy.app.request_rems_permissions", return_value=[]):
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc", "X-Profile-Token": ""})
+        self.assertEqual(200, resp.status)
+        self.assertNotIn("X-Profile", resp.headers)
+
+    @unittest_run_loop
+    async def test_jwks_cache(self):
+        """Test that the JWK set is cacheable and revalidated with its ETag."""
+        resp = await self.client.request("GET", "/jwks.json")
+        self.assertEqual(200, resp.status)
+        self.assertEqual(await resp.json(), CONFIG.public_key)
+        self.assertEqual(resp.headers["Cache-Control"], f"public, max-age={CONFIG.jwks_max_age}")
+        resp = await self.client.request("GET", "/jwks.json", headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(304, resp.status)
+
+    @unittest_run_loop
+    async def test_request_id(self):
+        """Test that the correlation ID is kept from the request, or generated."""
+        resp = await self.client.request("GET", "/", headers={"X-Request-ID": "abc123"})
+        self.assertEqual(resp.headers["X-Request-ID"], "abc123")
+        resp = await self.client.request("GET", "/permissions/user")
+        self.assertEqual(400, resp.status)
+        self.assertEqual(len(resp.headers["X-Request-ID"]), 32)
+
+
+class TestAdmission(AioHTTPTestCase):
+    """Test rate and in-flight limits of the web application."""
+
+    async def get_application(self):
+        """Retrieve web app with low limits."""
+        with patch("elixir_rems_proxy.middlewares.CONFIG", CONFIG._replace(rate_limit=1, rate_limit_burst=2, max_in_flight=1, overload_retry_after=2)):
+            return await init_app()
+
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions", return_value=[])
+    @unittest_run_loop
+    async def test_rate_limit(self, _rems_permissions):
+        """Test that an api key over its rate gets 429, while other keys and unprotected routes are served."""
+        for status in (200, 200, 429):
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+            self.assertEqual(status, resp.status)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "def"})
+        self.assertEqual(200, resp.status)
+        resp = await self.client.request("GET", "/")
+        self.assertEqual(200, resp.status)
+
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions_batch", return_value={})
+    @unittest_run_loop
+    async def test_rate_limit_batch(self, _rems_permissions_batch):
+        """Test that a batch takes a token for each distinct user, and cannot ask for more users than the burst."""
+        headers = {"Permissions-Api-Key": "abc"}
+        resp = await self.client.request("POST", "/permissions", json={"usernames": ["user1", "user2", "user1"]}, headers=headers)
+        self.assertEqual(200, resp.status)
+        resp = await self.client.request("POST", "/permissions", json={"usernames": ["user1"]}, headers=headers)
+        self.assertEqual(429, resp.status)
+        resp = await self.client.request("POST", "/permissions", json={"usernames": ["user1", "user2", "user3"]}, headers={"Permissions-Api-Key": "def"})
+        self.assertEqual(400, resp.status)
+
+    @unittest_run_loop
+    async def test_in_flight_limit(self):
+        """Test that requests over the in-flight limit get 503 at once, and are admitted again once others finish."""
+        release = asyncio.Event()
+
+        async def permissions(**kwargs):
+            await release.wait()
+            return []
+
+        with patch("elixir_rems_proxy.app.request_rems_permissions", side_effect=permissions):
+            first = asyncio.ensure_future(self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"}))
+            await asyncio.sleep(0.1)
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "def"})
+            self.assertEqual(503, resp.status)
+            self.assertEqual(resp.headers["Retry-After"], "2")
+            release.set()
+            self.assertEqual(200, (await first).status)
+            resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "def"})
+            self.assertEqual(200, resp.status)
@@ -0,0 +1,182 @@
+import asyncio
+import asynctest
+
+from unittest.mock import patch
+
+from elixir_rems_proxy.utils.cache import LRUCache
+
+
+class TestLRUCache(asynctest.TestCase):
+    """Test the in-process cache."""
+
+    async def test_get_set(self):
+        """Test that stored entries are returned and counted."""
+        cache = LRUCache(2, 10)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 1, "misses": 1, "evictions": 0, "coalesced": 0})
+
+    async def test_eviction(self):
+        """Test that the least recently used entry is evicted first."""
+        cache = LRUCache(2, 10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.evictions, 1)
+
+    async def test_expiry(self):
+        """Test that entries expire after their ttl."""
+        cache = LRUCache(2, 10)
+        with patch("time.monotonic", return_value=100):
+            cache.set("a", 1)
+            cache.set("b", 2, ttl=20)
+        with patch("time.monotonic", return_value=115):
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b"), 2)
+
+    async def test_stale(self):
+        """Test that expired entries are kept for `get_stale` until the stale ttl has passed."""
+        cache = LRUCache(2, 10, stale_ttl=60)
+        with patch("time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("time.monotonic", return_value=115):
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get_stale("a"), 1)
+        with patch("time.monotonic", return_value=175):
+            self.assertIsNone(cache.get("a"))
+            self.assertIsNone(cache.get_stale("a"))
+            self.assertEqual(len(cache), 0)
+
+    async def test_revalidate(self):
+        """Test that expired entries are returned at once, and replaced once fetched in the background."""
+        cache = LRUCache(2, 10, stale_ttl=60, revalidate=True)
+        fetched = asyncio.Event()
+
+        async def fetch():
+            await fetched.wait()
+            return 2
+
+        with patch("time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("time.monotonic", return_value=115):
+            self.assertEqual(cache.age("a"), 15)
+            self.assertEqual(await cache.get_or_fetch("a", fetch), 1)
+            self.assertEqual(await cache.get_or_fetch("a", fetch), 1)
+            fetched.set()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertEqual(await cache.get_or_fetch("a", fetch), 2)
+            self.assertEqual(cache.age("a"), 0)
+
+    async def test_get_or_fetch_aged(self):
+        """Test that a value fetched earlier elsewhere is stored as that old, and expires that much sooner."""
+        cache = LRUCache(2, 10)
+
+        async def fetch():
+            return 4, "value"
+
+        with patch("time.monotonic", return_value=100):
+            self.assertEqual(await cache.get_or_fetch_aged("a", fetch), "value")
+            await asyncio.sleep(0)
+            self.assertEqual(cache.age("a"), 4)
+        with patch("time.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), "value")
+        with patch("time.monotonic", return_value=107):
+            self.assertIsNone(cache.get("a"))
+
+    async def test_revalidate_failure(self):
+        """Test that a failed background fetch keeps the expired entry, until the stale ttl has passed."""
+        cache = LRUCache(2, 10, stale_ttl=60, revalidate=True)
+
+        async def fetch():
+            raise ValueError()
+
+        with patch("time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("time.monotonic", return_value=115):
+            self.assertEqual(await cache.get_or_fetch("a", fetch), 1)
+            await asyncio.sleep(0)
+            self.assertEqual(await cache.get_or_fetch("a", fetch), 1)
+        with patch("time.monotonic", return_value=175):
+            with self.assertRaises(ValueError):
+                await cache.get_or_fetch("a", fetch)
+
+    async def test_disabled(self):
+        """Test that a cache without a ttl stores nothing."""
+        cache = LRUCache(2, 0)
+        cache.set("a", 1)
+        self.assertEqual(len(cache), 0)
+
+    async def test_invalidate(self):
+        """Test that matching entries are dropped."""
+        cache = LRUCache(3, 10)
+        cache.set(("user", 1), 1)
+        cache.set(("user", 2), 2)
+        cache.set(("other", 1), 3)
+        self.assertEqual(cache.invalidate(lambda key: key[0] == "user"), 2)
+        self.assertEqual(cache.get(("other", 1)), 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    async def test_get_or_fetch_coalesces(self):
+        """Test that concurrent misses share a single fetch, and the result is cached."""
+        cache = LRUCache(2, 10)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ["permission"]
+
+        results = await asyncio.gather(*[cache.get_or_fetch("user", fetch) for _ in range(5)])
+        self.assertEqual(results, [["permission"]] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.coalesced, 4)
+        self.assertEqual(await cache.get_or_fetch("user", fetch), ["permission"])
+        self.assertEqual(len(calls), 1)
+
+    async def test_get_or_fetch_error(self):
+        """Test that a failed fetch is raised to all waiters and not cached."""
+        cache = LRUCache(2, 10)
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ValueError("REMS down")
+
+        results = await asyncio.gather(*[cache.get_or_fetch("user", fetch) for _ in range(3)], return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(len(cache), 0)
+
+    async def test_get_or_fetch_invalidated(self):
+        """Test that a fetch completing after invalidation is not cached."""
+        cache = LRUCache(2, 10)
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            return ["old"]
+
+        task = asyncio.ensure_future(cache.get_or_fetch("user", fetch))
+        await asyncio.sleep(0)
+        cache.clear()
+        self.assertEqual(await task, ["old"])
+        self.assertEqual(len(cache), 0)
+
+    async def test_get_or_fetch_invalidated_other(self):
+        """Test that invalidating one key does not drop the fetches of other keys in flight."""
+        cache = LRUCache(2, 10)
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            return ["permission"]
+
+        tasks = [asyncio.ensure_future(cache.get_or_fetch(username, fetch)) for username in ("user", "other")]
+        await asyncio.sleep(0)
+        cache.invalidate(lambda key: key == "user")
+        await asyncio.gather(*tasks)
+        self.assertIsNone(cache.get("user"))
+        self.assertEqual(cache.get("other"), ["permission"])
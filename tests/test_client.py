@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+import aiohttp
+import asynctest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from unittest.mock import patch
+
+from elixir_rems_proxy.utils.client import CircuitBreaker, RemsClient
+
+from .fake_rems import FakeRems, entitlements
+
+HEADERS = {"x-rems-user-id": "user"}
+
+
+class TestCircuitBreaker(asynctest.TestCase):
+    """Test the circuit breaker states."""
+
+    async def test_open_and_close(self):
+        """Test that the circuit opens on consecutive failures, and closes after a successful trial call."""
+        breaker = CircuitBreaker(2, 10)
+        with patch("time.monotonic", return_value=100):
+            breaker.failure()
+            self.assertTrue(breaker.allow())
+            breaker.failure()
+            self.assertEqual(breaker.state, "open")
+            self.assertFalse(breaker.allow())
+            self.assertEqual(breaker.retry_after(), 10)
+        with patch("time.monotonic", return_value=111):
+            self.assertEqual(breaker.state, "half-open")
+            self.assertTrue(breaker.allow())
+            # One trial at a time
+            self.assertFalse(breaker.allow())
+            breaker.success()
+            self.assertEqual(breaker.state, "closed")
+
+    async def test_failed_trial(self):
+        """Test that a failed trial call opens the circuit again."""
+        breaker = CircuitBreaker(1, 10)
+        with patch("time.monotonic", return_value=100):
+            breaker.failure()
+        with patch("time.monotonic", return_value=111):
+            self.assertTrue(breaker.allow())
+            breaker.failure()
+            self.assertFalse(breaker.allow())
+
+    async def test_disabled(self):
+        """Test that a zero threshold never opens the circuit."""
+        breaker = CircuitBreaker(0, 10)
+        for _ in range(10):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+
+
+class TestRemsClient(asynctest.TestCase):
+    """Test REMS calls against a fake REMS."""
+
+    async def setUp(self):
+        """Start the fake REMS."""
+        self.rems = FakeRems()
+        self.server = TestServer(self.rems.app)
+        await self.server.start_server()
+        self.url = str(self.server.make_url("/api/entitlements"))
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, connect=1, sock_read=0.2))
+
+    async def tearDown(self):
+        """Stop the fake REMS."""
+        await self.session.close()
+        await self.server.close()
+
+    def client(self, **kwargs):
+        """Return a client with fast retries."""
+        return RemsClient(self.session, **dict({"retries": 2, "backoff": 0.001}, **kwargs))
+
+    async def test_get_json(self):
+        """Test that a successful response is decoded."""
+        self.assertEqual(await self.client().get_json(self.url, HEADERS, json.loads), entitlements("user"))
+        self.assertEqual(self.rems.calls, 1)
+
+    async def test_retry(self):
+        """Test that unavailable REMS, timeouts and dropped connections are retried."""
+        for failure in (503, "timeout", "disconnect"):
+            self.rems.calls = 0
+            self.rems.script = [failure]
+            self.assertEqual(await self.client().get_json(self.url, HEADERS, json.loads), entitlements("user"), msg=failure)
+            self.assertEqual(self.rems.calls, 2, msg=failure)
+
+    async def test_retries_exhausted(self):
+        """Test that failures are mapped to gateway errors once the retries are used up."""
+        for failure, error in ((502, web.HTTPBadGateway), (503, web.HTTPServiceUnavailable)):
+            self.rems.calls = 0
+            self.rems.script = [failure] * 3
+            with self.assertRaises(error, msg=failure):
+                await self.client().get_json(self.url, HEADERS, json.loads)
+            self.assertEqual(self.rems.calls, 3, msg=failure)
+
+        # aiohttp may itself retry a request on a reused connection that was dropped
+        self.rems.script = ["disconnect"] * 6
+        with self.assertRaises(web.HTTPBadGateway):
+            await self.client().get_json(self.url, HEADERS, json.loads)
+
+        self.rems.script = ["timeout"]
+        with self.assertRaises(web.HTTPGatewayTimeout):
+            await self.client(retries=0).get_json(self.url, HEADERS, json.loads)
+
+    async def test_error_rate(self):
+        """Test that the fake REMS fails the configured share of requests."""
+        self.rems.error_rate = 1
+        with self.assertRaises(web.HTTPServiceUnavailable):
+            await self.client().get_json(self.url, HEADERS, json.loads)
+        self.assertEqual(self.rems.calls, 3)
+        self.rems.error_rate = 0
+        self.assertEqual(await self.client().get_json(self.url, HEADERS, json.loads), entitlements("user"))
+
+    async def test_not_retried(self):
+        """Test that REMS refusing the request is not retried, and keeps the circuit closed."""
+        client = self.client(breaker=CircuitBreaker(1, 60))
+        for status, error in ((403, web.HTTPForbidden), (404, web.HTTPNotFound)):
+            self.rems.calls = 0
+            self.rems.script = [status]
+            with self.assertRaises(error):
+                await client.get_json(self.url, HEADERS, json.loads)
+            self.assertEqual(self.rems.calls, 1)
+        self.assertEqual(client.breaker.state, "closed")
+
+    async def test_circuit_breaker(self):
+        """Test that calls fail fast while the circuit is open, and REMS is tried again after the reset timeout."""
+        client = self.client(retries=0, breaker=CircuitBreaker(2, 0.2))
+        self.rems.script = [503, 503]
+        for _ in range(2):
+            with self.assertRaises(web.HTTPServiceUnavailable):
+                await client.get_json(self.url, HEADERS, json.loads)
+        with self.assertRaises(web.HTTPServiceUnavailable) as cm:
+            await client.get_json(self.url, HEADERS, json.loads)
+        self.assertEqual(cm.exception.headers["Retry-After"], "1")
+        self.assertEqual(self.rems.calls, 2)
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(await client.get_json(self.url, HEADERS, json.loads), entitlements("user"))
+        self.assertEqual(client.breaker.state, "closed")
+
+    async def test_concurrency_limit(self):
+        """Test that at most `concurrency` calls are made at once."""
+        self.rems.delay = 0.05
+        client = self.client(concurrency=2)
+        await asyncio.gather(*[client.get_json(self.url, HEADERS, json.loads) for _ in range(6)])
+        self.assertEqual(self.rems.calls, 6)
+        self.assertEqual(self.rems.max_in_flight, 2)
+
+    async def test_iter_chunks(self):
+        """Test that a streamed response is retried before its first chunk."""
+        self.rems.script = [503]
+        body = b"".join([chunk async for chunk in self.client().iter_chunks(self.url, HEADERS, 16)])
+        self.assertEqual(json.loads(body), entitlements("user"))
+        self.assertEqual(self.rems.calls, 2)
@@ -0,0 +1,54 @@
+import unittest
+
+from unittest.mock import patch
+
+from authlib.jose import jwt
+
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.config.keys import KEY_RING
+from elixir_rems_proxy.utils.codec import CODECS, select_codec
+from elixir_rems_proxy.utils.types import Permission, Visa
+
+DOCUMENTS = [
+    {"ga4gh_passport_v1": ["header.payload.signature", "header.payload.signature"]},
+    {"user1": {"ga4gh_passport_v1": []}, "user2": {"error": {"status": 403, "message": "403 Forbidden"}}},
+    {"iss": "https://host/", "sub": "üsér", "ga4gh_visa_v1": Visa("https://www.ebi.ac.uk/ega/EGAD1", 1577880000).claim(), "iat": 1, "exp": 2},
+    [Permission("EGAD1", "2020-01-01T12:00:00.000Z"), Permission(None, None)],
+    {"keys": [{"kty": "RSA", "n": "abc", "e": "AQAB", "kid": "rsa1"}]},
+    "header.payload.signature",
+]
+
+
+class TestCodecs(unittest.TestCase):
+    """Test that the JSON backends are interchangeable."""
+
+    def test_equivalent(self):
+        """Test that all backends encode documents to the same bytes, which decode back."""
+        expected = [CODECS["json"].dumps(document) for document in DOCUMENTS]
+        for name, codec in CODECS.items():
+            for document, encoded in zip(DOCUMENTS, expected):
+                with self.subTest(backend=name, document=document):
+                    self.assertEqual(codec.dumps(document), encoded)
+                    self.assertEqual(codec.loads(encoded), codec.loads(encoded.decode("utf-8")))
+        self.assertEqual(CODECS["json"].loads(expected[3]), [["EGAD1", "2020-01-01T12:00:00.000Z"], [None, None]])
+
+    def test_unserializable(self):
+        """Test that all backends refuse objects that are not JSON."""
+        for codec in CODECS.values():
+            with self.assertRaises(TypeError):
+                codec.dumps({"key": object()})
+
+    def test_select(self):
+        """Test that `auto` prefers orjson, and missing backends are refused."""
+        self.assertEqual(select_codec("auto").name, "orjson" if "orjson" in CODECS else "json")
+        self.assertEqual(select_codec("json").name, "json")
+        with self.assertRaises(ValueError):
+            select_codec("simplejson")
+
+    def test_signing(self):
+        """Test that tokens signed with each backend verify."""
+        key = KEY_RING.current.active
+        for name, codec in CODECS.items():
+            with self.subTest(backend=name), patch("elixir_rems_proxy.config.keys.CODEC", codec):
+                token = key.sign(key._encode_header("host"), DOCUMENTS[2])
+                self.assertEqual(jwt.decode(token, CONFIG.public_key)["sub"], "üsér")
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+import unittest
+
+from elixir_rems_proxy.config import strtobool
+
+
+class TestConfig(unittest.TestCase):
+    """Test configuration parsing and startup."""
+
+    def test_strtobool(self):
+        """Test that truth values are parsed as by distutils, and other values are refused."""
+        for value in ("y", "Yes", "t", "TRUE", "on", "1"):
+            self.assertIs(strtobool(value), True)
+        for value in ("n", "No", "f", "False", "off", "0"):
+            self.assertIs(strtobool(value), False)
+        with self.assertRaises(ValueError):
+            strtobool("maybe")
+
+    def test_lazy_imports(self):
+        """Test that the app imports neither distutils, nor dateutil before a date needs it."""
+        code = "import sys, elixir_rems_proxy.app; print(' '.join(sorted(name for name in ('distutils', 'dateutil') if name in sys.modules)))"
+        modules = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split()
+        self.assertEqual(modules, [])
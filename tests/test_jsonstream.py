@@ -0,0 +1,36 @@
+import json
+import asynctest
+
+from elixir_rems_proxy.utils.jsonstream import iter_json_array
+
+
+async def chunked(data, size):
+    """Yield `data` in chunks of `size` bytes."""
+    for start in range(0, len(data), size):
+        stop = start + size
+        yield data[start:stop]
+
+
+class TestJSONStream(asynctest.TestCase):
+    """Test incremental JSON array parsing."""
+
+    async def parse(self, data, size):
+        """Collect the parsed items."""
+        return [item async for item in iter_json_array(chunked(data, size))]
+
+    async def test_items(self):
+        """Test that items are parsed regardless of where the chunks split."""
+        items = [{"resource": f"EGAD{n}", "start": "2020-01-01T12:00:00.000Z", "note": "ä, ] [ }"} for n in range(20)]
+        data = json.dumps(items, indent=1).encode("utf-8")
+        for size in (1, 2, 7, 64, len(data)):
+            self.assertEqual(await self.parse(data, size), items, msg=f"Chunk size {size}")
+
+    async def test_empty(self):
+        """Test that an empty array yields nothing."""
+        self.assertEqual(await self.parse(b" [ ] ", 1), [])
+
+    async def test_invalid(self):
+        """Test that malformed and truncated arrays are rejected."""
+        for data in (b'{"a": 1}', b'[{"a": 1}', b'[{"a": 1} {"b": 2}]', b'[{"a": 1},]', b'[{"a": 1}] x'):
+            with self.assertRaises(ValueError, msg=data):
+                await self.parse(data, 3)
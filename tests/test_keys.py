@@ -0,0 +1,140 @@
+import base64
+import io
+import json
+import os
+import tempfile
+
+from authlib.jose import jwt
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.config.jwks import generate_jwks
+from elixir_rems_proxy.config.keys import KEY_RING, KeyRing, SigningKey, load_key_set
+
+SIGNING_KEY = KEY_RING.current.active
+
+
+class TestSigningKey(TestCase):
+    """Test the preloaded signing key."""
+
+    def test_sign(self):
+        """Test that signed tokens verify against the published key set."""
+        token = SIGNING_KEY.sign(SIGNING_KEY.encoded_header("dummyhost"), {"sub": "testuser"})
+        self.assertEqual(jwt.decode(token, CONFIG.public_key)["sub"], "testuser")
+
+    def test_encoded_header(self):
+        """Test that the header names the issuer host and the key."""
+        encoded = SIGNING_KEY.encoded_header("dummyhost")
+        header = json.loads(base64.urlsafe_b64decode(encoded + b"=" * (-len(encoded) % 4)))
+        self.assertEqual(header, {"jku": "https://dummyhost/jwks.json", "kid": CONFIG.public_key["keys"][0]["kid"], "alg": "RS256", "typ": "JWT"})
+        self.assertIs(SIGNING_KEY.encoded_header("dummyhost"), encoded)
+
+    def test_without_crt_parameters(self):
+        """Test that a key without the optional CRT parameters can be loaded."""
+        minimal = {member: CONFIG.private_key[member] for member in ("kty", "n", "e", "d")}
+        key = SigningKey(minimal, SIGNING_KEY.kid)
+        token = key.sign(key.encoded_header("dummyhost"), {"sub": "testuser"})
+        self.assertEqual(jwt.decode(token, CONFIG.public_key)["sub"], "testuser")
+
+    def test_unsupported(self):
+        """Test that unsupported keys are rejected."""
+        with self.assertRaises(ValueError):
+            SigningKey({"kty": "oct", "k": "secret"}, "kid")
+        with self.assertRaises(ValueError):
+            SigningKey(CONFIG.private_key, "kid", "HS256")
+
+
+class TestKeyRing(TestCase):
+    """Test loading and reloading the key ring."""
+
+    def setUp(self):
+        """Write a key ring of the test key, active, and a published and a retired key."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.private_key_file = os.path.join(self.directory.name, "private_key.json")
+        self.public_key_file = os.path.join(self.directory.name, "public_key.json")
+        self.ring = {
+            "keys": [
+                dict(CONFIG.private_key, kid="active", alg="RS256", status="active"),
+                dict(CONFIG.private_key, kid="next", alg="RS256", status="published"),
+                dict(CONFIG.private_key, kid="old", alg="RS256", status="retired"),
+            ]
+        }
+        self.write(self.ring)
+
+    def tearDown(self):
+        """Remove the key files."""
+        self.directory.cleanup()
+
+    def write(self, ring):
+        """Write the key files."""
+        with open(self.private_key_file, "w") as private_file:
+            json.dump(ring, private_file)
+        with open(self.public_key_file, "w") as public_file:
+            json.dump({"keys": []}, public_file)
+
+    def test_single_key(self):
+        """Test that a single private key pairs with the first public key."""
+        key_set = load_key_set(CONFIG.private_key, CONFIG.public_key)
+        self.assertEqual(key_set.active.kid, CONFIG.public_key["keys"][0]["kid"])
+        self.assertIs(key_set.jwks, CONFIG.public_key)
+
+    def test_key_ring(self):
+        """Test that the active key signs, and only non-retired public keys are published."""
+        key_set = load_key_set(self.ring, {"keys": []})
+        self.assertEqual(key_set.active.kid, "active")
+        self.assertEqual([key["kid"] for key in key_set.jwks["keys"]], ["active", "next"])
+        for key in key_set.jwks["keys"]:
+            self.assertNotIn("d", key)
+            self.assertNotIn("status", key)
+        token = key_set.active.sign(key_set.active.encoded_header("dummyhost"), {"sub": "testuser"})
+        self.assertEqual(jwt.decode(token, key_set.jwks)["sub"], "testuser")
+
+    def test_invalid_key_ring(self):
+        """Test that a key ring needs exactly one active key, and known statuses."""
+        for statuses in (["published", "published"], ["active", "active"], ["active", "revoked"]):
+            ring = {"keys": [dict(CONFIG.private_key, kid=str(n), status=status) for n, status in enumerate(statuses)]}
+            with self.assertRaises(ValueError, msg=statuses):
+                load_key_set(ring, {"keys": []})
+
+    def test_reload(self):
+        """Test that a reload swaps in the new keys, and that invalid files keep the current keys."""
+        ring = KeyRing(load_key_set(self.ring, {"keys": []}), self.private_key_file, self.public_key_file)
+        self.assertFalse(ring.reload_if_modified())
+
+        self.ring["keys"][0]["status"] = "published"
+        self.ring["keys"][1]["status"] = "active"
+        self.write(self.ring)
+        os.utime(self.private_key_file, (0, 0))
+        self.assertTrue(ring.reload_if_modified())
+        self.assertEqual(ring.current.active.kid, "next")
+
+        with open(self.private_key_file, "w") as private_file:
+            private_file.write('{"keys": [')
+        current = ring.current
+        self.assertFalse(ring.reload())
+        self.assertIs(ring.current, current)
+
+
+class TestAlgorithms(TestCase):
+    """Test signing with each supported algorithm."""
+
+    def test_algorithms(self):
+        """Test that tokens of each algorithm verify against the published key."""
+        for alg in ("RS256", "ES256", "EdDSA"):
+            with self.subTest(alg=alg), redirect_stdout(io.StringIO()):
+                public_key, private_key = generate_jwks(alg)
+                key_set = load_key_set(private_key, public_key)
+                self.assertEqual(key_set.active.alg, alg)
+                self.assertNotIn("d", public_key["keys"][0])
+                token = key_set.active.sign(key_set.active.encoded_header("dummyhost"), {"sub": "testuser"})
+                self.assertEqual(jwt.decode(token, public_key)["sub"], "testuser")
+
+    def test_key_type_mismatch(self):
+        """Test that a key cannot sign with the algorithm of another key type."""
+        with redirect_stdout(io.StringIO()):
+            _, private_key = generate_jwks("ES256")
+        with self.assertRaises(ValueError):
+            SigningKey(private_key, "kid", "EdDSA")
+        with self.assertRaises(ValueError):
+            SigningKey(CONFIG.private_key, "kid", "ES256")
@@ -0,0 +1,66 @@
+import json
+import sys
+import logging
+import unittest
+
+from elixir_rems_proxy.config import REQUEST_ID, JSONFormatter, RequestContextFilter
+
+
+def record(level=logging.DEBUG, msg="message %s", args=("arg",)):
+    """Return a log record."""
+    return logging.LogRecord("ELIXIR", level, __file__, 1, msg, args, None)
+
+
+class TestLogging(unittest.TestCase):
+    """Test log formatting and debug sampling."""
+
+    def test_request_id(self):
+        """Test that records are tagged with the current request ID."""
+        entry = record()
+        self.assertTrue(RequestContextFilter().filter(entry))
+        self.assertEqual(entry.request_id, "-")
+        token = REQUEST_ID.set("abc")
+        try:
+            entry = record()
+            RequestContextFilter().filter(entry)
+            self.assertEqual(entry.request_id, "abc")
+        finally:
+            REQUEST_ID.reset(token)
+
+    def test_debug_sampling(self):
+        """Test that debug records are kept for a stable sample of requests, and other records always."""
+        log_filter = RequestContextFilter(0.25)
+        kept = []
+        for n in range(1000):
+            token = REQUEST_ID.set(f"request-{n}")
+            try:
+                sampled = log_filter.filter(record())
+                # A request keeps all or none of its debug records
+                self.assertEqual(log_filter.filter(record()), sampled)
+                self.assertTrue(log_filter.filter(record(logging.INFO)))
+                kept.append(sampled)
+            finally:
+                REQUEST_ID.reset(token)
+        self.assertTrue(150 < sum(kept) < 350)
+        # Records outside requests are not sampled
+        self.assertTrue(RequestContextFilter(0).filter(record()))
+
+    def test_json_formatter(self):
+        """Test that records are formatted as single line JSON."""
+        entry = record(logging.INFO)
+        RequestContextFilter().filter(entry)
+        line = JSONFormatter().format(entry)
+        self.assertNotIn("\n", line)
+        content = json.loads(line)
+        self.assertEqual(content["message"], "message arg")
+        self.assertEqual(content["level"], "INFO")
+        self.assertEqual(content["request_id"], "-")
+        try:
+            raise ValueError("failure")
+        except ValueError:
+            entry = logging.LogRecord("ELIXIR", logging.ERROR, __file__, 1, "failed", (), sys.exc_info())
+        self.assertIn("ValueError: failure", json.loads(JSONFormatter().format(entry))["exception"])
+
+
+if __name__ == "__main__":
+    unittest.main()
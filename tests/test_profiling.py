@@ -0,0 +1,92 @@
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+import asynctest
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from unittest.mock import patch
+
+from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.utils.profiling import StackSampler
+
+
+def busy_wait(until: float) -> None:
+    """Keep the thread running Python code until `until`."""
+    while time.perf_counter() < until:
+        pass
+
+
+class TestStackSampler(asynctest.TestCase):
+    """Test sampling the stacks of a thread."""
+
+    def test_sampled(self):
+        """Test that stacks of the sampled thread are counted in the folded format."""
+        worker = threading.Thread(target=busy_wait, args=(time.perf_counter() + 0.3,))
+        worker.start()
+        sampler = StackSampler(worker.ident, 0.005)
+        sampler.start()
+        time.sleep(0.2)
+        sampler.stop()
+        worker.join()
+        self.assertGreater(sampler.samples, 0)
+        stack, count = sampler.folded().splitlines()[0].rsplit(" ", 1)
+        self.assertTrue(stack.endswith("test_profiling.py:busy_wait"))
+        self.assertEqual(stack.split(";")[0], "threading.py:_bootstrap")
+
+
+class TestProfiling(AioHTTPTestCase):
+    """Test profiling requests and the worker."""
+
+    def setUp(self):
+        """Enable profiling, with profiles written to a temporary directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        config = CONFIG._replace(profiling_token="secret", profile_dir=self.directory.name, profile_max_seconds=1)
+        self.patchers = [patch(f"{module}.CONFIG", config) for module in ("elixir_rems_proxy.app", "elixir_rems_proxy.utils.profiling")]
+        for patcher in self.patchers:
+            patcher.start()
+        super().setUp()
+
+    def tearDown(self):
+        """Disable profiling."""
+        super().tearDown()
+        for patcher in self.patchers:
+            patcher.stop()
+        self.directory.cleanup()
+
+    async def get_application(self):
+        """Retrieve web app for the tests."""
+        return await init_app()
+
+    @asynctest.patch("elixir_rems_proxy.app.request_rems_permissions", return_value=[])
+    @unittest_run_loop
+    async def test_profile_request(self, _rems_permissions):
+        """Test that requests with the token are profiled to a file, and other requests are not."""
+        resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc", "X-Profile-Token": "secret"})
+        self.assertEqual(200, resp.status)
+        stats = pstats.Stats(os.path.join(self.directory.name, resp.headers["X-Profile"]))
+        self.assertTrue(any(function == "get_permissions" for _, _, function in stats.stats))
+
+        resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc"})
+        self.assertEqual(200, resp.status)
+        self.assertNotIn("X-Profile", resp.headers)
+        resp = await self.client.request("GET", "/permissions/user", headers={"Permissions-Api-Key": "abc", "X-Profile-Token": "wrong"})
+        self.assertEqual(403, resp.status)
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+    @unittest_run_loop
+    async def test_profile_worker(self):
+        """Test that the worker is sampled for the requested time, with the token only."""
+        resp = await self.client.request("GET", "/admin/profile?seconds=0.2&interval=0.005", headers={"X-Profile-Token": "secret"})
+        self.assertEqual(200, resp.status)
+        self.assertGreater(int(resp.headers["X-Profile-Samples"]), 0)
+        # The loop waits for the end of the sampling meanwhile
+        self.assertIn("base_events.py:_run_once", await resp.text())
+
+        resp = await self.client.request("GET", "/admin/profile?seconds=0.2")
+        self.assertEqual(403, resp.status)
+        resp = await self.client.request("GET", "/admin/profile?seconds=2", headers={"X-Profile-Token": "secret"})
+        self.assertEqual(400, resp.status)
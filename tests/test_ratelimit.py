@@ -0,0 +1,54 @@
+import unittest
+
+from unittest.mock import patch
+
+from elixir_rems_proxy.utils.ratelimit import InFlightLimit, TokenBuckets
+
+
+class TestTokenBuckets(unittest.TestCase):
+    """Test per api key token buckets."""
+
+    def test_refill(self):
+        """Test that a burst is admitted, then requests at the rate, and the wait until the next token is returned."""
+        buckets = TokenBuckets(rate=2, burst=3, maxsize=10)
+        with patch("time.monotonic", return_value=100):
+            self.assertEqual([buckets.take("key") for _ in range(4)], [0, 0, 0, 0.5])
+            self.assertEqual(buckets.take("other"), 0)
+        with patch("time.monotonic", return_value=100.5):
+            self.assertEqual(buckets.take("key"), 0)
+            self.assertEqual(buckets.take("key"), 0.5)
+        with patch("time.monotonic", return_value=1000):
+            self.assertEqual([buckets.take("key") for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_cost(self):
+        """Test that several tokens are taken at once, and none when the caller does not have them all."""
+        buckets = TokenBuckets(rate=2, burst=3, maxsize=10)
+        with patch("time.monotonic", return_value=100):
+            self.assertEqual(buckets.take("key", 2), 0)
+            self.assertEqual(buckets.take("key", 2), 0.5)
+            self.assertEqual(buckets.take("key"), 0)
+
+    def test_bounded(self):
+        """Test that the least recently seen callers are dropped, and api keys are not kept."""
+        buckets = TokenBuckets(rate=1, burst=1, maxsize=2)
+        with patch("time.monotonic", return_value=100):
+            for key in ("key1", "key2", "key1", "key3"):
+                buckets.take(key)
+            self.assertEqual(len(buckets), 2)
+            self.assertEqual(buckets.take("key2"), 0)
+            self.assertEqual(buckets.take("key3"), 1)
+        self.assertNotIn(b"key3", b"".join(buckets._buckets))
+
+
+class TestInFlightLimit(unittest.TestCase):
+    """Test the in-flight limit."""
+
+    def test_limit(self):
+        """Test that requests are refused at the limit, and never with no limit."""
+        limit = InFlightLimit(1)
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        limit.release()
+        self.assertTrue(limit.acquire())
+        unlimited = InFlightLimit(0)
+        self.assertTrue(all(unlimited.acquire() for _ in range(100)))
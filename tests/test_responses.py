@@ -0,0 +1,69 @@
+import gzip
+import json
+import unittest
+
+from aiohttp.test_utils import make_mocked_request
+
+from elixir_rems_proxy.utils.responses import JSONBody, StaticBody, accepts_gzip, gzip_deterministic
+
+
+class TestStaticBody(unittest.TestCase):
+    """Test precomputed responses."""
+
+    def test_accepts_gzip(self):
+        """Test Accept-Encoding parsing."""
+        self.assertTrue(accepts_gzip("gzip, deflate, br"))
+        self.assertTrue(accepts_gzip("br;q=1.0, gzip;q=0.5"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip("gzip;q=0"))
+        self.assertFalse(accepts_gzip("identity"))
+        self.assertFalse(accepts_gzip(""))
+
+    def test_response(self):
+        """Test that the body is served plain or gzipped, with a distinct ETag each."""
+        body = StaticBody(b"x" * 1000, "text/plain", "no-cache")
+        plain = body.response(make_mocked_request("GET", "/"))
+        self.assertEqual(plain.body, b"x" * 1000)
+        self.assertEqual(plain.headers["Cache-Control"], "no-cache")
+        compressed = body.response(make_mocked_request("GET", "/", headers={"Accept-Encoding": "gzip"}))
+        self.assertEqual(compressed.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed.body), b"x" * 1000)
+        self.assertNotEqual(plain.headers["ETag"], compressed.headers["ETag"])
+
+    def test_gzip_deterministic(self):
+        """Test that gzipping the same body twice gives the same bytes, and so the same ETag in every worker."""
+        body = b"x" * 1000
+        self.assertEqual(gzip_deterministic(body), gzip_deterministic(body))
+        self.assertEqual(gzip.decompress(gzip_deterministic(body)), body)
+
+    def test_small_body(self):
+        """Test that small bodies are not compressed."""
+        body = StaticBody(b"ok", "text/plain", "no-cache")
+        response = body.response(make_mocked_request("GET", "/", headers={"Accept-Encoding": "gzip"}))
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertNotIn("Vary", response.headers)
+
+    def test_not_modified(self):
+        """Test that a matching If-None-Match gets 304 Not Modified."""
+        body = StaticBody(b"ok", "text/plain", "no-cache")
+        for tags in (body.etag, f'"other", W/{body.etag}', "*"):
+            response = body.response(make_mocked_request("GET", "/", headers={"If-None-Match": tags}))
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.headers["ETag"], body.etag)
+        response = body.response(make_mocked_request("GET", "/", headers={"If-None-Match": '"other"'}))
+        self.assertEqual(response.status, 200)
+
+    def test_json_rebuilt(self):
+        """Test that a JSON body is rebuilt when the document is replaced."""
+        documents = [{"keys": []}]
+        body = JSONBody(lambda: documents[-1], "public, max-age=300")
+        first = body.get()
+        self.assertIs(body.get(), first)
+        documents.append({"keys": [{"kid": "new"}]})
+        second = body.get()
+        self.assertNotEqual(first.etag, second.etag)
+        self.assertEqual(json.loads(second.body), {"keys": [{"kid": "new"}]})
+
+
+if __name__ == "__main__":
+    unittest.main()
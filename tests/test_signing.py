@@ -0,0 +1,80 @@
+import base64
+import json
+import os
+import tempfile
+
+import asynctest
+
+from authlib.jose import jwt
+
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.config.keys import KEY_RING, KeyRing, SigningKey, load_key_set
+from elixir_rems_proxy.utils.signing import close_key_reload, create_signer, init_key_reload
+
+SIGNING_KEY = KEY_RING.current.active
+HEADER = SIGNING_KEY.encoded_header("dummyhost")
+
+
+class TestSigner(asynctest.TestCase):
+    """Test JWT signing backends."""
+
+    async def check_signer(self, executor, workers):
+        """Check that the signer returns valid tokens in payload order."""
+        signer = create_signer(SIGNING_KEY, executor, workers)
+        try:
+            payloads = [{"sub": "testuser", "n": n} for n in range(5)]
+            tokens = await signer.sign(SIGNING_KEY, HEADER, payloads)
+            self.assertEqual([jwt.decode(token, CONFIG.public_key)["n"] for token in tokens], list(range(5)))
+            self.assertEqual(await signer.sign(SIGNING_KEY, HEADER, []), [])
+        finally:
+            signer.close()
+
+    async def test_synchronous(self):
+        """Test signing without workers."""
+        await self.check_signer("thread", 0)
+
+    async def test_thread_pool(self):
+        """Test signing in a thread pool."""
+        await self.check_signer("thread", 2)
+
+    async def test_process_pool(self):
+        """Test signing in a process pool."""
+        await self.check_signer("process", 2)
+
+    async def test_rotated_key(self):
+        """Test that process pool workers load a key other than the one they started with."""
+        key = SigningKey(CONFIG.private_key, "rotated")
+        signer = create_signer(SIGNING_KEY, "process", 2)
+        try:
+            tokens = await signer.sign(key, key.encoded_header("dummyhost"), [{"sub": "testuser"}] * 4)
+            for token in tokens:
+                header = token.split(".")[0]
+                self.assertEqual(json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4)))["kid"], "rotated")
+        finally:
+            signer.close()
+
+    async def test_reload_on_start(self):
+        """Test that a worker starting after the key files were rotated signs with the new active key."""
+        with tempfile.TemporaryDirectory() as directory:
+            private_key_file = os.path.join(directory, "private_key.json")
+            public_key_file = os.path.join(directory, "public_key.json")
+            with open(public_key_file, "w") as public_file:
+                json.dump({"keys": []}, public_file)
+
+            def key_ring(active):
+                return {"keys": [dict(CONFIG.private_key, kid=kid, alg="RS256", status="active" if kid == active else "published") for kid in ("old", "new")]}
+
+            ring = KeyRing(load_key_set(key_ring("old"), {"keys": []}), private_key_file, public_key_file)
+            # Rotated after the master loaded the keys, and before the worker starts
+            with open(private_key_file, "w") as private_file:
+                json.dump(key_ring("new"), private_file)
+            app = {}
+            with asynctest.patch("elixir_rems_proxy.utils.signing.KEY_RING", ring):
+                await init_key_reload(app)
+                await close_key_reload(app)
+            self.assertEqual(ring.current.active.kid, "new")
+
+    async def test_unknown_executor(self):
+        """Test that an unknown executor is rejected."""
+        with self.assertRaises(ValueError):
+            create_signer(SIGNING_KEY, "fiber", 2)
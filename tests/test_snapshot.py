@@ -0,0 +1,157 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+import asynctest
+
+from unittest.mock import patch
+
+from elixir_rems_proxy.utils.snapshot import PermissionSnapshot
+from elixir_rems_proxy.utils.types import Permission, Visa
+
+KEY = ("user", b"fingerprint")
+
+
+class TestPermissionSnapshot(asynctest.TestCase):
+    """Test the permissions snapshot shared by workers."""
+
+    def setUp(self):
+        """Open two snapshots of the same file, as two workers would."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot.sqlite")
+        self.worker1 = PermissionSnapshot(self.path, ttl=10, stale_ttl=60, lease=1, poll_interval=0.01)
+        self.worker2 = PermissionSnapshot(self.path, ttl=10, stale_ttl=60, lease=1, poll_interval=0.01)
+
+    def tearDown(self):
+        """Remove the snapshot file."""
+        self.worker1.close()
+        self.worker2.close()
+        self.directory.cleanup()
+
+    async def test_shared(self):
+        """Test that permissions stored by one worker are read by another while fresh, and the file is private."""
+        fetched = self.worker1.put(KEY, [Permission("EGAD1", None)])
+        fetch = asynctest.CoroutineMock(return_value=[])
+        self.assertEqual(await self.worker2.get_or_fetch(KEY, fetch), (fetched, [Permission("EGAD1", None)]))
+        fetch.assert_not_called()
+        refetched, value = await self.worker2.get_or_fetch(KEY, fetch, refresh=True)
+        self.assertEqual(value, [])
+        self.assertGreaterEqual(refetched, fetched)
+        self.assertEqual(self.worker1.get(KEY)[1], [])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    async def test_lease(self):
+        """Test that one worker fetches while the other waits for its result."""
+        fetched = asyncio.Event()
+
+        async def fetch():
+            await fetched.wait()
+            return [Permission("EGAD1", None)]
+
+        fetch2 = asynctest.CoroutineMock(return_value=[])
+        first = asyncio.ensure_future(self.worker1.get_or_fetch(KEY, fetch))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.worker2.get_or_fetch(KEY, fetch2))
+        await asyncio.sleep(0.05)
+        self.assertFalse(second.done())
+        fetched.set()
+        self.assertEqual((await first)[1], [Permission("EGAD1", None)])
+        self.assertEqual(await second, await first)
+        fetch2.assert_not_called()
+        self.assertEqual(self.worker2.waits, 1)
+        self.assertFalse(self.worker1.leased(KEY))
+
+    async def test_failed_fetch(self):
+        """Test that a failed fetch releases the lease, so that waiting workers fetch themselves."""
+        failed = asyncio.Event()
+
+        async def fetch():
+            await failed.wait()
+            raise ValueError()
+
+        first = asyncio.ensure_future(self.worker1.get_or_fetch(KEY, fetch))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.worker2.get_or_fetch(KEY, asynctest.CoroutineMock(return_value=[])))
+        await asyncio.sleep(0.05)
+        failed.set()
+        with self.assertRaises(ValueError):
+            await first
+        self.assertEqual((await second)[1], [])
+
+    async def test_expired_lease(self):
+        """Test that the lease of a worker that stopped expires."""
+        self.assertTrue(self.worker1.acquire(KEY))
+        self.assertFalse(self.worker2.acquire(KEY))
+        with patch("time.time", return_value=time.time() + 2):
+            self.assertTrue(self.worker2.acquire(KEY))
+        self.worker1.release(KEY)
+        self.assertTrue(self.worker2.leased(KEY))
+
+    async def test_renewed_lease(self):
+        """Test that a renewed lease outlasts its first expiry, and only the worker holding it renews it."""
+        self.assertTrue(self.worker1.acquire(KEY))
+        self.assertFalse(self.worker2.renew(KEY))
+        with patch("time.time", return_value=time.time() + 0.5):
+            self.assertTrue(self.worker1.renew(KEY))
+        with patch("time.time", return_value=time.time() + 1.2):
+            self.assertFalse(self.worker2.acquire(KEY))
+        self.worker1.release(KEY)
+        self.assertFalse(self.worker1.renew(KEY))
+
+    async def test_overlapping_entitlements(self):
+        """Test that syncs storing at the same time write generations of their own, and the last one completed is read."""
+        users1 = {f"user{i}": [Visa("EGAD1", i)] for i in range(5)}
+        users2 = {f"user{i}": [Visa("EGAD2", i)] for i in range(3)}
+        with patch("elixir_rems_proxy.utils.snapshot.ENTITLEMENT_BATCH", 2):
+            await asyncio.gather(self.worker1.store_entitlements(users1, 100), self.worker2.store_entitlements(users2, 200))
+        self.assertEqual(self.worker1.entitlements("user1"), (200, [Visa("EGAD2", 1)]))
+        self.assertEqual(self.worker1.entitlements("user4"), (200, None))
+        self.assertEqual(self.worker1.entitlements_synced(), 200)
+        self.assertEqual(self.worker1._db.execute("SELECT count(*), count(DISTINCT generation) FROM entitlements").fetchone(), (3, 1))
+
+    async def test_locked(self):
+        """Test that writes to a snapshot locked by another worker are given up at once, while reads go on."""
+        fetched = self.worker1.put(KEY, [Permission("EGAD1", None)])
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            start = time.perf_counter()
+            self.assertFalse(self.worker1.acquire(KEY))
+            self.assertEqual(self.worker1.get(KEY), (fetched, [Permission("EGAD1", None)]))
+            self.assertFalse(self.worker1.leased(KEY))
+            self.worker1.put(KEY, [])
+            self.worker1.release(KEY)
+            self.assertEqual(self.worker1.prune(), 0)
+            self.assertLess(time.perf_counter() - start, 1)
+        finally:
+            writer.execute("ROLLBACK")
+            writer.close()
+        self.assertEqual(self.worker1.get(KEY), (fetched, [Permission("EGAD1", None)]))
+        self.assertTrue(self.worker1.acquire(KEY))
+
+    async def test_prune(self):
+        """Test that permissions too old to be served are pruned, and users are invalidated."""
+        with patch("time.time", return_value=100):
+            self.worker1.put(KEY, [])
+            self.worker1.put(("other", b"fingerprint"), [])
+        with patch("time.time", return_value=165):
+            self.assertEqual(self.worker1.prune(), 0)
+        with patch("time.time", return_value=175):
+            self.assertEqual(self.worker1.invalidate("other"), 1)
+            self.assertEqual(self.worker1.prune(), 1)
+        self.assertIsNone(self.worker2.get(KEY))
+
+    async def test_pruned_on_put(self):
+        """Test that storing permissions prunes the snapshot once every prune interval."""
+        now = time.time()
+        self.worker1.put(KEY, [])
+        self.worker1.acquire(("other", b"fingerprint"))
+        with patch("time.time", return_value=now + 200):
+            self.worker1.put(("other", b"fingerprint"), [])
+        self.assertIsNotNone(self.worker2.get(KEY))
+        with patch("time.time", return_value=now + 300):
+            self.worker1.put(("other", b"fingerprint"), [])
+        self.assertIsNone(self.worker2.get(KEY))
+        self.assertEqual(self.worker2._db.execute("SELECT count(*) FROM leases").fetchone(), (0,))
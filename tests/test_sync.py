@@ -0,0 +1,185 @@
+import asyncio
+import os
+import tempfile
+
+import aiohttp
+import asynctest
+
+from aiohttp.test_utils import TestClient, TestServer
+from unittest.mock import patch
+
+from elixir_rems_proxy.app import init_app
+from elixir_rems_proxy.config import CONFIG
+from elixir_rems_proxy.endpoints.permissions import permission_visa
+from elixir_rems_proxy.utils.client import RemsClient
+from elixir_rems_proxy.utils.snapshot import PermissionSnapshot
+from elixir_rems_proxy.utils.sync import ENTITLEMENT_SYNC, SYNC_LEASE, EntitlementSync, build_index
+from elixir_rems_proxy.utils.types import Visa
+
+from .fake_rems import FakeRems
+
+START = "2020-01-01T12:00:00.000Z"
+
+
+def all_entitlements(user_id: str) -> list:
+    """Return entitlements of all users, as REMS lists them to its owner."""
+    return [
+        {"resource": "EGAD1", "user": {"userid": "user1", "name": "User 1"}, "start": START},
+        {"resource": "EGAD2", "user": {"userid": "user1"}, "start": START},
+        {"resource": "EGAD1", "user": "user2", "start": START},
+        {"resource": "EGAD3", "start": START},
+    ]
+
+
+async def iterate(items: list):
+    """Yield entitlements as the incremental parser would."""
+    for item in items:
+        yield item
+
+
+class TestBuildIndex(asynctest.TestCase):
+    """Test building the entitlement index."""
+
+    async def test_grouped(self):
+        """Test that visas are grouped by user, shared between users, and entitlements without a user are skipped."""
+        index = await build_index(iterate(all_entitlements("owner")), permission_visa)
+        self.assertEqual(set(index.users), {"user1", "user2"})
+        self.assertEqual(index.users["user1"], (Visa(f"{CONFIG.repository}EGAD1", 1577880000), Visa(f"{CONFIG.repository}EGAD2", 1577880000)))
+        self.assertIs(index.users["user1"][0], index.users["user2"][0])
+        self.assertEqual(index.entitlements, 3)
+        self.assertGreater(index.size, 0)
+
+
+class TestEntitlementSync(asynctest.TestCase):
+    """Test syncing from a fake REMS."""
+
+    async def setUp(self):
+        """Start the fake REMS."""
+        self.rems = FakeRems(permissions=all_entitlements)
+        self.server = TestServer(self.rems.app)
+        await self.server.start_server()
+        self.session = aiohttp.ClientSession()
+        client = RemsClient(self.session, retries=0, backoff=0.001)
+        self.sync = EntitlementSync(client, str(self.server.make_url("/api/entitlements")), "owner-key", "owner", 60, permission_visa)
+
+    async def tearDown(self):
+        """Stop the fake REMS."""
+        await self.session.close()
+        await self.server.close()
+
+    async def test_lookup(self):
+        """Test that only requests with the sync api key are answered from a fresh index."""
+        self.assertIsNone(self.sync.lookup("user2", "owner-key"))
+        index = await self.sync.sync()
+        self.assertEqual(self.sync.lookup("user2", "owner-key"), (index.synced, (Visa(f"{CONFIG.repository}EGAD1", 1577880000),)))
+        self.assertIsNone(self.sync.lookup("user2", "other-key"))
+        self.assertIsNone(self.sync.lookup("user3", "owner-key"))
+        with patch("time.time", return_value=self.sync.index.synced + 181):
+            self.assertIsNone(self.sync.lookup("user2", "owner-key"))
+
+    async def test_shared(self):
+        """Test that with a snapshot one worker syncs, and every worker looks users up in the index it stored."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.sqlite")
+            snapshots = [PermissionSnapshot(path, ttl=60), PermissionSnapshot(path, ttl=60)]
+            workers = [EntitlementSync(self.sync.client, self.sync.url, "owner-key", "owner", 60, permission_visa, snapshot) for snapshot in snapshots]
+            try:
+                index = await workers[0].sync()
+                self.assertIsNone(workers[0].index)
+                # Synced less than an interval ago by the other worker
+                self.assertIsNone(await workers[1].sync())
+                self.assertEqual(self.rems.calls, 1)
+                self.assertEqual(workers[1].lookup("user2", "owner-key"), (index.synced, [Visa(f"{CONFIG.repository}EGAD1", 1577880000)]))
+                self.assertIsNone(workers[1].lookup("user3", "owner-key"))
+                self.assertIsNone(workers[1].lookup("user2", "other-key"))
+                self.assertLess(workers[1].age(), 60)
+
+                # A new sync replaces the stored index
+                with patch("time.time", return_value=index.synced + 61):
+                    self.assertIsNotNone(await workers[1].sync())
+                self.assertEqual(self.rems.calls, 2)
+                self.assertEqual(snapshots[0]._db.execute("SELECT count(*), count(DISTINCT generation) FROM entitlements").fetchone(), (2, 1))
+            finally:
+                for snapshot in snapshots:
+                    snapshot.close()
+
+    async def test_sync_leased(self):
+        """Test that a worker does not sync while another one holds the sync lease."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.sqlite")
+            snapshots = [PermissionSnapshot(path, ttl=60), PermissionSnapshot(path, ttl=60)]
+            try:
+                self.assertTrue(snapshots[0].acquire(SYNC_LEASE, lease=60))
+                worker = EntitlementSync(self.sync.client, self.sync.url, "owner-key", "owner", 60, permission_visa, snapshots[1])
+                self.assertIsNone(await worker.sync())
+                self.assertEqual(self.rems.calls, 0)
+                self.assertIsNone(worker.lookup("user2", "owner-key"))
+            finally:
+                for snapshot in snapshots:
+                    snapshot.close()
+
+    async def test_sync_lease_renewed(self):
+        """Test that the sync lease is renewed while a sync lasts longer than the lease, and released once done."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.sqlite")
+            snapshots = [PermissionSnapshot(path, ttl=60), PermissionSnapshot(path, ttl=60)]
+            worker = EntitlementSync(self.sync.client, self.sync.url, "owner-key", "owner", 60, permission_visa, snapshots[0])
+            leased = []
+
+            async def slow_sync():
+                for _ in range(4):
+                    await asyncio.sleep(0.05)
+                    leased.append(snapshots[1].leased(SYNC_LEASE))
+
+            try:
+                with patch("elixir_rems_proxy.utils.sync.SYNC_LEASE_SECONDS", 0.06), patch.object(worker, "_sync", slow_sync):
+                    await worker.sync()
+                self.assertEqual(leased, [True] * 4)
+                self.assertFalse(snapshots[1].leased(SYNC_LEASE))
+            finally:
+                for snapshot in snapshots:
+                    snapshot.close()
+
+    async def test_failed_sync(self):
+        """Test that the index is kept when a sync fails."""
+        index = await self.sync.sync()
+        self.rems.script = [503]
+        with patch("asyncio.sleep", side_effect=asyncio.CancelledError), self.assertRaises(asyncio.CancelledError):
+            await self.sync.run()
+        self.assertIs(self.sync.index, index)
+
+
+class TestIndexedPermissions(asynctest.TestCase):
+    """Test that indexed users are answered without calling REMS."""
+
+    async def test_indexed(self):
+        """Test that users in the index skip REMS, others and other api keys are fetched from it."""
+        rems = FakeRems(permissions=all_entitlements)
+        server = TestServer(rems.app)
+        await server.start_server()
+        config = CONFIG._replace(rems_url=str(server.make_url("/api/entitlements")), rems_sync_interval=60, rems_sync_api_key="owner-key")
+        with patch("elixir_rems_proxy.utils.sync.CONFIG", config), patch("elixir_rems_proxy.endpoints.permissions.CONFIG", config):
+            app = await init_app()
+            client = TestClient(TestServer(app))
+            await client.start_server()
+            try:
+                # Synced in the background on startup
+                while app[ENTITLEMENT_SYNC].index is None:
+                    await asyncio.sleep(0.01)
+                calls = rems.calls
+                response = await client.get("/permissions/user1", headers={"Permissions-Api-Key": "owner-key"})
+                self.assertEqual(len((await response.json())["ga4gh_passport_v1"]), 2)
+                self.assertIn("Age", response.headers)
+                response = await client.post("/permissions", json={"usernames": ["user1", "user2"]}, headers={"Permissions-Api-Key": "owner-key"})
+                self.assertEqual(response.status, 200)
+                response = await client.get("/permissions/user1?resource=EGAD2", headers={"Permissions-Api-Key": "owner-key"})
+                self.assertEqual(len((await response.json())["ga4gh_passport_v1"]), 1)
+                self.assertEqual(rems.calls, calls)
+
+                await client.get("/permissions/user3", headers={"Permissions-Api-Key": "owner-key"})
+                await client.get("/permissions/user1", headers={"Permissions-Api-Key": "other-key"})
+                await client.get("/permissions/user1", headers={"Permissions-Api-Key": "owner-key", "Cache-Control": "no-cache"})
+                self.assertEqual(rems.calls, calls + 3)
+            finally:
+                await client.close()
+                await server.close()
@@ -1,13 +1,33 @@
+import os
+import tempfile
+import time
+
 import aiohttp
 import asynctest
+
+from aiohttp import web
 import random
 
 from authlib.jose import jwt
 from asynctest import CoroutineMock
 from unittest.mock import patch
+from prometheus_client import REGISTRY
 
 from elixir_rems_proxy.config import CONFIG
 import elixir_rems_proxy.endpoints.permissions as permissions
+from elixir_rems_proxy.utils.cache import LRUCache
+from elixir_rems_proxy.utils.client import RemsClient
+from elixir_rems_proxy.utils.ratelimit import TokenBuckets
+from elixir_rems_proxy.utils.snapshot import PERMISSIONS_SNAPSHOT, PermissionSnapshot
+from elixir_rems_proxy.utils.types import Permission, PermissionFilter, Visa
+
+
+class Request(dict):
+    """Minimal stand-in for `aiohttp.web.Request`."""
+
+    host = "dummyhost"
+    app = {}
+    headers = {}
 
 
 class TestPermissionFunctions(asynctest.TestCase):
@@ -18,25 +38,23 @@ class TestPermissionFunctions(asynctest.TestCase):
         """Test visa generation."""
         # Test that you get as many items in your visa as the input permissions.
         length = random.randint(1, 10)
-        visas = await permissions.create_ga4gh_visa_v1([{"start": 1} for x in range(length)])
+        visas = await permissions.create_ga4gh_visa_v1([Permission("EGAD1", "start") for x in range(length)])
         self.assertEqual(length, len(visas), msg=f"Unequal length for input {length}")
 
         # Test that the first one contains all fields.
-        self.assertIn("type", visas[0])
-        self.assertIn("value", visas[0])
-        self.assertIn("source", visas[0])
-        self.assertIn("by", visas[0])
-        self.assertIn("asserted", visas[0])
+        claim = visas[0].claim()
+        self.assertEqual(claim["type"], "ControlledAccessGrants")
+        self.assertEqual(claim["value"], f"{CONFIG.repository}EGAD1")
+        self.assertIn("source", claim)
+        self.assertIn("by", claim)
+        self.assertIn("asserted", claim)
 
     async def test_ga4gh_passports(self):
         """Test passport generation."""
         length = random.randint(1, 10)
-        visas = "v" * length
+        visas = [Visa(f"dataset{n}", 1577880000) for n in range(length)]
         user = "testuser"
 
-        class Request:
-            host = "dummyhost"
-
         passport = await permissions.create_ga4gh_passports(Request(), user, visas)
         # Check the length of the passport (number of visas)
         self.assertEqual(length, len(passport), msg=f"Unequal length for input {length}")
@@ -46,17 +64,51 @@ class TestPermissionFunctions(asynctest.TestCase):
         # Check that the first visa contains the correct fields
         self.assertIn("iss", decoded)
         self.assertIn("sub", decoded)
-        self.assertIn("ga4gh_visa_v1", decoded)
+        self.assertEqual(decoded["ga4gh_visa_v1"], visas[0].claim())
         # Check that the first visa contains the correct username
         self.assertEqual(decoded["sub"], user)
 
+    async def test_ga4gh_passports_reused(self):
+        """Test that signed visas are reused from the cache until they get close to expiry."""
+        visas = [Visa("dataset1", None), Visa("dataset2", None)]
+        with patch("elixir_rems_proxy.endpoints.permissions.TOKEN_CACHE", LRUCache(10, 60)) as cache:
+            first = await permissions.create_ga4gh_passports(Request(), "testuser", visas)
+            second = await permissions.create_ga4gh_passports(Request(), "testuser", visas)
+            self.assertEqual(first, second)
+            self.assertNotEqual(first[0], first[1])
+            # Other users never receive the same tokens
+            other = await permissions.create_ga4gh_passports(Request(), "otheruser", visas)
+            self.assertNotEqual(first[0], other[0])
+            self.assertEqual(cache.hits, 2)
+        with patch("elixir_rems_proxy.endpoints.permissions.TOKEN_CACHE", LRUCache(10, 0)):
+            third = await permissions.create_ga4gh_passports(Request(), "testuser", visas)
+            self.assertNotEqual(first, third)
+
     async def test_iso_to_timestamp(self):
         """Test that timestamp generation works as expected."""
         iso = "2020-01-01T12:00:00.000Z"
         expected_stamp = 1577880000
-        stamp = await permissions.iso_to_timestamp(iso)
+        stamp = permissions.iso_to_timestamp(iso)
         self.assertEqual(stamp, expected_stamp)
 
+    async def test_iso_to_timestamp_formats(self):
+        """Test that UTC offsets and other formats give the same timestamp."""
+        expected_stamp = 1577880000
+        self.assertEqual(permissions.iso_to_timestamp("2020-01-01T12:00:00Z"), expected_stamp)
+        self.assertEqual(permissions.iso_to_timestamp("2020-01-01T12:00:00.999999Z"), expected_stamp)
+        self.assertEqual(permissions.iso_to_timestamp("2020-01-01T14:00:00.000+02:00"), expected_stamp)
+        self.assertEqual(permissions.iso_to_timestamp("2020-01-01T09:30:00-0230"), expected_stamp)
+        # Falls back to the generic parser
+        self.assertEqual(permissions.iso_to_timestamp("2020-01-01 12:00:00 UTC"), expected_stamp)
+        self.assertIsNone(permissions.iso_to_timestamp(None))
+
+    async def test_iso_to_timestamp_invalid(self):
+        """Test that dates out of range are rejected, not carried over into the next month."""
+        with self.assertRaises(ValueError):
+            permissions.iso_to_timestamp("2020-02-30T00:00:00Z")
+        with self.assertRaises(ValueError):
+            permissions.iso_to_timestamp("2020-01-01T24:00:00.000+02:00")
+
     async def test_generate_jtw_timestamp(self):
         """Test that the expires time is in the future."""
         iat, exp = await permissions.generate_jwt_timestamps()
@@ -73,6 +125,31 @@ class TestPermissionFunctions(asynctest.TestCase):
         # if successfull, the json response should be returned without changes
         self.assertEqual(res, {"test": "test"})
 
+    async def test_call_api_shared_session(self):
+        """Test that the given session is used for the call instead of opening a new one."""
+        session = asynctest.MagicMock()
+        session.get.return_value.__aenter__.return_value.json = CoroutineMock(side_effect=[[Permission("test", None)]])
+        session.get.return_value.__aenter__.return_value.status = 200
+
+        with patch("aiohttp.ClientSession") as new_session:
+            res = await permissions.call_rems_api("url", {"x-rems-user-id": "test"}, RemsClient(session))
+        new_session.assert_not_called()
+        session.get.assert_called_once_with("url", headers={"x-rems-user-id": "test"})
+        self.assertEqual(res, [Permission("test", None)])
+
+    async def test_call_api_metrics(self):
+        """Test that REMS latency is recorded by status and the response body is decoded."""
+        session = asynctest.MagicMock()
+        session.get.return_value.__aenter__.return_value.json = CoroutineMock(return_value=[])
+        session.get.return_value.__aenter__.return_value.status = 200
+        before = REGISTRY.get_sample_value("elixir_rems_proxy_rems_request_duration_seconds_count", {"status": "200"}) or 0
+
+        await permissions.call_rems_api("url", {}, RemsClient(session))
+        after = REGISTRY.get_sample_value("elixir_rems_proxy_rems_request_duration_seconds_count", {"status": "200"})
+        self.assertEqual(after, before + 1)
+        loads = session.get.return_value.__aenter__.return_value.json.call_args[1]["loads"]
+        self.assertEqual(loads('[{"resource": "test", "user": "user"}]'), [Permission("test", None)])
+
     @asynctest.patch("aiohttp.ClientSession.get")
     async def test_call_api_fail(self, session_mock):
         """Test that an unsuccessfull call to the rems api raises an error."""
@@ -88,10 +165,10 @@ class TestPermissionFunctions(asynctest.TestCase):
         """Test that an unsuccessfull call to the rems api raises an error."""
 
         session_mock.return_value.__aenter__.return_value.status = 500
-        # status code 500 should internal server error
-        with self.assertRaises(aiohttp.web_exceptions.HTTPInternalServerError) as cm:
+        # status code 500 from REMS should be bad gateway
+        with self.assertRaises(aiohttp.web_exceptions.HTTPBadGateway) as cm:
             await permissions.call_rems_api("url", {})
-        self.assertEqual(cm.exception.status, 500)
+        self.assertEqual(cm.exception.status, 502)
 
     @asynctest.patch("elixir_rems_proxy.endpoints.permissions.create_ga4gh_visa_v1")
     @asynctest.patch("elixir_rems_proxy.endpoints.permissions.create_ga4gh_passports")
@@ -100,7 +177,7 @@ class TestPermissionFunctions(asynctest.TestCase):
         """Test that no passports are returned if no permissions are given."""
 
         mock_call_api.return_value = []
-        passports = await permissions.request_rems_permissions("", "", "")
+        passports = await permissions.request_rems_permissions(Request(), "", "")
         self.assertEqual(passports, [])
 
     @asynctest.patch("elixir_rems_proxy.endpoints.permissions.create_ga4gh_visa_v1")
@@ -113,6 +190,182 @@ class TestPermissionFunctions(asynctest.TestCase):
         # returns
         mock_call_api.return_value = ["testin"]
         mock_passport.return_value = ["testout"]
-        passports = await permissions.request_rems_permissions("", "", "")
+        passports = await permissions.request_rems_permissions(Request(), "", "")
         self.assertEqual(len(passports), 1)
         self.assertEqual(passports, ["testout"])
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.create_ga4gh_visa_v1")
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.create_ga4gh_passports")
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_cached(self, mock_call_api, mock_passport, _mock_visa):
+        """Test that REMS is called once per user and api key while the permissions are cached."""
+        mock_call_api.return_value = ["testin"]
+        mock_passport.return_value = ["testout"]
+        with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 60)):
+            await permissions.request_rems_permissions(Request(), "user", "key")
+            await permissions.request_rems_permissions(Request(), "user", "key")
+            self.assertEqual(mock_call_api.call_count, 1)
+            # Another api key may see different permissions
+            await permissions.request_rems_permissions(Request(), "user", "other key")
+            self.assertEqual(mock_call_api.call_count, 2)
+            # Invalidation forces a new call
+            self.assertEqual(permissions.invalidate_permissions("user"), 2)
+            await permissions.request_rems_permissions(Request(), "user", "key")
+            self.assertEqual(mock_call_api.call_count, 3)
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_refresh(self, mock_call_api):
+        """Test that `Cache-Control: no-cache` refreshes cached permissions, up to the refresh rate of the api key."""
+        mock_call_api.return_value = [Permission("EGAD1", None)]
+
+        class NoCacheRequest(Request):
+            headers = {"Cache-Control": "no-cache"}
+
+        with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 60)), patch(
+            "elixir_rems_proxy.endpoints.permissions.REFRESH_BUCKETS", TokenBuckets(0.001, 2, 10)
+        ):
+            await permissions.fetch_rems_permissions(Request(), "user", "key")
+            refreshed = []
+            for _ in range(3):
+                request = NoCacheRequest()
+                await permissions.fetch_rems_permissions(request, "user", "key")
+                refreshed.append(request[permissions.CACHE_REFRESHES]["user"])
+            self.assertEqual(refreshed, [True, True, False])
+            self.assertEqual(mock_call_api.call_count, 3)
+            # Another api key has a bucket of its own
+            await permissions.fetch_rems_permissions(NoCacheRequest(), "user", "other key")
+            self.assertEqual(mock_call_api.call_count, 4)
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_snapshot(self, mock_call_api):
+        """Test that permissions are shared through the snapshot, and served from it while REMS is unavailable."""
+        mock_call_api.return_value = [Permission("EGAD1", None)]
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = PermissionSnapshot(os.path.join(directory, "snapshot.sqlite"), ttl=60, stale_ttl=600)
+            request = Request()
+            request.app = {PERMISSIONS_SNAPSHOT: snapshot}
+            with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 0)):
+                await permissions.fetch_rems_permissions(request, "user", "key")
+                await permissions.fetch_rems_permissions(request, "user", "key")
+                self.assertEqual(mock_call_api.call_count, 1)
+
+                mock_call_api.side_effect = web.HTTPServiceUnavailable()
+                with self.assertRaises(web.HTTPServiceUnavailable):
+                    await permissions.fetch_rems_permissions(request, "other", "key")
+                fetched = snapshot.get(("user", permissions.api_key_fingerprint("key")))[0]
+                with patch("time.time", return_value=fetched + 300):
+                    request = Request()
+                    request.app = {PERMISSIONS_SNAPSHOT: snapshot}
+                    self.assertEqual(await permissions.fetch_rems_permissions(request, "user", "key"), [Permission("EGAD1", None)])
+                    self.assertEqual(request["permissions_age"], 300)
+            snapshot.close()
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_snapshot_age(self, mock_call_api):
+        """Test that permissions taken from the snapshot are cached as old as they are stored, and tell that age."""
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = PermissionSnapshot(os.path.join(directory, "snapshot.sqlite"), ttl=60)
+            request = Request()
+            request.app = {PERMISSIONS_SNAPSHOT: snapshot}
+            with patch("time.time", return_value=1000):
+                snapshot.put(("user", permissions.api_key_fingerprint("key")), [Permission("EGAD1", None)])
+            cache = LRUCache(10, 60)
+            with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", cache), patch("time.time", return_value=1050):
+                self.assertEqual(await permissions.fetch_rems_permissions(request, "user", "key"), [Permission("EGAD1", None)])
+                self.assertAlmostEqual(request["permissions_age"], 50, places=3)
+                mock_call_api.assert_not_called()
+                # Expires from the cache when the stored permissions do
+                with patch("time.monotonic", return_value=time.monotonic() + 11):
+                    self.assertIsNone(cache.get(("user", permissions.api_key_fingerprint("key"))))
+            snapshot.close()
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_stale(self, mock_call_api):
+        """Test that expired permissions are served while REMS is unavailable, and only then."""
+        mock_call_api.return_value = [Permission("EGAD1", None)]
+        with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 60, stale_ttl=600)):
+            with patch("time.monotonic", return_value=100):
+                await permissions.fetch_rems_permissions(Request(), "user", "key")
+            mock_call_api.side_effect = web.HTTPServiceUnavailable()
+            with patch("time.monotonic", return_value=200):
+                request = Request()
+                self.assertEqual(await permissions.fetch_rems_permissions(request, "user", "key"), [Permission("EGAD1", None)])
+                self.assertEqual(request["permissions_age"], 100)
+                with self.assertRaises(web.HTTPServiceUnavailable):
+                    await permissions.fetch_rems_permissions(Request(), "other", "key")
+            mock_call_api.side_effect = web.HTTPForbidden()
+            with patch("time.monotonic", return_value=200), self.assertRaises(web.HTTPForbidden):
+                await permissions.fetch_rems_permissions(Request(), "user", "key")
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_filtered(self, mock_call_api):
+        """Test that only requested permissions are signed, with the resource filter passed to REMS unless all permissions are cached."""
+        rems = [Permission("EGAD1", "2020-01-01T12:00:00.000Z"), Permission("EGAD2", "2021-01-01T12:00:00.000Z"), Permission("EGAF3", None)]
+        mock_call_api.side_effect = lambda url, headers, client: [permission for permission in rems if "resource=" not in url or permission.resource in url]
+
+        def values(passports):
+            return [jwt.decode(passport, CONFIG.public_key)["ga4gh_visa_v1"]["value"].replace(CONFIG.repository, "") for passport in passports]
+
+        with patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 60)):
+            self.assertEqual(values(await permissions.request_rems_permissions(Request(), "user", "key", PermissionFilter(resource="EGAD2"))), ["EGAD2"])
+            self.assertTrue(mock_call_api.call_args[1]["url"].endswith("?user=user&resource=EGAD2"))
+            self.assertEqual(values(await permissions.request_rems_permissions(Request(), "user", "key", PermissionFilter(prefix="EGAD"))), ["EGAD1", "EGAD2"])
+            self.assertEqual(values(await permissions.request_rems_permissions(Request(), "user", "key", PermissionFilter(since=1577880000))), ["EGAD2"])
+            self.assertEqual(mock_call_api.call_count, 2)
+            # All permissions of the user are cached now
+            self.assertEqual(values(await permissions.request_rems_permissions(Request(), "user", "key", PermissionFilter(resource="EGAD1"))), ["EGAD1"])
+            self.assertEqual(mock_call_api.call_count, 2)
+
+    async def test_permission_filter(self):
+        """Test that filters select permissions by resource, resource prefix and start."""
+        self.assertTrue(PermissionFilter().selects(None, None))
+        self.assertTrue(PermissionFilter(resource="EGAD1", since=100).selects("EGAD1", 101))
+        self.assertFalse(PermissionFilter(resource="EGAD1").selects("EGAD10", 101))
+        self.assertFalse(PermissionFilter(prefix="EGAD").selects(None, 101))
+        self.assertFalse(PermissionFilter(since=100).selects("EGAD1", 100))
+        self.assertFalse(PermissionFilter(since=100).selects("EGAD1", None))
+
+    async def test_stream_permissions(self):
+        """Test that passports are streamed from REMS permissions in batches, or from the cache."""
+        rems = [Permission(f"EGAD{n}", "2020-01-01T12:00:00.000Z") for n in range(5)]
+
+        async def iter_rems_api(**kwargs):
+            for permission in rems:
+                yield permission
+
+        request = Request()
+        request.app = {"rems_client": None}
+        with patch("elixir_rems_proxy.endpoints.permissions.CONFIG", CONFIG._replace(stream_batch_size=2)), patch(
+            "elixir_rems_proxy.endpoints.permissions.iter_rems_api", side_effect=iter_rems_api
+        ) as mock_rems, patch("elixir_rems_proxy.endpoints.permissions.PERMISSIONS_CACHE", LRUCache(10, 60)) as cache:
+            passports = [passport async for passport in permissions.stream_rems_permissions(request, "testuser", "key")]
+            self.assertEqual(len(passports), 5)
+            self.assertEqual(jwt.decode(passports[4], CONFIG.public_key)["ga4gh_visa_v1"]["value"], f"{CONFIG.repository}EGAD4")
+            self.assertEqual(mock_rems.call_count, 1)
+            cache.set(("testuser", permissions.api_key_fingerprint("key")), rems[:1])
+            passports = [passport async for passport in permissions.stream_rems_permissions(request, "testuser", "key")]
+            self.assertEqual(len(passports), 1)
+            self.assertEqual(mock_rems.call_count, 1)
+
+    @asynctest.patch("elixir_rems_proxy.endpoints.permissions.call_rems_api")
+    async def test_request_permissions_batch(self, mock_call_api):
+        """Test that permissions of several users are signed together, with errors reported per user."""
+
+        async def call_rems_api(url, headers, client):
+            if headers["x-rems-user-id"] == "forbidden":
+                raise web.HTTPForbidden(text="403 Forbidden")
+            if headers["x-rems-user-id"] == "broken":
+                raise ValueError("Unexpected REMS response")
+            return [Permission(headers["x-rems-user-id"], "2020-01-01T12:00:00.000Z")]
+
+        mock_call_api.side_effect = call_rems_api
+        with patch("elixir_rems_proxy.endpoints.permissions.SYNCHRONOUS_SIGNER.sign", wraps=permissions.SYNCHRONOUS_SIGNER.sign) as sign:
+            result = await permissions.request_rems_permissions_batch(Request(), ["user1", "forbidden", "user2", "broken"], "key")
+        self.assertEqual(list(result), ["user1", "forbidden", "user2", "broken"])
+        self.assertEqual(sign.call_count, 1)
+        for username in ("user1", "user2"):
+            decoded = jwt.decode(result[username]["ga4gh_passport_v1"][0], CONFIG.public_key)
+            self.assertEqual(decoded["sub"], username)
+            self.assertEqual(decoded["ga4gh_visa_v1"]["value"], f"{CONFIG.repository}{username}")
+        self.assertEqual(result["forbidden"], {"error": {"status": 403, "message": "403 Forbidden"}})
+        self.assertEqual(result["broken"], {"error": {"status": 500, "message": "500 Internal Server Error"}})